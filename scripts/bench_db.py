@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Compare the bare and tuned SQLite engine profiles.
+
+Measures, against a throw-away database:
+  - auth checks: SELECT of an authorized user by chat_id
+  - event inserts: one UnauthorizedEvent per transaction (the worst case)
+  - mixed: auth checks running concurrently with a stream of inserts
+
+Uso:
+  python scripts/bench_db.py [--seconds 3] [--concurrency 8] [--dir /ruta/en/el/volumen]
+
+Run it with --dir pointing at the same filesystem as DB_PATH (e.g. the NFS
+mount) to see numbers that match production.
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from sqlalchemy import select  # noqa: E402
+
+from models import AuthorizedUser, Database, UnauthorizedEvent  # noqa: E402
+
+USERS = 200
+
+
+async def _auth_worker(db: Database, deadline: float, counter: list) -> None:
+    chat_id = 0
+    while time.perf_counter() < deadline:
+        async with db.read_session() as session:
+            stmt = select(AuthorizedUser.chat_id).where(AuthorizedUser.chat_id == chat_id % USERS)
+            await session.execute(stmt)
+        chat_id += 1
+        counter[0] += 1
+
+
+async def _insert_worker(db: Database, deadline: float, counter: list) -> None:
+    while time.perf_counter() < deadline:
+        async with db.session() as session:
+            session.add(UnauthorizedEvent(chat_id=counter[0], username=None, command="/start"))
+            await session.commit()
+        counter[0] += 1
+
+
+async def _measure(db: Database, seconds: float, auth_workers: int, insert_workers: int) -> tuple[float, float]:
+    auth_count, insert_count = [0], [0]
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(
+        *(_auth_worker(db, deadline, auth_count) for _ in range(auth_workers)),
+        *(_insert_worker(db, deadline, insert_count) for _ in range(insert_workers)),
+    )
+    return auth_count[0] / seconds, insert_count[0] / seconds
+
+
+async def _bench_profile(name: str, tuned: bool, directory: Path, seconds: float, concurrency: int) -> None:
+    db_path = directory / f"bench_{name}.db"
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+
+    db = Database(db_path, tuned=tuned, read_pool_size=concurrency)
+    await db.initialize()
+    async with db.session() as session:
+        session.add_all(AuthorizedUser(chat_id=i, username=f"user{i}") for i in range(USERS))
+        await session.commit()
+
+    auth, _ = await _measure(db, seconds, concurrency, 0)
+    _, inserts = await _measure(db, seconds, 0, concurrency)
+    mixed_auth, mixed_inserts = await _measure(db, seconds, concurrency, 2)
+    await db.close()
+
+    print(
+        f"{name:<8} auth {auth:>9.0f}/s   insert {inserts:>8.0f}/s   "
+        f"mixed: auth {mixed_auth:>9.0f}/s + insert {mixed_inserts:>7.0f}/s"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=3.0, help="duration of each measurement")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent readers/writers")
+    parser.add_argument("--dir", type=Path, default=None, help="directory for the benchmark databases")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        directory = Path(tmp)
+        await _bench_profile("bare", False, directory, args.seconds, args.concurrency)
+        await _bench_profile("tuned", True, directory, args.seconds, args.concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
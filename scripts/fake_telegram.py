@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Minimal fake Telegram Bot API for testing the bot without Telegram.
+
+Answers the Bot API methods the bot calls at startup and when replying, and
+logs every call. Once the bot registers a webhook (setWebhook), it delivers a
+test update with the right secret token (expects 200) and one with a wrong
+token (expects 403).
+
+Uso:
+  python scripts/fake_telegram.py --port 8081
+
+  # en otra terminal
+  BOT_TOKEN=123:fake TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot \\
+  UPDATE_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443/telegram \\
+  python src/bot.py
+
+Without UPDATE_MODE=webhook the bot long-polls and getUpdates returns the same
+test update once.
+
+sendVideo/sendAudio/sendMediaGroup report how each file arrived: as a
+multipart upload, or, with TELEGRAM_LOCAL_MODE=1, as a file:// path (checked
+to exist, as a local Bot API server sharing the download volumes would read it).
+"""
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+BOT_USER = {"id": 123, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+CHAT = {"id": 1000, "type": "private", "first_name": "Tester", "username": "tester"}
+
+_message_ids = itertools.count(1)
+_update_ids = itertools.count(1)
+_pending_updates = []
+
+
+def _message(text: str) -> dict:
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": CHAT,
+        "from": {"id": CHAT["id"], "is_bot": False, "first_name": "Tester", "username": "tester"},
+        "text": text,
+        **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]} if text.startswith("/") else {}),
+    }
+
+
+def _video_message(caption: str = "", kind: str = "video") -> dict:
+    message = _message(caption)
+    file_id = f"fake-{kind}-{message['message_id']}"
+    message[kind] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+    if kind == "video":
+        message[kind].update(width=1280, height=720)
+    return message
+
+
+def _describe_file(value: str) -> str:
+    if value.startswith("file://"):
+        path = unquote(urlparse(value).path)
+        return f"local path {path} ({'exists' if os.path.isfile(path) else 'MISSING'})"
+    if value.startswith("<upload"):
+        return value
+    return f"file_id {value}"
+
+
+def _update(text: str) -> dict:
+    return {"update_id": next(_update_ids), "message": _message(text)}
+
+
+def _deliver(url: str, secret: str, update: dict) -> int:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def _exercise_webhook(url: str, secret: str) -> None:
+    time.sleep(1)
+    status = _deliver(url, secret, _update("/start"))
+    print(f"webhook delivery with secret      -> {status} ({'ok' if status == 200 else 'UNEXPECTED'})")
+    status = _deliver(url, "wrong-" + secret, _update("/start"))
+    print(f"webhook delivery with bad secret  -> {status} ({'ok' if status == 403 else 'UNEXPECTED'})")
+
+
+class FakeTelegram(BaseHTTPRequestHandler):
+    def _params(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if "json" in content_type:
+            return json.loads(body or b"{}")
+        if "x-www-form-urlencoded" in content_type:
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if "multipart/form-data" in content_type:
+            form = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in form.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True) or b""
+                if part.get_filename():
+                    params[name] = f"<upload {len(payload)} bytes>"
+                else:
+                    params[name] = payload.decode(errors="replace")
+            return params
+        return {}
+
+    def _reply(self, result) -> None:
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except BrokenPipeError:
+            # The bot gave up on a long poll (e.g. while shutting down)
+            pass
+
+    def do_POST(self) -> None:
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        params = self._params()
+        print(f"{method} {json.dumps(params, ensure_ascii=False)[:200]}")
+
+        if method == "getMe":
+            self._reply(BOT_USER)
+        elif method == "getUpdates":
+            updates, _pending_updates[:] = list(_pending_updates), []
+            if not updates:
+                time.sleep(min(float(params.get("timeout") or 0), 1))
+            self._reply(updates)
+        elif method == "setWebhook":
+            self._reply(True)
+            threading.Thread(
+                target=_exercise_webhook, args=(params["url"], params.get("secret_token", "")), daemon=True
+            ).start()
+        elif method in ("sendMessage", "editMessageText"):
+            self._reply(_message(params.get("text", "")))
+        elif method in ("sendVideo", "sendAudio"):
+            kind = "video" if method == "sendVideo" else "audio"
+            print(f"  {kind}: {_describe_file(str(params.get(kind, '')))}")
+            self._reply(_video_message(params.get("caption", ""), kind))
+        elif method == "sendMediaGroup":
+            media = params.get("media", [])
+            if isinstance(media, str):
+                media = json.loads(media)
+            for item in media:
+                item_media = str(item.get("media", ""))
+                if item_media.startswith("attach://"):
+                    item_media = params.get(item_media[len("attach://"):], item_media)
+                print(f"  media: {_describe_file(item_media)}")
+            self._reply([_video_message(item.get("caption", ""), item.get("type", "video")) for item in media])
+        else:
+            self._reply(True)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    _pending_updates.append(_update("/start"))
+    server = ThreadingHTTPServer((args.host, args.port), FakeTelegram)
+    print(f"Fake Bot API on http://{args.host}:{args.port}/bot<token>/<method>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,37 @@ import os
 import logging
 import asyncio
 import signal
+import secrets
+import shutil
+import time
+from datetime import datetime, timedelta
 from typing import Final
 from pathlib import Path
 from urllib.parse import urlparse, urlunparse
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, InputFile, InputMediaAudio, InputMediaVideo, Message, MessageEntity, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters
 
 # Import our modules
 from db_manager import (
     init_db, is_user_authorized, is_super_admin, add_authorized_user, 
-    log_unauthorized_attempt, get_unauthorized_events
+    log_unauthorized_attempt, get_unauthorized_events,
+    get_cached_file_id, cache_file_id, forget_file_id,
+    get_cached_download, record_download, forget_download, prune_download_cache,
+    get_download_access_times,
+    event_writer, close_db, record_job, get_job_stats, get_user_count, db
 )
-from downloader import download_video, ensure_directories, transcode_to_telegram_mp4
+from downloader import (
+    download_video, ensure_directories, transcode_to_telegram_mp4, to_telegram_audio, shutdown_download_engine,
+    stream_to_telegram_mp4, split_for_upload, transcode_pool, STREAM_TRANSCODE,
+    identify_url, expand_url, prefetch_info, telegram_profile_key, active_processes, PREFETCH_TTL_SECONDS
+)
+from scheduler import JobScheduler
+from retry import PERMANENT, TRANSIENT, classify_failure
+from jobqueue import create_job_queue
+from storage import DirectoryBudget, JobDir, StorageManager, publish, remove_empty_job_dir
+from metrics import Counter, Gauge, Histogram, MetricsServer
 
 # Load environment variables
 load_dotenv()
@@ -105,7 +122,196 @@ def _file_size_mb(path: Path) -> float:
     except Exception:
         return 0.0
 
-TELEGRAM_MAX_UPLOAD_MB = float(os.getenv("TELEGRAM_MAX_UPLOAD_MB", "45"))
+# Self-hosted Bot API server (telegram-bot-api --local) at TELEGRAM_API_BASE_URL:
+# it reads files straight from the shared download volumes instead of receiving
+# an HTTP upload, and accepts up to 2000 MB instead of api.telegram.org's 50 MB
+TELEGRAM_LOCAL_MODE = (os.getenv("TELEGRAM_LOCAL_MODE", "0").lower() not in {"0", "false", "no"})
+_TELEGRAM_UPLOAD_LIMIT_MB = 2000 if TELEGRAM_LOCAL_MODE else 50
+TELEGRAM_MAX_UPLOAD_MB = min(
+    float(os.getenv("TELEGRAM_MAX_UPLOAD_MB", "1900" if TELEGRAM_LOCAL_MODE else "45")),
+    _TELEGRAM_UPLOAD_LIMIT_MB,
+)
+# Videos over TELEGRAM_MAX_UPLOAD_MB are cut at keyframes (no re-encode) and
+# sent as an album of parts instead of being refused
+SPLIT_OVERSIZED = (os.getenv("SPLIT_OVERSIZED", "0").lower() not in {"0", "false", "no"})
+
+# Job scheduling: global worker slots and how many of them a single chat may hold
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+MAX_JOBS_PER_CHAT = int(os.getenv("MAX_JOBS_PER_CHAT", "1"))
+
+job_scheduler = JobScheduler(MAX_CONCURRENT_JOBS, MAX_JOBS_PER_CHAT)
+
+# With a durable queue backend ("sqlite" or "package.module:ClassName") the bot only
+# enqueues jobs and separate worker processes (src/worker.py) run them. Empty =
+# jobs run inside the bot through job_scheduler.
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "")
+# A job whose worker stopped renewing its lease this many times is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Batches: every link of a message (up to MAX_BATCH_ITEMS, playlists and
+# carousels included when EXPAND_PLAYLISTS=1) runs as one job that fetches
+# BATCH_CONCURRENCY videos at a time and delivers them in order
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "10"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+EXPAND_PLAYLISTS = (os.getenv("EXPAND_PLAYLISTS", "0").lower() not in {"0", "false", "no"})
+# Telegram accepts 2-10 items per media group
+_MEDIA_GROUP_SIZE = 10
+# Prompts still waiting for a button press, per chat
+_MAX_OPEN_PROMPTS = 50
+
+# Actions that only deliver to the chat: "small" is a low-bandwidth video
+# (SMALL_VIDEO_HEIGHT) and "audio" just the sound track, sent with sendAudio
+_SEND_ACTIONS = {"send", "small", "audio"}
+
+def _action_profile(action: str) -> str:
+    """download_video profile an action fetches with."""
+    return {"save": "best", "small": "small", "audio": "audio"}.get(action, "telegram")
+
+# While the user picks an action: fetch each link's metadata (shown in the
+# prompt, reused by the download) and, with PREFETCH_DOWNLOAD=1, already start
+# downloading a single video for sending; it is dropped if "guardar" is chosen
+# or nobody answers within PREFETCH_TTL_SECONDS
+PREFETCH_INFO = (os.getenv("PREFETCH_INFO", "1").lower() not in {"0", "false", "no"})
+PREFETCH_DOWNLOAD = (os.getenv("PREFETCH_DOWNLOAD", "0").lower() not in {"0", "false", "no"})
+_prefetch_tasks: set[asyncio.Task] = set()
+_staged_downloads: set[asyncio.Task] = set()
+
+job_queue = (
+    create_job_queue(JOB_QUEUE_BACKEND, db, max_attempts=JOB_MAX_ATTEMPTS, per_chat_limit=MAX_JOBS_PER_CHAT)
+    if JOB_QUEUE_BACKEND
+    else None
+)
+
+# How often stale entries are removed from the download cache index
+DOWNLOAD_CACHE_PRUNE_MINUTES = float(os.getenv("DOWNLOAD_CACHE_PRUNE_MINUTES", "60"))
+
+# Disk budgets per directory (MB, 0 = unlimited). Saved videos are pinned (never
+# evicted) unless SAVED_VIDEOS_PINNED=0; DOWNLOAD_DIR only holds files of running
+# jobs, so anything idle there for ORPHAN_MAX_AGE_MINUTES is a leftover. Running
+# jobs keep their files in locked .job-* directories, which are never swept.
+DOWNLOAD_DIR_MAX_MB = float(os.getenv("DOWNLOAD_DIR_MAX_MB", "0"))
+SAVED_VIDEOS_MAX_MB = float(os.getenv("SAVED_VIDEOS_MAX_MB", "0"))
+SAVED_VIDEOS_PINNED = (os.getenv("SAVED_VIDEOS_PINNED", "1").lower() not in {"0", "false", "no"})
+ORPHAN_MAX_AGE_MINUTES = float(os.getenv("ORPHAN_MAX_AGE_MINUTES", "60"))
+# New jobs are refused when they would leave less than this free on the volume
+MIN_FREE_DISK_MB = float(os.getenv("MIN_FREE_DISK_MB", "1024"))
+STORAGE_SWEEP_MINUTES = float(os.getenv("STORAGE_SWEEP_MINUTES", "15"))
+
+storage = StorageManager(
+    [
+        DirectoryBudget("downloads", DOWNLOAD_DIR, int(DOWNLOAD_DIR_MAX_MB * 1024 * 1024), transient=True),
+        DirectoryBudget(
+            "saved_videos", SAVED_VIDEOS_DIR, int(SAVED_VIDEOS_MAX_MB * 1024 * 1024), pinned=SAVED_VIDEOS_PINNED
+        ),
+    ],
+    orphan_age=ORPHAN_MAX_AGE_MINUTES * 60,
+    min_free_bytes=int(MIN_FREE_DISK_MB * 1024 * 1024),
+)
+
+# Space a job may need before it starts: the download plus a transcoded copy.
+# Set apart from the upload limit, which reaches ~2 GB with a local Bot API server.
+JOB_DISK_RESERVE_MB = float(os.getenv("JOB_DISK_RESERVE_MB") or min(TELEGRAM_MAX_UPLOAD_MB * 2, 1024))
+JOB_DISK_RESERVE_BYTES = int(JOB_DISK_RESERVE_MB * 1024 * 1024)
+
+def _job_disk_reserve(estimated_size: int | None = None) -> int:
+    """Free space to ask for before a job: twice the size estimate when known, at most JOB_DISK_RESERVE_MB."""
+    if estimated_size:
+        return min(int(estimated_size * 2), JOB_DISK_RESERVE_BYTES)
+    return JOB_DISK_RESERVE_BYTES
+
+# Long-running maintenance loops, cancelled on shutdown
+_background_tasks: set[asyncio.Task] = set()
+
+# Minimum seconds between progress edits of a status message. Telegram throttles
+# message edits per chat (roughly 20 per minute in groups), so keep this >= 3.
+PROGRESS_EDIT_SECONDS = float(os.getenv("PROGRESS_EDIT_SECONDS", "5"))
+
+# How updates are received: "polling" (getUpdates) or "webhook" (built-in HTTP
+# listener, usually behind a reverse proxy that terminates TLS)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Path served by the listener; defaults to the path of WEBHOOK_URL
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "")
+# Checked against X-Telegram-Bot-Api-Secret-Token; a random one is used if empty
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+# Discard updates that arrived while the bot was down (previous behaviour)
+DROP_PENDING_UPDATES = (os.getenv("DROP_PENDING_UPDATES", "1").lower() not in {"0", "false", "no"})
+# Alternative Bot API endpoint: a local Bot API server or a fake one for tests
+# ("http://127.0.0.1:8081/bot")
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "")
+# Defaults to ".../file/bot" next to TELEGRAM_API_BASE_URL
+TELEGRAM_API_BASE_FILE_URL = os.getenv("TELEGRAM_API_BASE_FILE_URL", "")
+
+def telegram_api_options() -> dict:
+    """Bot API endpoint settings, as keyword arguments of ``telegram.Bot``."""
+    options = {}
+    if TELEGRAM_API_BASE_URL:
+        options["base_url"] = TELEGRAM_API_BASE_URL
+        base_file_url = TELEGRAM_API_BASE_FILE_URL
+        if not base_file_url and TELEGRAM_API_BASE_URL.rstrip("/").endswith("/bot"):
+            base_file_url = TELEGRAM_API_BASE_URL.rstrip("/")[: -len("bot")] + "file/bot"
+        if base_file_url:
+            options["base_file_url"] = base_file_url
+    if TELEGRAM_LOCAL_MODE:
+        options["local_mode"] = True
+    return options
+
+# Prometheus endpoint (0 = disabled)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+def _disk_free_bytes() -> dict:
+    free = {}
+    for name, directory in (("downloads", DOWNLOAD_DIR), ("saved_videos", SAVED_VIDEOS_DIR)):
+        try:
+            free[name] = shutil.disk_usage(directory).free
+        except OSError:
+            free[name] = None
+    return free
+
+STAGE_SECONDS = Histogram(
+    "mediabot_stage_duration_seconds", "Time spent in each stage of a job", ["stage", "action"]
+)
+JOBS_TOTAL = Counter("mediabot_jobs_total", "Processed jobs by final outcome", ["action", "outcome"])
+BYTES_DOWNLOADED = Counter("mediabot_downloaded_bytes_total", "Bytes fetched by yt-dlp", ["action"])
+BYTES_UPLOADED = Counter("mediabot_uploaded_bytes_total", "Bytes uploaded to Telegram", ["action"])
+CACHE_HITS = Counter(
+    "mediabot_cache_hits_total", "Requests served from the file_id cache or a local copy", ["cache"]
+)
+UPLOAD_REJECTIONS = Counter(
+    "mediabot_upload_rejections_total", "Uploads refused for size (file_too_large or telegram_413)", ["action", "reason"]
+)
+Gauge("mediabot_jobs_in_flight", "Jobs currently running", callback=lambda: job_scheduler.in_flight)
+Gauge("mediabot_jobs_queued", "Jobs waiting for a slot", callback=lambda: job_scheduler.queue_depth)
+Gauge("mediabot_transcodes_queued", "Encodes waiting for a transcode slot", callback=lambda: transcode_pool.queue_depth)
+Gauge(
+    "mediabot_processes_in_flight", "yt-dlp runs and ffmpeg processes in progress", ["kind"],
+    callback=lambda: dict(active_processes),
+)
+Gauge("mediabot_disk_free_bytes", "Free space on the download volumes", ["dir"], callback=_disk_free_bytes)
+Gauge(
+    "mediabot_dir_used_bytes", "Bytes used per download directory (as of the last storage sweep)", ["dir"],
+    callback=lambda: dict(storage.last_usage),
+)
+
+_UPLOADED_OUTCOMES = {"sent", "saved_and_sent", "sent_split", "saved_and_sent_split"}
+
+def _observe_job(stats: dict) -> None:
+    """Feed a finished job's stats (see process_video_job) into the metrics."""
+    action, outcome = stats["action"], stats["outcome"]
+    JOBS_TOTAL.inc(action=action, outcome=outcome)
+    for stage in ("download", "transcode", "upload", "total"):
+        seconds = stats.get(f"{stage}_seconds")
+        if seconds is not None:
+            STAGE_SECONDS.observe(seconds, stage=stage, action=action)
+    if stats.get("bytes_downloaded"):
+        BYTES_DOWNLOADED.inc(stats["bytes_downloaded"], action=action)
+    if outcome in _UPLOADED_OUTCOMES and stats.get("output_size"):
+        BYTES_UPLOADED.inc(stats["output_size"], action=action)
+    if outcome in ("file_too_large", "telegram_413"):
+        UPLOAD_REJECTIONS.inc(action=action, reason=outcome)
 
 # Ensure directories exist and have correct permissions
 if not ensure_directories(DOWNLOAD_DIR, SAVED_VIDEOS_DIR):
@@ -175,15 +381,76 @@ async def events_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     message = "Últimos intentos no autorizados:\n\n"
     for event in events:
-        chat_id, username, command, timestamp = event
-        message += f"🚫 Chat ID: {chat_id}\n"
-        message += f"👤 Username: {username or 'N/A'}\n"
-        message += f"🔍 Comando: {command}\n"
-        message += f"⏰ Fecha: {timestamp}\n"
+        message += f"🚫 Chat ID: {event.chat_id}\n"
+        message += f"👤 Username: {event.username or 'N/A'}\n"
+        message += f"🔍 Comando: {event.command}\n"
+        if event.attempts > 1:
+            message += f"🔁 Intentos: {event.attempts}\n"
+        message += f"⏰ Fecha: {event.timestamp}\n"
         message += "------------------------\n"
     
     await update.message.reply_text(message)
 
+def _format_seconds(value: float | None) -> str:
+    if value is None:
+        return "—"
+    if value < 60:
+        return f"{value:.1f} s"
+    return f"{value / 60:.1f} min"
+
+def _format_bytes(value: int) -> str:
+    size = float(value or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Command to view job statistics. Only super admins can use this."""
+    if not await is_super_admin(update.effective_chat.id):
+        await handle_unauthorized_user(update, "/stats")
+        return
+
+    try:
+        hours = float(context.args[0]) if context.args else 24.0
+    except ValueError:
+        await update.message.reply_text("Uso: /stats [horas]\nPor defecto muestra las últimas 24 horas.")
+        return
+
+    stats = await get_job_stats(datetime.utcnow() - timedelta(hours=hours))
+    users = await get_user_count()
+    total = stats["total"]
+    if not total:
+        await update.message.reply_text(
+            f"No hay trabajos registrados en las últimas {hours:g} h.\n👥 Usuarios autorizados: {users}"
+        )
+        return
+
+    failure_rate = 100 * stats["failed"] / total
+    skipped_rate = 100 * stats["transcode_skipped"] / stats["transcoded"] if stats["transcoded"] else 0
+    message = f"📊 Estadísticas (últimas {hours:g} h)\n\n"
+    message += f"🧮 Trabajos: {total} (❌ {stats['failed']} fallidos, {failure_rate:.1f}%)\n"
+    message += f"⚡ Ritmo: {total / hours:.1f} trabajos/h\n"
+    message += f"⬇️ Descargado: {_format_bytes(stats['bytes_downloaded'])}\n"
+    message += f"📦 Producido: {_format_bytes(stats['output_bytes'])}\n"
+    message += f"⏭ Conversión omitida: {skipped_rate:.0f}% de {stats['transcoded']}\n\n"
+    message += "⏱ Latencias (p50 / p95):\n"
+    for label, stage in (
+        ("Descarga", "download_seconds"),
+        ("Conversión", "transcode_seconds"),
+        ("Envío", "upload_seconds"),
+        ("Total", "total_seconds"),
+    ):
+        p50, p95 = stats["latency"][stage]
+        message += f"  {label}: {_format_seconds(p50)} / {_format_seconds(p95)}\n"
+    message += "\n📋 Por resultado:\n"
+    for outcome, count in sorted(stats["outcomes"].items(), key=lambda item: -item[1]):
+        message += f"  {outcome}: {count}\n"
+    message += f"\n👥 Usuarios autorizados: {users}"
+
+    await update.message.reply_text(message)
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     if not await is_user_authorized(update.effective_chat.id):
@@ -202,10 +469,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     await update.message.reply_text(
-        "Simplemente envía un enlace de video y te daré tres opciones:\n\n"
+        "Simplemente envía un enlace de video y te daré cinco opciones:\n\n"
         "1. Descargar y enviar: El video se descargará y te lo enviaré en el chat\n"
         "2. Descargar y guardar: El video se descargará y se guardará en el servidor\n"
-        "3. Descargar, guardar y reenviar: El video se guardará y además te lo enviaré\n\n"
+        "3. Descargar, guardar y reenviar: El video se guardará y además te lo enviaré\n"
+        "4. Solo audio: Te enviaré únicamente el audio (ideal para charlas y canciones)\n"
+        "5. Video ligero: Te enviaré el video en baja resolución, para conexiones lentas\n\n"
+        f"Puedes enviar varios enlaces en un mismo mensaje (hasta {MAX_BATCH_ITEMS}): "
+        "los procesaré en paralelo y te los enviaré en orden, agrupados en álbumes.\n\n"
         "Plataformas soportadas:\n"
         "- Instagram (posts y reels)\n"
         "- Facebook (videos)\n"
@@ -213,26 +484,139 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "- YouTube (videos)"
     )
 
+class _Prompt:
+    """Links waiting for the user to pick an action, plus what was prefetched for them."""
+
+    def __init__(self, urls: list[str]):
+        self.urls = urls
+        # Held while editing the prompt so a late prefetch can't overwrite the job's status
+        self.lock = asyncio.Lock()
+        self.staged: asyncio.Task | None = None
+        self.answered = asyncio.Event()
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def _describe_video(info: dict | None) -> str | None:
+    if not info or not info.get("title"):
+        return None
+    title = str(info["title"])
+    title = title if len(title) <= 100 else title[:97] + "..."
+    details = []
+    if info.get("duration"):
+        details.append(f"⏱ {_format_duration(info['duration'])}")
+    if info.get("estimated_size"):
+        details.append(f"≈{_format_bytes(info['estimated_size'])}")
+    return f"{title} ({' · '.join(details)})" if details else title
+
+async def _stage_download(url: str) -> tuple[bool, str, Path, dict]:
+    # A directory of its own: the job that claims the file may be for the same link
+    workdir = await asyncio.to_thread(JobDir, DOWNLOAD_DIR, f"prefetch {url}")
+    try:
+        return await download_video(url, workdir.path, profile="telegram", max_size_mb=TELEGRAM_MAX_UPLOAD_MB)
+    finally:
+        await asyncio.to_thread(workdir.close)
+
+async def _discard_staged(task: asyncio.Task | None) -> None:
+    """Drop a speculative download. Cancelling it stops the yt-dlp thread (or
+    process); a .part file it leaves is an orphan for the storage sweep."""
+    if task is None:
+        return
+    task.cancel()
+    result = (await asyncio.gather(task, return_exceptions=True))[0]
+    if isinstance(result, tuple) and result[0]:
+        try:
+            result[2].unlink()
+        except OSError:
+            pass
+        remove_empty_job_dir(result[2].parent)
+    logger.info("staged_download_discarded")
+
+async def _prefetch_prompt(
+    prompt: Message, pending: _Prompt, prompts: dict, question: str, reply_markup: InlineKeyboardMarkup
+) -> None:
+    """Show the links' metadata in their prompt and optionally start the download."""
+    infos = await asyncio.gather(*(prefetch_info(url) for url in pending.urls))
+    lines = [_describe_video(info) for info in infos]
+    stage = (
+        PREFETCH_DOWNLOAD
+        and job_queue is None
+        and len(pending.urls) == 1
+        and infos[0] is not None
+        and infos[0].get("type") == "video"
+        and job_scheduler.in_flight + len(_staged_downloads) < MAX_CONCURRENT_JOBS
+        # Speculative work never evicts cached files: without room it just waits
+        and await asyncio.to_thread(
+            storage.has_room, DOWNLOAD_DIR, _job_disk_reserve(infos[0].get("estimated_size"))
+        )
+    )
+
+    async with pending.lock:
+        if prompts.get(prompt.message_id) is not pending:
+            # The user already chose; the job reuses the prefetched metadata
+            return
+        if stage:
+            pending.staged = asyncio.create_task(_stage_download(pending.urls[0]))
+            _staged_downloads.add(pending.staged)
+            pending.staged.add_done_callback(_staged_downloads.discard)
+            logger.info("staged_download_started chat_id=%s", prompt.chat_id)
+        if any(lines):
+            if len(lines) == 1:
+                text = f"🎬 {lines[0]}\n\n{question}"
+            else:
+                text = "\n".join(f"{i}. {line or pending.urls[i - 1]}" for i, line in enumerate(lines, 1))
+                text = f"{text}\n\n{question}"
+            try:
+                await prompt.edit_text(text[:4096], reply_markup=reply_markup)
+            except BadRequest as e:
+                logger.debug(f"Could not update prompt: {e}")
+
+    if pending.staged is not None:
+        try:
+            await asyncio.wait_for(pending.answered.wait(), timeout=PREFETCH_TTL_SECONDS)
+            return
+        except asyncio.TimeoutError:
+            pass
+        async with pending.lock:
+            if prompts.get(prompt.message_id) is pending:
+                staged, pending.staged = pending.staged, None
+                await _discard_staged(staged)
+
+def _message_urls(message: Message) -> tuple[list[str], int]:
+    """Links of a message in order, without duplicates: (first MAX_BATCH_ITEMS, total found)."""
+    urls = []
+    for entity, text in message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK]).items():
+        url = entity.url if entity.type == MessageEntity.TEXT_LINK else text
+        if "://" not in url:
+            url = f"https://{url}"
+        if url not in urls:
+            urls.append(url)
+    return urls[:MAX_BATCH_ITEMS], len(urls)
+
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming URLs and show action options."""
     if not await is_user_authorized(update.effective_chat.id):
         await handle_unauthorized_user(update)
         return
 
-    url = update.message.text
+    urls, found = _message_urls(update.message)
+    if not urls:
+        return
     chat_id = update.effective_chat.id
     username = update.effective_user.username if update.effective_user else None
     logger.info(
-        "url_received chat_id=%s username=%s url=%s",
+        "url_received chat_id=%s username=%s urls=%s url=%s",
         chat_id,
         username,
-        _sanitize_url_for_log(url),
+        found,
+        ",".join(_sanitize_url_for_log(url) for url in urls),
     )
     
-    # Store URL in user_data for later use
-    context.user_data['current_url'] = url
-    
-    # Create inline keyboard with three options
+    # Create inline keyboard with the five options
     keyboard = [
         [
             InlineKeyboardButton("📤 Descargar y enviar", callback_data="send"),
@@ -240,14 +624,32 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         ],
         [
             InlineKeyboardButton("📤💾 Descargar, guardar y reenviar", callback_data="save_and_send")
+        ],
+        [
+            InlineKeyboardButton("🎵 Solo audio", callback_data="audio"),
+            InlineKeyboardButton("📱 Video ligero", callback_data="small")
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "¿Qué quieres hacer con este video?",
-        reply_markup=reply_markup
-    )
+
+    if len(urls) == 1:
+        text = "¿Qué quieres hacer con este video?"
+    else:
+        text = f"¿Qué quieres hacer con estos {len(urls)} videos?"
+        if found > len(urls):
+            text += f"\n(Solo se procesarán los primeros {len(urls)} enlaces de {found}.)"
+    prompt = await update.message.reply_text(text, reply_markup=reply_markup)
+
+    # Keyed by the prompt, so a new link doesn't replace one still waiting for its button
+    prompts = context.chat_data.setdefault('prompts', {})
+    pending = prompts[prompt.message_id] = _Prompt(urls)
+    while len(prompts) > _MAX_OPEN_PROMPTS:
+        await _discard_staged(prompts.pop(next(iter(prompts))).staged)
+
+    if PREFETCH_INFO:
+        task = asyncio.create_task(_prefetch_prompt(prompt, pending, prompts, text, reply_markup))
+        _prefetch_tasks.add(task)
+        task.add_done_callback(_prefetch_tasks.discard)
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle button callbacks."""
@@ -259,232 +661,1164 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     
-    url = context.user_data.get('current_url')
-    if not url:
+    # Popped so a second press on the same prompt can't start the job twice
+    pending = context.chat_data.get('prompts', {}).pop(query.message.message_id, None)
+    if pending is None:
         await query.edit_message_text("❌ Lo siento, hubo un error. Por favor, envía el enlace nuevamente.")
         return
+    urls = pending.urls
+    pending.answered.set()
 
     chat_id = query.message.chat_id
     username = update.effective_user.username if update.effective_user else None
     action = query.data
     logger.info(
-        "action_selected chat_id=%s username=%s action=%s url=%s",
+        "action_selected chat_id=%s username=%s action=%s urls=%s url=%s",
         chat_id,
         username,
         action,
-        _sanitize_url_for_log(url),
+        len(urls),
+        ",".join(_sanitize_url_for_log(url) for url in urls),
     )
     
-    message = await query.edit_message_text("⏳ Procesando el enlace...")
-    
+    async with pending.lock:
+        staged = pending.staged
+        message = await query.edit_message_text(
+            "⏳ Procesando el enlace..." if len(urls) == 1 else "⏳ Procesando los enlaces..."
+        )
+    if staged is not None and action not in ("send", "save_and_send"):
+        # Fetched in the Telegram profile; the other actions want another format
+        await _discard_staged(staged)
+        staged = None
+
+    if job_queue is not None:
+        await _enqueue_for_workers(chat_id, username, action, urls, message)
+        return
+
+    async def run_job() -> None:
+        await process_request(context.bot, chat_id, username, action, urls, message, staged)
+
+    async def show_position(position: int) -> None:
+        try:
+            await message.edit_text(f"⏳ En cola: eres el #{position}. Empezaré en cuanto haya un lugar libre.")
+        except BadRequest:
+            pass
+
+    async def drop_job() -> None:
+        await _discard_staged(staged)
+        await message.edit_text(
+            "⚠️ El bot se está reiniciando y tu solicitud no llegó a empezar. "
+            "Por favor, envía el enlace de nuevo en un momento."
+        )
+
     try:
-        # Choose directory based on action
-        output_dir = SAVED_VIDEOS_DIR if query.data in ["save", "save_and_send"] else DOWNLOAD_DIR
-        
-        await message.edit_text("⬇️ Descargando video...")
-        success, status_msg, video_path = await download_video(url, output_dir)
-        
-        if not success:
-            raise Exception(status_msg)
-        
-        if query.data == "send":
-            # Solo enviar
-            await message.edit_text("📤 Enviando video...")
-            # Make it Telegram-friendly (avoid still-frame+audio issues)
-            ok, _, send_path = await transcode_to_telegram_mp4(video_path)
-            if not ok:
-                send_path = video_path
-
-            size_mb = _file_size_mb(send_path)
-            if size_mb > TELEGRAM_MAX_UPLOAD_MB:
-                # Clean up (send-only should not keep large files)
-                try:
-                    if send_path != video_path:
-                        send_path.unlink()
-                    video_path.unlink()
-                except Exception:
-                    pass
-                logger.warning(
-                    "action_failed chat_id=%s username=%s action=%s error=file_too_large size_mb=%.2f limit_mb=%.2f",
-                    chat_id,
-                    username,
-                    action,
-                    size_mb,
-                    TELEGRAM_MAX_UPLOAD_MB,
-                )
-                await message.edit_text(
-                    f"⚠️ El video pesa {size_mb:.2f} MB y excede el límite de envío del bot (≈{TELEGRAM_MAX_UPLOAD_MB:.0f} MB).\n"
-                    "Usa la opción 'Descargar y guardar' para conservarlo en el servidor."
-                )
-                return
+        position = job_scheduler.submit(chat_id, run_job, show_position, drop_job)
+    except RuntimeError:
+        await _discard_staged(staged)
+        await message.edit_text("⚠️ El bot se está reiniciando. Por favor, intenta de nuevo en un momento.")
+        return
+
+    logger.info(
+        "job_queued chat_id=%s action=%s position=%s in_flight=%s queue_depth=%s transcode_queue_depth=%s",
+        chat_id,
+        action,
+        position,
+        job_scheduler.in_flight,
+        job_scheduler.queue_depth,
+        transcode_pool.queue_depth,
+    )
+
+async def _enqueue_for_workers(
+    chat_id: int, username: str | None, action: str, urls: list[str], message: Message
+) -> None:
+    """Hand the job to the worker processes; they edit ``message`` as it progresses."""
+    try:
+        # Show the position before enqueueing so a worker's first edit can't be overwritten
+        position = (await job_queue.counts()).get("queued", 0) + 1
+        if position > 1:
+            await message.edit_text(f"⏳ En cola: eres el #{position}. Empezaré en cuanto haya un lugar libre.")
+        # A batch is stored as its links one per line (URLs can't contain newlines)
+        job_id = await job_queue.enqueue(chat_id, username, action, "\n".join(urls), message.message_id)
+    except Exception as e:
+        logger.error(f"Could not enqueue job: {e}")
+        await message.edit_text("❌ Lo siento, no se pudo poner el video en cola. Intenta de nuevo en un momento.")
+        return
 
+    logger.info(
+        "job_enqueued chat_id=%s action=%s job_id=%s position=%s backend=%s",
+        chat_id,
+        action,
+        job_id,
+        position,
+        JOB_QUEUE_BACKEND,
+    )
+
+def _video_identities(url_identity: tuple[str, str] | None, video_info: dict) -> list[tuple[str, str]]:
+    """Cache keys for a video: what the URL looks like and what yt-dlp reported."""
+    identities = []
+    if url_identity:
+        identities.append(url_identity)
+    if video_info.get('extractor') and video_info.get('id'):
+        info_identity = (str(video_info['extractor']), str(video_info['id']))
+        if info_identity not in identities:
+            identities.append(info_identity)
+    return identities
+
+async def _send_media(
+    bot: Bot,
+    chat_id: int,
+    media: str | Path,
+    caption: str,
+    audio: bool = False,
+    title: str | None = None,
+    duration: int | None = None,
+) -> Message:
+    """send_video, or send_audio (with its title and duration) for the "audio" action."""
+    if audio:
+        return await bot.send_audio(chat_id=chat_id, audio=media, caption=caption, title=title, duration=duration)
+    return await bot.send_video(chat_id=chat_id, video=media, caption=caption)
+
+async def _remember_sent_video(sent: Message, identities: list[tuple[str, str]], profile_key: str) -> None:
+    video = (sent.video or sent.audio) if sent else None
+    if not video:
+        return
+    try:
+        for extractor, video_id in identities:
+            await cache_file_id(
+                extractor, video_id, profile_key, video.file_id, video.file_unique_id, video.file_size
+            )
+    except Exception as e:
+        logger.warning(f"Could not cache file_id: {e}")
+
+async def _find_local_copy(identities: list[tuple[str, str]], profiles: list[str]) -> Path | None:
+    """Return a previously downloaded file for this video if it is still intact."""
+    for extractor, video_id in identities:
+        entry = await get_cached_download(extractor, video_id, profiles)
+        if entry is None:
+            continue
+        path = Path(entry.path)
+        try:
+            valid = path.is_file() and path.stat().st_size == entry.file_size
+        except OSError:
+            valid = False
+        if not valid:
+            await forget_download(entry.id)
+            continue
+        # Refresh last_used_at
+        await record_download(extractor, video_id, entry.profile, entry.path, entry.file_size)
+        await asyncio.to_thread(storage.touch, path)
+        CACHE_HITS.inc(cache="download")
+        return path
+    return None
+
+async def _remember_download(identities: list[tuple[str, str]], profile: str, path: Path) -> None:
+    try:
+        file_size = path.stat().st_size
+        for extractor, video_id in identities:
+            await record_download(extractor, video_id, profile, str(path), file_size)
+        await asyncio.to_thread(storage.record_file, path)
+    except Exception as e:
+        logger.warning(f"Could not index download: {e}")
+
+def _format_eta(seconds: float | None) -> str:
+    if seconds is None:
+        return ""
+    return f" · quedan ~{_format_duration(seconds)}"
+
+class ProgressMessage:
+    """Shows download/encode progress in a job's status message.
+
+    Progress callbacks can come from yt-dlp worker threads, so ``update`` only
+    records the latest value; the message is edited from the event loop at most
+    once every PROGRESS_EDIT_SECONDS and only when the text actually changes.
+    """
+
+    def __init__(self, message: Message, interval: float = PROGRESS_EDIT_SECONDS):
+        self.message = message
+        self.interval = interval
+        self._progress: tuple[float, float | None] | None = None
+        self._shown: str | None = None
+
+    @property
+    def shown(self) -> bool:
+        """Whether the last ``run`` replaced the message text with its progress."""
+        return self._shown is not None
+
+    def update(self, fraction: float, eta: float | None) -> None:
+        self._progress = (fraction, eta)
+
+    async def run(self, heading: str, coro):
+        """Await ``coro`` while its progress is shown under ``heading``."""
+        self._progress = None
+        self._shown = None
+        task = asyncio.create_task(self._edit_loop(heading))
+        try:
+            return await coro
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _render(self, heading: str) -> str | None:
+        if self._progress is None:
+            return None
+        fraction, eta = self._progress
+        filled = int(fraction * 10)
+        bar = "▓" * filled + "░" * (10 - filled)
+        return f"{heading}\n{bar} {fraction * 100:.0f}%{_format_eta(eta)}"
+
+    async def _edit_loop(self, heading: str) -> None:
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.interval
+            text = self._render(heading)
+            if text is None or text == self._shown:
+                continue
             try:
-                await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=send_path,
-                    caption=f"📹 Video descargado"
-                )
+                await self.message.edit_text(text)
+                self._shown = text
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = max(self.interval, getattr(retry_after, "total_seconds", lambda: retry_after)())
             except BadRequest as e:
-                if "Request Entity Too Large" in str(e):
-                    # Clean up
-                    try:
-                        if send_path != video_path:
-                            send_path.unlink()
-                        video_path.unlink()
-                    except Exception:
-                        pass
-                    logger.warning(
-                        "action_failed chat_id=%s username=%s action=%s error=telegram_413 size_mb=%.2f",
-                        chat_id,
-                        username,
-                        action,
-                        size_mb,
-                    )
-                    await message.edit_text(
-                        "⚠️ Telegram rechazó el envío por tamaño (413).\n"
-                        "Usa la opción 'Descargar y guardar' para conservarlo en el servidor."
-                    )
-                    return
-                raise
-            # Clean up
+                logger.debug(f"Progress edit failed: {e}")
+
+async def _record_job_stats(stats: dict, started_at: datetime, started: float) -> None:
+    stats["total_seconds"] = time.monotonic() - started
+    _observe_job(stats)
+    try:
+        await record_job(created_at=started_at, **stats)
+    except Exception as e:
+        logger.warning(f"Could not record job stats: {e}")
+
+async def process_request(
+    bot: Bot,
+    chat_id: int,
+    username: str | None,
+    action: str,
+    urls: list[str],
+    message: Message,
+    staged: asyncio.Task | None = None,
+) -> str:
+    """Run the job for the links of one prompt; returns its outcome.
+
+    A single video goes through ``process_video_job``; several links, or a
+    playlist/carousel when EXPAND_PLAYLISTS is on, through ``process_batch_job``.
+    ``staged`` is a download started while the prompt was open (PREFETCH_DOWNLOAD).
+    Runs inside the job scheduler, or in a worker process when JOB_QUEUE_BACKEND is set.
+    """
+    items = [(url, None) for url in urls]
+    if EXPAND_PLAYLISTS:
+        items = []
+        for url in urls:
+            items += await expand_url(url, MAX_BATCH_ITEMS - len(items))
+            if len(items) >= MAX_BATCH_ITEMS:
+                break
+    if len(items) == 1 and items[0][1] is None:
+        return await process_video_job(bot, chat_id, username, action, items[0][0], message, staged)
+    await _discard_staged(staged)
+    return await process_batch_job(bot, chat_id, username, action, items, message)
+
+async def process_video_job(
+    bot: Bot,
+    chat_id: int,
+    username: str | None,
+    action: str,
+    url: str,
+    message: Message,
+    staged: asyncio.Task | None = None,
+) -> str:
+    """Download, transcode and deliver a video (or its audio); returns the job outcome."""
+    stats = {"chat_id": chat_id, "action": action, "outcome": "error"}
+    started_at = datetime.utcnow()
+    started = time.monotonic()
+    try:
+        await _deliver_video(bot, chat_id, username, action, url, message, stats, staged)
+    finally:
+        await _record_job_stats(stats, started_at, started)
+    return stats["outcome"]
+
+async def _edit_status(message: Message, text: str) -> None:
+    """Edit a job's status message; showing the text it already has is not an error."""
+    try:
+        await message.edit_text(text)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+async def _claim_staged(staged: asyncio.Task, output_dir: Path, message: Message, stats: dict) -> tuple[Path, dict] | None:
+    """Wait for the download started while the prompt was open and move it to ``output_dir``."""
+    await _edit_status(message, "⬇️ Descargando video...")
+    stage_started = time.monotonic()
+    try:
+        success, status_msg, video_path, video_info = await staged
+    except Exception as e:
+        success, status_msg = False, str(e)
+    if not success:
+        logger.info("staged_download_failed error=%s", status_msg[:200])
+        return None
+    if video_path.parent != output_dir:
+        staging_dir = video_path.parent
+        video_path = await asyncio.to_thread(publish, video_path, output_dir)
+        remove_empty_job_dir(staging_dir)
+    stats["download_seconds"] = time.monotonic() - stage_started
+    stats["bytes_downloaded"] = video_path.stat().st_size
+    logger.info("staged_download_used wait_seconds=%.2f", stats["download_seconds"])
+    return video_path, video_info
+
+async def _deliver_video(
+    bot: Bot,
+    chat_id: int,
+    username: str | None,
+    action: str,
+    url: str,
+    message: Message,
+    stats: dict,
+    staged: asyncio.Task | None = None,
+) -> None:
+    """Prepare and deliver a single video (or its audio), reporting in ``message``.
+
+    Goes through the same ``_prepare_item``/``_deliver_batch`` steps as a batch
+    item; only the status edits and the final report are specific to it.
+    """
+    item = _MediaItem(1, url, chat_id, action)
+    item.stats = stats
+    progress = ProgressMessage(message)
+    noun = "audio" if action == "audio" else "video"
+    try:
+        for use_file_id in (True, False):
+            await _prepare_item(item, progress=progress, staged=staged, use_file_id=use_file_id)
+            staged = None
+            if item.parts:
+                await _send_in_parts(bot, chat_id, action, item, message)
+            elif item.sendable:
+                if item.send_path is not None:
+                    await _edit_status(message, f"📤 Enviando {noun}...")
+                await _deliver_batch(bot, chat_id, action, [item], 1)
+            if not item.stale:
+                break
+            # Telegram no longer has the cached upload: fetch and upload it again
+            item.stale = False
+        await _report_delivery(item, username, message)
+    except Exception as e:
+        await _report_job_failure(chat_id, username, action, message, stats, e)
+    finally:
+        item.close()
+
+async def _report_delivery(item: "_MediaItem", username: str | None, message: Message) -> None:
+    """Tell the user how a single-video job ended; a failed download raised earlier."""
+    stats = item.stats
+    chat_id, action, outcome = stats["chat_id"], stats["action"], stats["outcome"]
+    noun = "audio" if action == "audio" else "video"
+    saved = f"✅ Video guardado como:\n`{item.saved_name}`\n\n" if action == "save_and_send" else ""
+    size_mb = (stats.get("output_size") or 0) / (1024 * 1024)
+    keep_hint = "\nUsa la opción 'Descargar y guardar' para conservarlo en el servidor." if action in ("send", "small") else ""
+
+    if outcome in ("sent", "sent_cached", "sent_split"):
+        await message.delete()
+    elif outcome == "saved":
+        await message.edit_text(f"✅ Video guardado exitosamente como:\n`{item.saved_name}`")
+    elif outcome == "saved_and_sent_split":
+        await message.edit_text(f"✅ Video guardado y enviado en {len(item.parts)} partes como:\n`{item.saved_name}`")
+    elif outcome.startswith("saved_and_sent"):
+        await message.edit_text(f"✅ Video guardado y enviado exitosamente como:\n`{item.saved_name}`")
+    elif outcome == "disk_full":
+        await message.edit_text(
+            "⚠️ El servidor se está quedando sin espacio de almacenamiento.\n"
+            "Inténtalo de nuevo más tarde."
+        )
+    elif outcome == "file_too_large" and saved:
+        await message.edit_text(
+            f"{saved}⚠️ No se pudo reenviar: pesa {size_mb:.2f} MB y excede el límite de Telegram (≈{TELEGRAM_MAX_UPLOAD_MB:.0f} MB)."
+        )
+    elif outcome == "file_too_large":
+        await message.edit_text(
+            f"⚠️ El {noun} pesa {size_mb:.2f} MB y excede el límite de envío del bot (≈{TELEGRAM_MAX_UPLOAD_MB:.0f} MB).{keep_hint}"
+        )
+    elif outcome == "telegram_413":
+        await message.edit_text(f"{saved}⚠️ Telegram rechazó el envío por tamaño (413).{keep_hint}")
+    elif item.parts:
+        sent = [part.index for part in item.parts if part.sent]
+        await message.edit_text(saved + _unsent_parts_text(sent, len(item.parts)))
+    else:
+        await _report_job_failure(chat_id, username, action, message, stats, Exception(stats.get("error") or item.error))
+        return
+
+    if outcome in ("disk_full", "file_too_large", "telegram_413") or item.error:
+        logger.warning(
+            "action_failed chat_id=%s username=%s action=%s error=%s size_mb=%.2f limit_mb=%.2f parts=%s file=%s",
+            chat_id,
+            username,
+            action,
+            stats.get("error") or outcome,
+            size_mb,
+            TELEGRAM_MAX_UPLOAD_MB,
+            len(item.parts),
+            item.saved_name or "",
+        )
+    else:
+        logger.info(
+            "action_success chat_id=%s username=%s action=%s result=%s parts=%s file=%s",
+            chat_id,
+            username,
+            action,
+            outcome,
+            len(item.parts),
+            item.saved_name or "",
+        )
+
+async def _report_job_failure(
+    chat_id: int, username: str | None, action: str, message: Message, stats: dict, error: Exception
+) -> None:
+    stats["outcome"] = "error"
+    stats["error"] = str(error)[:500]
+    failure = classify_failure(str(error))
+    logger.warning(
+        "action_failed chat_id=%s username=%s action=%s failure=%s error=%s",
+        chat_id,
+        username,
+        action,
+        failure,
+        str(error),
+    )
+    if action == "audio" and "requested format is not available" in str(error).lower():
+        text = (
+            "❌ Este sitio no ofrece el audio por separado para este video.\n"
+            "Usa 'Video ligero' o 'Descargar y enviar'."
+        )
+    elif failure == TRANSIENT:
+        text = (
+            "⚠️ El sitio no respondió después de varios intentos. "
+            "Envía el enlace de nuevo en unos minutos: la descarga continuará donde se quedó."
+        )
+    elif failure == PERMANENT:
+        text = (
+            "❌ No se pudo descargar: el video no está disponible, es privado "
+            "o el enlace no es compatible."
+        )
+    else:
+        text = (
+            "❌ Lo siento, ocurrió un error al procesar el video. "
+            "Por favor, verifica que el enlace sea válido."
+        )
+    await message.edit_text(text)
+
+class _MediaItem:
+    """One video (or audio) to deliver, alone or in a batch: what to upload once its turn comes, or why it won't be."""
+
+    def __init__(self, index: int, url: str, chat_id: int, action: str, playlist_item: int | None = None):
+        self.index = index
+        self.url = url
+        self.playlist_item = playlist_item  # carousel entry to fetch from ``url``
+        self.stats = {"chat_id": chat_id, "action": action, "outcome": "error"}
+        self.started_at = datetime.utcnow()
+        self.started = time.monotonic()
+        self.identities: list[tuple[str, str]] = []
+        self.file_id: str | None = None  # previous upload to re-send
+        self.send_path: Path | None = None  # file to upload
+        self.saved_name: str | None = None
+        self.title: str | None = None  # sendAudio metadata
+        self.duration: int | None = None
+        self.cleanup: list[Path] = []  # send-only files removed after delivery
+        self.error: str | None = None  # shown in the batch summary
+        self.caption: str | None = None
+        self.parts: list["_MediaItem"] = []  # sent instead of the item when split
+        self.sent = False
+        self.stale = False  # its file_id was rejected: prepare it again without one
+        self.workdir: JobDir | None = None  # where its files are written until delivered or kept
+
+    @property
+    def sendable(self) -> bool:
+        return self.file_id is not None or self.send_path is not None
+
+    @property
+    def upload_bytes(self) -> int:
+        if self.send_path is None:
+            return 0
+        try:
+            return self.send_path.stat().st_size
+        except OSError:
+            return 0
+
+    def remove_files(self) -> None:
+        for path in self.cleanup:
             try:
-                if send_path != video_path:
-                    send_path.unlink()
-            finally:
-                video_path.unlink()
-            await message.delete()
-            logger.info(
-                "action_success chat_id=%s username=%s action=%s result=sent",
-                chat_id,
-                username,
-                action,
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not remove {path}: {e}")
+        self.cleanup = []
+
+    def close(self) -> None:
+        """Remove what is left of its (and its parts') files and release its working directory."""
+        for part in self.parts:
+            part.remove_files()
+        self.remove_files()
+        if self.workdir is not None:
+            self.workdir.close()
+            self.workdir = None
+
+async def _cached_file_id(identities: list[tuple[str, str]], profile_key: str) -> str | None:
+    for extractor, video_id in identities:
+        file_id = await get_cached_file_id(extractor, video_id, profile_key)
+        if file_id:
+            return file_id
+    return None
+
+def _batch_failure_text(error: str) -> str:
+    failure = classify_failure(error)
+    if failure == TRANSIENT:
+        return "el sitio no respondió, inténtalo de nuevo en unos minutos"
+    if failure == PERMANENT:
+        return "no está disponible, es privado o el enlace no es compatible"
+    return "ocurrió un error al procesarlo"
+
+def _cache_profiles(action: str, profile_key: str) -> list[str]:
+    """Indexed downloads an action can reuse instead of fetching the video again.
+
+    Sending can use a saved copy of either profile; saving wants its own.
+    "small" and "audio" would pay a full re-encode to shrink a saved copy.
+    """
+    if action == "send":
+        return [profile_key, "best"]
+    if action == "save_and_send":
+        return [profile_key]
+    if action == "save":
+        return ["best"]
+    return []
+
+async def _run_stage(progress: ProgressMessage | None, heading: str, stage):
+    """Await ``stage(on_progress)``, shown under ``heading`` in the job's status message if it has one."""
+    if progress is None:
+        return await stage(None)
+    return await progress.run(heading, stage(progress.update))
+
+async def _prepare_item(
+    item: _MediaItem,
+    total: int = 1,
+    progress: ProgressMessage | None = None,
+    staged: asyncio.Task | None = None,
+    use_file_id: bool = True,
+) -> None:
+    """Get an item ready for ``_deliver_batch``: a cached file_id, a file to upload or its parts.
+
+    Downloads the video (or reuses an indexed copy), transcodes it and indexes
+    what is kept. Sets ``item.error`` when it can't be sent at all and raises
+    when the download fails. With ``progress`` the stages are shown in the
+    job's status message; ``staged`` is a download started while the prompt
+    was open (PREFETCH_DOWNLOAD) and needs ``progress`` too.
+    """
+    stats = item.stats
+    chat_id, action = stats["chat_id"], stats["action"]
+    output_dir = SAVED_VIDEOS_DIR if action in ["save", "save_and_send"] else DOWNLOAD_DIR
+    profile = _action_profile(action)
+    profile_key = telegram_profile_key(TELEGRAM_MAX_UPLOAD_MB, profile)
+    noun = "audio" if action == "audio" else "video"
+    if staged is not None and action not in ("send", "save_and_send"):
+        # Staged downloads are fetched for sending as video
+        await _discard_staged(staged)
+        staged = None
+
+    # A carousel item has no URL of its own to identify it by
+    url_identity = await identify_url(item.url) if item.playlist_item is None else None
+    if url_identity:
+        stats["extractor"], stats["video_id"] = url_identity
+        item.identities = [url_identity]
+
+    if use_file_id and action in _SEND_ACTIONS and url_identity:
+        # Already uploaded for someone else: no download, transcode or upload
+        item.file_id = await _cached_file_id(item.identities, profile_key)
+        if item.file_id:
+            await _discard_staged(staged)
+            return
+
+    if item.workdir is None:
+        key = f"{profile} {item.url} {item.playlist_item or ''}"
+        item.workdir = await asyncio.to_thread(JobDir, output_dir, key)
+    workdir = item.workdir.path
+
+    cache_profiles = _cache_profiles(action, profile_key)
+    reused_path = await _find_local_copy(item.identities, cache_profiles) if url_identity and cache_profiles else None
+    claimed = None
+    if reused_path is not None:
+        video_path, video_info = reused_path, {}
+        logger.info("download_cache_hit chat_id=%s action=%s file=%s", chat_id, action, video_path.name)
+        await _discard_staged(staged)
+    elif staged is not None:
+        claimed = await _claim_staged(staged, workdir, progress.message, stats)
+    if claimed is not None:
+        video_path, video_info = claimed
+
+    streamed = False
+    if reused_path is None and claimed is None:
+        if not await asyncio.to_thread(storage.ensure_room, output_dir, JOB_DISK_RESERVE_BYTES):
+            stats["outcome"] = "disk_full"
+            item.error = "el servidor se está quedando sin espacio"
+            logger.warning("disk_full chat_id=%s action=%s dir=%s", chat_id, action, output_dir)
+            return
+
+        if action == "send" and STREAM_TRANSCODE and item.playlist_item is None:
+            # Download and encode in one pass; only the final file touches disk
+            heading = "⬇️ Descargando y convirtiendo video..."
+            if progress is not None:
+                await _edit_status(progress.message, heading)
+            stage_started = time.monotonic()
+            streamed, status_msg, video_path, video_info = await _run_stage(
+                progress,
+                heading,
+                lambda on_progress: stream_to_telegram_mp4(
+                    item.url, workdir, max_size_mb=TELEGRAM_MAX_UPLOAD_MB, on_progress=on_progress
+                ),
             )
-        elif query.data == "save":
-            # Solo guardar
-            await message.edit_text(
-                f"✅ Video guardado exitosamente como:\n"
-                f"`{video_path.name}`"
+            if streamed:
+                # Download and transcode overlap; account the whole pass as download
+                stats["download_seconds"] = time.monotonic() - stage_started
+            else:
+                logger.info("stream_fallback chat_id=%s action=%s reason=%s", chat_id, action, status_msg[:200])
+
+        if not streamed:
+            heading = f"⬇️ Descargando {noun}..."
+            if progress is not None:
+                # A failed staged download already showed this text
+                await _edit_status(progress.message, heading)
+            stage_started = time.monotonic()
+            success, status_msg, video_path, video_info = await _run_stage(
+                progress,
+                heading,
+                lambda on_progress: download_video(
+                    item.url,
+                    workdir,
+                    profile=profile,
+                    max_size_mb=TELEGRAM_MAX_UPLOAD_MB,
+                    on_progress=on_progress,
+                    playlist_item=item.playlist_item,
+                ),
             )
-            logger.info(
-                "action_success chat_id=%s username=%s action=%s result=saved file=%s",
-                chat_id,
-                username,
-                action,
-                video_path.name,
+            if not success:
+                raise Exception(status_msg)
+            stats["download_seconds"] = time.monotonic() - stage_started
+            stats["bytes_downloaded"] = video_path.stat().st_size
+    if reused_path is None and action in _SEND_ACTIONS:
+        item.cleanup.append(video_path)
+
+    item.identities = _video_identities(url_identity, video_info)
+    if item.identities:
+        stats["extractor"], stats["video_id"] = item.identities[-1]
+    item.title = video_info.get("title")
+    item.duration = int(video_info["duration"]) if video_info.get("duration") else None
+
+    if action == "save":
+        if video_path.parent == workdir:
+            video_path = await asyncio.to_thread(publish, video_path, output_dir)
+        await _remember_download(item.identities, "best", video_path)
+        stats["output_size"] = video_path.stat().st_size
+        item.saved_name = video_path.name
+        stats["outcome"] = "saved"
+        return
+
+    if action == "save_and_send" and use_file_id:
+        # Already uploaded before: still save (and index) the Telegram-friendly
+        # copy, but send the upload again instead of the file
+        item.file_id = await _cached_file_id(item.identities, profile_key)
+
+    if streamed:
+        send_path = video_path
+    else:
+        # Make it Telegram-friendly (avoid still-frame+audio issues)
+        stage_started = time.monotonic()
+        if action == "audio":
+            ok, transcode_msg, send_path = await _run_stage(
+                progress,
+                "🎵 Convirtiendo audio...",
+                lambda on_progress: to_telegram_audio(
+                    video_path, TELEGRAM_MAX_UPLOAD_MB, on_progress=on_progress, output_dir=workdir
+                ),
             )
-        else:  # save_and_send
-            # Guardar y enviar
-            await message.edit_text("📤 Enviando video...")
-            ok, _, send_path = await transcode_to_telegram_mp4(video_path)
-            if ok and send_path != video_path:
-                # Replace saved file with Telegram-friendly one to avoid keeping two copies
-                try:
-                    video_path.unlink()
-                except Exception:
-                    pass
-                video_path = send_path
-
-            size_mb = _file_size_mb(video_path)
-            if size_mb > TELEGRAM_MAX_UPLOAD_MB:
-                # Keep file (it's in SAVED_VIDEOS_DIR)
-                logger.warning(
-                    "action_failed chat_id=%s username=%s action=%s error=file_too_large size_mb=%.2f limit_mb=%.2f file=%s",
-                    chat_id,
-                    username,
-                    action,
-                    size_mb,
-                    TELEGRAM_MAX_UPLOAD_MB,
-                    video_path.name,
+        else:
+            ok, transcode_msg, send_path = await _run_stage(
+                progress,
+                "🎞 Convirtiendo video...",
+                lambda on_progress: transcode_to_telegram_mp4(
+                    video_path, TELEGRAM_MAX_UPLOAD_MB, on_progress=on_progress, profile=profile, output_dir=workdir
+                ),
+            )
+        stats["transcode_seconds"] = time.monotonic() - stage_started
+        stats["transcode_skipped"] = transcode_msg in ("transcode skipped", "transcode disabled")
+        if not ok:
+            send_path = video_path
+    if action == "save_and_send":
+        if send_path != video_path and video_path.parent == workdir:
+            # Keep only the Telegram-friendly copy (an indexed copy may be in use elsewhere)
+            try:
+                video_path.unlink()
+            except Exception:
+                pass
+        if send_path.parent == workdir:
+            send_path = await asyncio.to_thread(publish, send_path, output_dir)
+        await _remember_download(item.identities, profile_key, send_path)
+        item.saved_name = send_path.name
+        if item.file_id:
+            return
+    elif send_path != video_path:
+        item.cleanup.append(send_path)
+
+    size_mb = _file_size_mb(send_path)
+    stats["output_size"] = int(size_mb * 1024 * 1024)
+    if size_mb > TELEGRAM_MAX_UPLOAD_MB and SPLIT_OVERSIZED and action != "audio":
+        if progress is not None:
+            await _edit_status(progress.message, "✂️ El video excede el límite de Telegram: dividiéndolo en partes...")
+        item.parts = await _split_into_parts(send_path, workdir, _batch_caption(item, total), chat_id, action, stats)
+        if item.parts:
+            # Only the parts are uploaded
+            item.remove_files()
+            return
+    if size_mb > TELEGRAM_MAX_UPLOAD_MB:
+        stats["outcome"] = "file_too_large"
+        item.error = f"pesa {size_mb:.2f} MB y excede el límite de envío (≈{TELEGRAM_MAX_UPLOAD_MB:.0f} MB)"
+        item.remove_files()
+        return
+    item.send_path = send_path
+
+async def _prepare_batch_item(username: str | None, item: _MediaItem, total: int, use_file_id: bool = True) -> None:
+    """``_prepare_item`` for one video of a batch; a failure is kept on the item for the summary."""
+    try:
+        await _prepare_item(item, total, use_file_id=use_file_id)
+    except Exception as e:
+        item.stats["outcome"] = "error"
+        item.stats["error"] = str(e)[:500]
+        item.error = _batch_failure_text(str(e))
+        item.remove_files()
+        logger.warning(
+            "action_failed chat_id=%s username=%s action=%s batch_item=%s failure=%s error=%s",
+            item.stats["chat_id"],
+            username,
+            item.stats["action"],
+            item.index,
+            classify_failure(str(e)),
+            str(e),
+        )
+
+def _media_input(path: Path) -> Path | InputFile:
+    """``media`` of an InputMedia for a file on disk.
+
+    InputMedia always turns a path into a local-mode file:// URI, so outside
+    local mode the file is read here (as send_video does with a Path).
+    """
+    if TELEGRAM_LOCAL_MODE:
+        return path
+    with path.open("rb") as f:
+        return InputFile(f, filename=path.name, attach=True)
+
+def _batch_caption(item: _MediaItem, total: int) -> str:
+    if item.caption:
+        return item.caption
+    if item.saved_name:
+        return f"📹 Video guardado como:\n`{item.saved_name}`"
+    text = "🎵 Audio descargado" if item.stats["action"] == "audio" else "📹 Video descargado"
+    return f"{text} ({item.index}/{total})" if total > 1 else text
+
+async def _deliver_batch(bot: Bot, chat_id: int, action: str, group: list[_MediaItem], total: int) -> None:
+    """Upload ready items in order: as one media group, or one by one if that's rejected.
+
+    An item whose cached file_id Telegram rejects is marked ``stale`` (and the
+    file_id forgotten) so the caller can prepare it again without the cache.
+    """
+    profile_key = telegram_profile_key(TELEGRAM_MAX_UPLOAD_MB, _action_profile(action))
+    audio = action == "audio"
+    sent: list[Message | None] = [None] * len(group)
+    try:
+        stage_started = time.monotonic()
+        album = False
+        if len(group) > 1:
+            # An album holds either videos or audios, never both
+            media = [
+                InputMediaAudio(
+                    media=item.file_id or _media_input(item.send_path),
+                    caption=_batch_caption(item, total),
+                    title=item.title,
+                    duration=item.duration,
                 )
-                await message.edit_text(
-                    f"✅ Video guardado como:\n`{video_path.name}`\n\n"
-                    f"⚠️ No se pudo reenviar: pesa {size_mb:.2f} MB y excede el límite de Telegram (≈{TELEGRAM_MAX_UPLOAD_MB:.0f} MB)."
+                if audio
+                else InputMediaVideo(
+                    media=item.file_id or _media_input(item.send_path),
+                    caption=_batch_caption(item, total),
+                    supports_streaming=True,
                 )
-                return
+                for item in group
+            ]
+            try:
+                sent = list(await bot.send_media_group(chat_id=chat_id, media=media))
+                album = True
+            except BadRequest as e:
+                # A stale file_id or an oversized request fails the whole album
+                logger.info("media_group_rejected chat_id=%s items=%s error=%s", chat_id, len(group), str(e))
+        if album:
+            upload_seconds = (time.monotonic() - stage_started) / len(group)
+            for item in group:
+                item.sent = True
+                item.stats["upload_seconds"] = upload_seconds
+            return
 
+        for n, item in enumerate(group):
+            stage_started = time.monotonic()
             try:
-                await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=video_path,
-                    caption=f"📹 Video guardado como:\n`{video_path.name}`"
+                sent[n] = await _send_media(
+                    bot, chat_id, item.file_id or item.send_path, _batch_caption(item, total), audio, item.title, item.duration
                 )
+                # Set right away: a later item's error may abort the loop
+                item.sent = True
             except BadRequest as e:
-                if "Request Entity Too Large" in str(e):
-                    logger.warning(
-                        "action_failed chat_id=%s username=%s action=%s error=telegram_413 size_mb=%.2f file=%s",
-                        chat_id,
-                        username,
-                        action,
-                        size_mb,
-                        video_path.name,
-                    )
-                    await message.edit_text(
-                        f"✅ Video guardado como:\n`{video_path.name}`\n\n"
-                        "⚠️ Telegram rechazó el envío por tamaño (413)."
-                    )
-                    return
-                raise
-            await message.edit_text(
-                f"✅ Video guardado y enviado exitosamente como:\n"
-                f"`{video_path.name}`"
-            )
-            logger.info(
-                "action_success chat_id=%s username=%s action=%s result=saved_and_sent file=%s",
-                chat_id,
-                username,
-                action,
-                video_path.name,
-            )
-            
+                if item.file_id:
+                    for extractor, video_id in item.identities:
+                        logger.info("file_id_cache_stale extractor=%s video_id=%s error=%s", extractor, video_id, str(e))
+                        await forget_file_id(extractor, video_id, profile_key)
+                    item.file_id = None
+                    item.stale = True
+                elif "Request Entity Too Large" in str(e):
+                    item.stats["outcome"] = "telegram_413"
+                    item.error = "Telegram rechazó el envío por tamaño (413)"
+                else:
+                    item.stats["outcome"] = "error"
+                    item.stats["error"] = str(e)[:500]
+                    item.error = "Telegram rechazó el envío"
+            item.stats["upload_seconds"] = time.monotonic() - stage_started
+    finally:
+        for item, message in zip(group, sent):
+            if item.sent:
+                outcome = "saved_and_sent" if action == "save_and_send" else "sent"
+                if item.file_id:
+                    CACHE_HITS.inc(cache="file_id")
+                    outcome += "_cached"
+                else:
+                    await _remember_sent_video(message, item.identities, profile_key)
+                item.stats["outcome"] = outcome
+            item.remove_files()
+
+class _AlbumPacker:
+    """Sends ready items in order, packed into media groups.
+
+    A group is sent once it holds 10 items or, unless TELEGRAM_LOCAL_MODE passes
+    files by path, once the next upload would push the request past
+    TELEGRAM_MAX_UPLOAD_MB (the request size the Bot API accepts).
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, action: str, total: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.action = action
+        self.total = total
+        self._group: list[_MediaItem] = []
+        self._bytes = 0
+
+    async def add(self, item: _MediaItem) -> None:
+        size = item.upload_bytes
+        too_big = not TELEGRAM_LOCAL_MODE and self._bytes + size > TELEGRAM_MAX_UPLOAD_MB * 1024 * 1024
+        if self._group and (len(self._group) >= _MEDIA_GROUP_SIZE or too_big):
+            await self.flush()
+        self._group.append(item)
+        self._bytes += size
+
+    async def flush(self) -> None:
+        if self._group:
+            group, self._group, self._bytes = self._group, [], 0
+            await _deliver_batch(self.bot, self.chat_id, self.action, group, self.total)
+
+async def _split_into_parts(
+    path: Path, output_dir: Path, caption: str, chat_id: int, action: str, stats: dict
+) -> list[_MediaItem]:
+    """Items for the parts of an oversized video (written to ``output_dir``), or [] if it can't be split."""
+    try:
+        if not await asyncio.to_thread(storage.ensure_room, output_dir, path.stat().st_size):
+            return []
+    except OSError:
+        return []
+    stage_started = time.monotonic()
+    ok, split_msg, paths = await split_for_upload(path, TELEGRAM_MAX_UPLOAD_MB, output_dir)
+    if not ok or len(paths) < 2:
+        logger.warning("split_failed file=%s error=%s", path.name, split_msg[:200])
+        return []
+    stats["transcode_seconds"] = (stats.get("transcode_seconds") or 0) + time.monotonic() - stage_started
+    parts = []
+    for index, part_path in enumerate(paths, 1):
+        part = _MediaItem(index, "", chat_id, action)
+        # Parts report into the video's own stats
+        part.stats = stats
+        part.send_path = part_path
+        part.cleanup = [part_path]
+        part.caption = f"{caption} (parte {index}/{len(paths)})"
+        parts.append(part)
+    return parts
+
+def _settle_parts(item: _MediaItem) -> list[int]:
+    """Outcome of an item sent as its parts; returns the numbers of the parts delivered."""
+    sent = [part.index for part in item.parts if part.sent]
+    if len(sent) == len(item.parts):
+        item.stats["outcome"] = ("saved_and_sent" if item.stats["action"] == "save_and_send" else "sent") + "_split"
+        return sent
+    failed_part = next((part for part in item.parts if part.error), None)
+    item.error = failed_part.error if failed_part is not None else "no se pudo enviar"
+    if sent:
+        item.error += f" (llegaron las partes {', '.join(map(str, sent))} de {len(item.parts)})"
+    item.stats["outcome"] = "error"
+    item.stats["error"] = f"split_send_failed sent={len(sent)}/{len(item.parts)}"
+    return sent
+
+async def _send_in_parts(bot: Bot, chat_id: int, action: str, item: _MediaItem, message: Message) -> tuple[list[int], int]:
+    """Send the parts of a split item as an ordered album.
+
+    Returns (numbers of the parts delivered, number of parts). An upload error
+    stops the remaining parts.
+    """
+    parts = item.parts
+    try:
+        await message.edit_text(f"📤 Enviando video en {len(parts)} partes...")
+        packer = _AlbumPacker(bot, chat_id, action, len(parts))
+        stage_started = time.monotonic()
+        for part in parts:
+            await packer.add(part)
+        await packer.flush()
+        item.stats["upload_seconds"] = time.monotonic() - stage_started
+    except TelegramError as e:
+        logger.warning("split_send_interrupted chat_id=%s error=%s", chat_id, str(e)[:200])
+    finally:
+        for part in parts:
+            part.remove_files()
+    sent = _settle_parts(item)
+    if len(sent) < len(parts):
+        logger.warning("split_send_failed chat_id=%s parts=%s sent=%s", chat_id, len(parts), len(sent))
+    return sent, len(parts)
+
+def _unsent_parts_text(sent: list[int], total: int) -> str:
+    """Tell the user which parts of a split video arrived when some didn't."""
+    if not sent:
+        return f"⚠️ No se pudo enviar ninguna de las {total} partes del video."
+    return (
+        f"⚠️ Solo se enviaron las partes {', '.join(map(str, sent))} de {total}; "
+        "las demás fallaron. Envía el enlace de nuevo para recibirlo completo."
+    )
+
+async def process_batch_job(
+    bot: Bot,
+    chat_id: int,
+    username: str | None,
+    action: str,
+    entries: list[tuple[str, int | None]],
+    message: Message,
+) -> str:
+    """Fetch several videos, BATCH_CONCURRENCY at a time, and deliver them in order.
+
+    ``entries`` are (url, playlist index) pairs as returned by ``expand_url``.
+    Videos to send go out as media groups (see ``_AlbumPacker``), each as soon
+    as all of its videos are ready; with SPLIT_OVERSIZED a video over the
+    upload limit is sent as its parts.
+    """
+    total = len(entries)
+    items = [
+        _MediaItem(index, url, chat_id, action, playlist_item)
+        for index, (url, playlist_item) in enumerate(entries, 1)
+    ]
+    progress = ProgressMessage(message)
+    slots = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+    done = 0
+
+    async def prepare(item: _MediaItem) -> None:
+        nonlocal done
+        async with slots:
+            try:
+                await _prepare_batch_item(username, item, total)
+            finally:
+                done += 1
+                progress.update(done / total, None)
+
+    async def deliver(packer: _AlbumPacker, item: _MediaItem) -> None:
+        if action == "save":
+            return
+        for part in item.parts or [item]:
+            if part.sendable:
+                await packer.add(part)
+
+    async def run() -> None:
+        packer = _AlbumPacker(bot, chat_id, action, total)
+        for item, task in zip(items, tasks):
+            await task
+            await deliver(packer, item)
+        await packer.flush()
+        # Telegram no longer has these cached uploads: fetch and upload them again
+        for item in items:
+            if item.stale:
+                item.stale = False
+                await _prepare_batch_item(username, item, total, use_file_id=False)
+                await deliver(packer, item)
+        await packer.flush()
+        for item in items:
+            if item.parts:
+                _settle_parts(item)
+
+    logger.info("batch_started chat_id=%s action=%s items=%s concurrency=%s", chat_id, action, total, BATCH_CONCURRENCY)
+    tasks = [asyncio.create_task(prepare(item)) for item in items]
+    noun = "audios" if action == "audio" else "videos"
+    heading = f"⬇️ Procesando {total} {noun}..."
+    try:
+        await message.edit_text(heading)
+        await progress.run(heading, run())
     except Exception as e:
-        logger.warning(
-            "action_failed chat_id=%s username=%s action=%s error=%s",
-            query.message.chat_id,
-            update.effective_user.username if update.effective_user else None,
-            query.data,
-            str(e),
-        )
-        await message.edit_text(
-            "❌ Lo siento, ocurrió un error al procesar el video. "
-            "Por favor, verifica que el enlace sea válido."
-        )
+        logger.warning(f"Batch delivery failed: {e}")
+        # Whatever wasn't delivered yet is lost
+        for item in items:
+            if item.error is None and item.stats["outcome"] == "error":
+                item.stats["error"] = str(e)[:500]
+                item.error = _batch_failure_text(str(e))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for item in items:
+            item.close()
+            await _record_job_stats(item.stats, item.started_at, item.started)
+
+    failed = [item for item in items if item.error]
+    ok = total - len(failed)
+    logger.info("batch_finished chat_id=%s action=%s items=%s failed=%s", chat_id, action, total, len(failed))
+
+    if action in _SEND_ACTIONS and not failed:
+        await message.delete()
+        return "sent"
+    verb = "guardados" if action == "save" else "guardados y enviados" if action == "save_and_send" else "enviados"
+    lines = [f"✅ {ok} de {total} {noun} {verb}."]
+    if action == "save":
+        lines += [f"{item.index}. `{item.saved_name}`" for item in items if item.saved_name and not item.error]
+    lines += [f"⚠️ {item.index}. {item.error}" for item in failed]
+    text = "\n".join(lines)
+    await message.edit_text(text if len(text) <= 4096 else text[:4093] + "...")
+    return "error" if not ok else "batch"
+
+async def _download_cache_maintenance() -> None:
+    """Periodically drop index entries whose files were deleted or replaced."""
+    while True:
+        try:
+            removed = await prune_download_cache()
+            if removed:
+                logger.info("download_cache_pruned removed=%s", removed)
+        except Exception as e:
+            logger.warning(f"Download cache cleanup failed: {e}")
+        await asyncio.sleep(DOWNLOAD_CACHE_PRUNE_MINUTES * 60)
+
+async def _storage_maintenance() -> None:
+    """Periodically remove orphaned temp files and enforce the directory budgets."""
+    try:
+        await asyncio.to_thread(storage.refresh)
+    except Exception as e:
+        logger.warning(f"Storage index initialization failed: {e}")
+    while True:
+        try:
+            # Workers index files too: reload the indexed paths before each sweep
+            storage.seed_access_times(await get_download_access_times())
+            removed, freed = await asyncio.to_thread(storage.sweep)
+            if removed:
+                logger.info("storage_sweep removed=%s freed_mb=%.1f", removed, freed / (1024 * 1024))
+        except Exception as e:
+            logger.warning(f"Storage sweep failed: {e}")
+        await asyncio.sleep(STORAGE_SWEEP_MINUTES * 60)
+
+async def _start_receiving_updates(application: Application) -> None:
+    """Start long polling or the webhook listener according to UPDATE_MODE."""
+    if UPDATE_MODE != "webhook":
+        application.create_task(application.updater.start_polling(drop_pending_updates=DROP_PENDING_UPDATES))
+        return
+
+    if not WEBHOOK_URL:
+        raise ValueError("UPDATE_MODE=webhook requires WEBHOOK_URL")
+    url_path = WEBHOOK_PATH or urlparse(WEBHOOK_URL).path
+    secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    await application.updater.start_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=url_path.strip("/"),
+        webhook_url=WEBHOOK_URL,
+        secret_token=secret_token,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    logger.info(
+        "webhook_listening listen=%s port=%s path=/%s drop_pending_updates=%s",
+        WEBHOOK_LISTEN,
+        WEBHOOK_PORT,
+        url_path.strip("/"),
+        DROP_PENDING_UPDATES,
+    )
 
-async def shutdown(application: Application) -> None:
-    """Shutdown the bot gracefully."""
+async def shutdown(application: Application, metrics_server: MetricsServer | None = None) -> None:
+    """Shutdown the bot gracefully.
+
+    Intake stops first so no update arrives mid-drain; the queued jobs are
+    then drained while the bot and database are still usable, and the
+    database (with its buffered event writes) is closed last.
+    """
     logger.info("Shutting down...")
     try:
-        if application.running:
+        was_running = application.running
+        if application.updater is not None and application.updater.running:
             await application.updater.stop()
+        if was_running:
             await application.stop()
+        for task in _background_tasks | _prefetch_tasks:
+            task.cancel()
+        await job_scheduler.stop()
+        shutdown_download_engine()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        if was_running:
             await application.shutdown()
     except Exception as e:
         logger.error(f"Error during shutdown: {e}")
+    try:
+        await close_db()
+    except Exception as e:
+        logger.error(f"Error closing database: {e}")
 
 async def main() -> None:
     """Start the bot."""
     if not TOKEN:
         logger.error("No bot token provided!")
         return
+    if TELEGRAM_LOCAL_MODE and not TELEGRAM_API_BASE_URL:
+        logger.error("TELEGRAM_LOCAL_MODE needs TELEGRAM_API_BASE_URL (the local Bot API server)")
+        return
 
     # Initialize the database
     await init_db()
+    event_writer.start()
         
     # Initialize Application
-    application = Application.builder().token(TOKEN).build()
+    # Updates are handled concurrently; long-running work goes through job_scheduler
+    builder = Application.builder().token(TOKEN).concurrent_updates(True)
+    for option, value in telegram_api_options().items():
+        builder = getattr(builder, option)(value)
+    application = builder.build()
+    logger.info(
+        "telegram_api base_url=%s local_mode=%s max_upload_mb=%.0f",
+        TELEGRAM_API_BASE_URL or "default",
+        TELEGRAM_LOCAL_MODE,
+        TELEGRAM_MAX_UPLOAD_MB,
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("events", events_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(
         MessageHandler(
-            filters.TEXT & ~filters.COMMAND & filters.Entity("url"),
+            filters.TEXT & ~filters.COMMAND & (filters.Entity("url") | filters.Entity("text_link")),
             handle_url
         )
     )
     application.add_handler(CallbackQueryHandler(button_callback))
 
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
     try:
         # Start the bot
         logger.info("Starting bot...")
@@ -503,8 +1837,12 @@ async def main() -> None:
         for sig in (signal.SIGINT, signal.SIGTERM):
             asyncio.get_running_loop().add_signal_handler(sig, signal_handler)
         
-        # Start polling in background
-        application.create_task(application.updater.start_polling(drop_pending_updates=True))
+        _background_tasks.add(asyncio.create_task(_download_cache_maintenance()))
+        _background_tasks.add(asyncio.create_task(_storage_maintenance()))
+        if metrics_server is not None:
+            await metrics_server.start()
+
+        await _start_receiving_updates(application)
         
         # Wait for stop signal
         try:
@@ -513,11 +1851,11 @@ async def main() -> None:
             # Remove signal handlers and shutdown
             for sig in (signal.SIGINT, signal.SIGTERM):
                 asyncio.get_running_loop().remove_signal_handler(sig)
-            await shutdown(application)
+            await shutdown(application, metrics_server)
             
     except Exception as e:
         logger.error(f"Error running bot: {e}")
-        await shutdown(application)
+        await shutdown(application, metrics_server)
 
 if __name__ == "__main__":
     try:
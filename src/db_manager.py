@@ -1,13 +1,15 @@
+import asyncio
 import logging
 import os
+import time
 from pathlib import Path
 from dotenv import load_dotenv
-from sqlalchemy import select
+from sqlalchemy import select, delete, insert, func, case
 from sqlalchemy.ext.asyncio import AsyncSession
-from datetime import datetime
+from datetime import datetime, timezone
 
 from models import (
-    Database, AuthorizedUser, UnauthorizedEvent,
+    Database, AuthorizedUser, UnauthorizedEvent, SentVideo, CachedDownload, Job,
     UserCreate, User, Event, EventBase,
     sanitize_text, sanitize_command
 )
@@ -27,7 +29,97 @@ DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 # Database URL
 DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
 
-db = Database(DB_PATH)
+# SQLite engine profile (see models.Database)
+DB_TUNING = os.getenv('DB_TUNING', '1').lower() not in {'0', 'false', 'no'}
+DB_JOURNAL_MODE = os.getenv('DB_JOURNAL_MODE', '')
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))
+
+# WAL keeps its index in shared memory, which network filesystems don't share
+# between hosts: there it can corrupt the database instead of just being slow
+_NETWORK_FILESYSTEMS = {
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs',
+    'fuse.glusterfs', 'fuse.sshfs', 'fuse.rclone', 'lustre', 'virtiofs',
+}
+
+def _filesystem_type(path: Path) -> str | None:
+    """Type of the filesystem holding ``path``, from /proc/mounts (None if unknown)."""
+    try:
+        with open('/proc/mounts') as mounts:
+            entries = [line.split() for line in mounts]
+    except OSError:
+        return None
+    target = str(path)
+    best, fstype = '', None
+    for fields in entries:
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1].replace('\\040', ' ')
+        inside = target == mount_point or target.startswith(mount_point.rstrip('/') + '/')
+        if inside and len(mount_point) >= len(best):
+            best, fstype = mount_point, fields[2]
+    return fstype
+
+def _journal_mode(requested: str, path: Path) -> str:
+    """Journal mode for the database at ``path``.
+
+    An explicit DB_JOURNAL_MODE is used as given (with a warning for WAL on a
+    network filesystem); otherwise WAL on local disks and DELETE elsewhere.
+    """
+    fstype = _filesystem_type(path)
+    remote = fstype in _NETWORK_FILESYSTEMS
+    if requested:
+        if requested.upper() == 'WAL' and remote:
+            logger.warning(
+                "db_journal_mode_unsafe mode=WAL filesystem=%s path=%s (use DB_JOURNAL_MODE=DELETE)",
+                fstype, path,
+            )
+        return requested
+    if remote:
+        logger.info("db_journal_mode mode=DELETE filesystem=%s path=%s", fstype, path)
+        return 'DELETE'
+    return 'WAL'
+
+db = Database(
+    DB_PATH,
+    tuned=DB_TUNING,
+    journal_mode=_journal_mode(DB_JOURNAL_MODE, DB_PATH.parent),
+    busy_timeout_ms=DB_BUSY_TIMEOUT_MS,
+    read_pool_size=DB_READ_POOL_SIZE,
+)
+
+# Authorization cache: the full authorized/super-admin sets live in memory so the
+# per-update check is a set lookup. Writes through add_authorized_user keep it in
+# sync; AUTH_CACHE_TTL (seconds, 0 = never) reloads it for multi-process setups
+# where another process may have changed the table.
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '0'))
+
+_authorized_ids: set[int] = set()
+_super_admin_ids: set[int] = set()
+_auth_cache_loaded_at: float | None = None
+_auth_cache_lock = asyncio.Lock()
+
+async def _load_auth_cache():
+    global _authorized_ids, _super_admin_ids, _auth_cache_loaded_at
+    async with db.read_session() as session:
+        result = await session.execute(select(AuthorizedUser.chat_id, AuthorizedUser.is_super_admin))
+        rows = result.all()
+    _authorized_ids = {chat_id for chat_id, _ in rows}
+    _super_admin_ids = {chat_id for chat_id, is_super in rows if is_super}
+    _auth_cache_loaded_at = time.monotonic()
+
+async def _ensure_auth_cache():
+    """Load the cache on first use and reload it once the TTL has expired."""
+    def is_fresh() -> bool:
+        if _auth_cache_loaded_at is None:
+            return False
+        return not AUTH_CACHE_TTL or time.monotonic() - _auth_cache_loaded_at < AUTH_CACHE_TTL
+
+    if is_fresh():
+        return
+    async with _auth_cache_lock:
+        if not is_fresh():
+            await _load_auth_cache()
 
 async def init_db():
     """Initialize the database and create tables."""
@@ -47,23 +139,18 @@ async def init_db():
                 )
                 session.add(super_admin)
                 await session.commit()
+    
+    await _load_auth_cache()
 
 async def is_user_authorized(chat_id: int) -> bool:
     """Check if a user is authorized to use the bot."""
-    async with db.session() as session:
-        stmt = select(AuthorizedUser).where(AuthorizedUser.chat_id == chat_id)
-        result = await session.execute(stmt)
-        return result.scalar() is not None
+    await _ensure_auth_cache()
+    return chat_id in _authorized_ids
 
 async def is_super_admin(chat_id: int) -> bool:
     """Check if a user is a super admin."""
-    async with db.session() as session:
-        stmt = select(AuthorizedUser).where(
-            AuthorizedUser.chat_id == chat_id,
-            AuthorizedUser.is_super_admin == True
-        )
-        result = await session.execute(stmt)
-        return result.scalar() is not None
+    await _ensure_auth_cache()
+    return chat_id in _super_admin_ids
 
 async def add_authorized_user(chat_id: int, username: str = None, is_super_admin: bool = False):
     """Add a new authorized user to the database."""
@@ -90,31 +177,336 @@ async def add_authorized_user(chat_id: int, username: str = None, is_super_admin
             session.add(user)
         
         await session.commit()
+    
+    # Write through to the in-memory cache
+    _authorized_ids.add(user_data.chat_id)
+    if user_data.is_super_admin:
+        _super_admin_ids.add(user_data.chat_id)
+    else:
+        _super_admin_ids.discard(user_data.chat_id)
+
+class UnauthorizedEventWriter:
+    """Write-behind buffer for unauthorized attempts.
+
+    Attempts are collected in memory, identical ones (same chat, username and
+    command) are collapsed into a single row with an ``attempts`` count, and the
+    buffer is written with one bulk INSERT when it reaches ``max_rows`` distinct
+    rows or every ``interval`` seconds, so a spammer can't turn every message
+    into its own SQLite transaction.
+    """
+
+    def __init__(self, max_rows: int = 100, interval: float = 5.0):
+        self.max_rows = max(1, max_rows)
+        self.interval = interval
+        self._pending: dict[tuple[int, str | None, str], list] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._flush_task: asyncio.Task | None = None
+
+    def add(self, chat_id: int, username: str | None, command: str):
+        key = (chat_id, username, command)
+        entry = self._pending.get(key)
+        now = datetime.utcnow()
+        if entry:
+            entry[0] += 1
+            entry[1] = now
+        else:
+            self._pending[key] = [1, now]
+        
+        if len(self._pending) >= self.max_rows and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Write everything buffered so far in a single transaction."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            
+            rows = []
+            for (chat_id, username, command), (attempts, last_seen) in pending.items():
+                # Validate and sanitize input (once per distinct attempt)
+                event_data = EventBase(
+                    chat_id=chat_id,
+                    username=sanitize_text(username) if username else None,
+                    command=sanitize_command(command)
+                )
+                rows.append({**event_data.dict(), 'attempts': attempts, 'timestamp': last_seen})
+            
+            try:
+                async with db.session() as session:
+                    await session.execute(insert(UnauthorizedEvent), rows)
+                    await session.commit()
+            except Exception as e:
+                logger.error(f"Could not write {len(rows)} unauthorized events: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the periodic flush and write whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+event_writer = UnauthorizedEventWriter(
+    max_rows=int(os.getenv('UNAUTHORIZED_FLUSH_ROWS', '100')),
+    interval=float(os.getenv('UNAUTHORIZED_FLUSH_SECONDS', '5')),
+)
 
 async def log_unauthorized_attempt(chat_id: int, username: str | None, command: str):
-    """Log an unauthorized attempt to use the bot."""
-    # Validate and sanitize input
-    event_data = EventBase(
-        chat_id=chat_id,
-        username=sanitize_text(username) if username else None,
-        command=sanitize_command(command)
-    )
-    
-    async with db.session() as session:
-        event = UnauthorizedEvent(**event_data.dict())
-        session.add(event)
-        await session.commit()
+    """Log an unauthorized attempt to use the bot (buffered, see UnauthorizedEventWriter)."""
+    event_writer.add(chat_id, username, command)
 
 async def get_user_count() -> int:
     """Get the total number of authorized users."""
-    async with db.session() as session:
-        result = await session.execute(select(AuthorizedUser))
-        return len(result.scalars().all())
+    async with db.read_session() as session:
+        result = await session.execute(select(func.count()).select_from(AuthorizedUser))
+        return result.scalar() or 0
 
 async def get_unauthorized_events(limit: int = 100) -> list[Event]:
     """Get recent unauthorized access attempts."""
-    async with db.session() as session:
+    await event_writer.flush()
+    async with db.read_session() as session:
         stmt = select(UnauthorizedEvent).order_by(UnauthorizedEvent.timestamp.desc()).limit(limit)
         result = await session.execute(stmt)
         events = result.scalars().all()
-        return [Event.from_orm(event) for event in events]
\ No newline at end of file
+        return [Event.from_orm(event) for event in events]
+
+async def get_cached_file_id(extractor: str, video_id: str, profile: str) -> str | None:
+    """Get the Telegram file_id of a previously sent video, if any."""
+    async with db.read_session() as session:
+        stmt = select(SentVideo.file_id).where(
+            SentVideo.extractor == extractor,
+            SentVideo.video_id == video_id,
+            SentVideo.profile == profile
+        )
+        result = await session.execute(stmt)
+        return result.scalar()
+
+async def cache_file_id(
+    extractor: str,
+    video_id: str,
+    profile: str,
+    file_id: str,
+    file_unique_id: str | None = None,
+    file_size: int | None = None
+):
+    """Remember the Telegram file_id of a sent video (insert or update)."""
+    async with db.session() as session:
+        stmt = select(SentVideo).where(
+            SentVideo.extractor == extractor,
+            SentVideo.video_id == video_id,
+            SentVideo.profile == profile
+        )
+        result = await session.execute(stmt)
+        sent = result.scalar()
+        
+        if sent:
+            sent.file_id = file_id
+            sent.file_unique_id = file_unique_id
+            sent.file_size = file_size
+            sent.created_at = datetime.utcnow()
+        else:
+            session.add(SentVideo(
+                extractor=extractor,
+                video_id=video_id,
+                profile=profile,
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+                file_size=file_size
+            ))
+        
+        await session.commit()
+
+async def forget_file_id(extractor: str, video_id: str, profile: str):
+    """Drop a cached file_id that Telegram no longer accepts."""
+    async with db.session() as session:
+        await session.execute(delete(SentVideo).where(
+            SentVideo.extractor == extractor,
+            SentVideo.video_id == video_id,
+            SentVideo.profile == profile
+        ))
+        await session.commit()
+
+async def get_cached_download(extractor: str, video_id: str, profiles: list[str]) -> CachedDownload | None:
+    """Get the cached file for a video, trying ``profiles`` in order of preference."""
+    async with db.read_session() as session:
+        stmt = select(CachedDownload).where(
+            CachedDownload.extractor == extractor,
+            CachedDownload.video_id == video_id,
+            CachedDownload.profile.in_(profiles)
+        )
+        result = await session.execute(stmt)
+        entries = {entry.profile: entry for entry in result.scalars().all()}
+        for profile in profiles:
+            if profile in entries:
+                return entries[profile]
+        return None
+
+async def record_download(extractor: str, video_id: str, profile: str, path: str, file_size: int):
+    """Index a downloaded file (insert or update) and mark it as just used."""
+    async with db.session() as session:
+        stmt = select(CachedDownload).where(
+            CachedDownload.extractor == extractor,
+            CachedDownload.video_id == video_id,
+            CachedDownload.profile == profile
+        )
+        result = await session.execute(stmt)
+        entry = result.scalar()
+        now = datetime.utcnow()
+        
+        if entry:
+            entry.path = path
+            entry.file_size = file_size
+            entry.last_used_at = now
+        else:
+            session.add(CachedDownload(
+                extractor=extractor,
+                video_id=video_id,
+                profile=profile,
+                path=path,
+                file_size=file_size,
+                created_at=now,
+                last_used_at=now
+            ))
+        
+        await session.commit()
+
+async def forget_download(entry_id: int):
+    """Remove a cache entry whose file is gone or no longer matches."""
+    async with db.session() as session:
+        await session.execute(delete(CachedDownload).where(CachedDownload.id == entry_id))
+        await session.commit()
+
+def _stale_downloads(rows) -> list:
+    """The (id, path, file_size) rows whose file is missing or changed size."""
+    stale = []
+    for entry_id, path, file_size in rows:
+        try:
+            if Path(path).stat().st_size != file_size:
+                stale.append((entry_id, path, file_size))
+        except OSError:
+            stale.append((entry_id, path, file_size))
+    return stale
+
+async def prune_download_cache() -> int:
+    """Drop cache entries whose file is missing or changed size. Returns how many were removed.
+
+    The files are checked off the event loop and outside any write transaction,
+    so a slow volume doesn't hold up the single writer connection.
+    """
+    async with db.read_session() as session:
+        result = await session.execute(select(CachedDownload.id, CachedDownload.path, CachedDownload.file_size))
+        rows = result.all()
+    stale = await asyncio.to_thread(_stale_downloads, rows)
+    if not stale:
+        return 0
+
+    removed = 0
+    async with db.session() as session:
+        for entry_id, path, file_size in stale:
+            # Skip entries re-recorded since they were read
+            result = await session.execute(
+                delete(CachedDownload).where(
+                    CachedDownload.id == entry_id,
+                    CachedDownload.path == path,
+                    CachedDownload.file_size == file_size,
+                )
+            )
+            removed += result.rowcount
+        await session.commit()
+    return removed
+
+async def get_download_access_times() -> dict[str, float]:
+    """Last use (epoch seconds) of every indexed download, keyed by path."""
+    async with db.read_session() as session:
+        result = await session.execute(
+            select(CachedDownload.path, func.max(CachedDownload.last_used_at)).group_by(CachedDownload.path)
+        )
+        return {
+            path: last_used.replace(tzinfo=timezone.utc).timestamp()
+            for path, last_used in result.all()
+            if last_used is not None
+        }
+
+# Job outcomes that count as failures in /stats
+JOB_FAILURE_OUTCOMES = ('error', 'file_too_large', 'telegram_413', 'disk_full')
+JOB_STAGE_COLUMNS = ('download_seconds', 'transcode_seconds', 'upload_seconds', 'total_seconds')
+
+async def record_job(**fields):
+    """Store one processed request (see models.Job for the available fields)."""
+    async with db.session() as session:
+        session.add(Job(**fields))
+        await session.commit()
+
+async def _percentiles(session, column, since: datetime, quantiles: tuple[float, ...]) -> list[float | None]:
+    """Nearest-rank percentiles of ``column`` over jobs since ``since``.
+
+    SQLite has no percentile aggregate: count the rows first, then read each rank
+    with ORDER BY ... LIMIT 1 OFFSET n over the created_at index range.
+    """
+    window = (Job.created_at >= since, column.isnot(None))
+    count = (await session.execute(select(func.count()).select_from(Job).where(*window))).scalar() or 0
+    if not count:
+        return [None for _ in quantiles]
+    
+    values = []
+    for quantile in quantiles:
+        offset = min(count - 1, int(round(quantile * (count - 1))))
+        stmt = select(column).where(*window).order_by(column).limit(1).offset(offset)
+        values.append((await session.execute(stmt)).scalar())
+    return values
+
+async def get_job_stats(since: datetime) -> dict:
+    """Aggregate job history since ``since``: outcomes, volume and p50/p95 stage latencies."""
+    async with db.read_session() as session:
+        stmt = (
+            select(
+                Job.outcome,
+                func.count(),
+                func.coalesce(func.sum(Job.bytes_downloaded), 0),
+                func.coalesce(func.sum(Job.output_size), 0),
+                func.count(Job.transcode_skipped),
+                func.sum(case((Job.transcode_skipped == True, 1), else_=0)),
+            )
+            .where(Job.created_at >= since)
+            .group_by(Job.outcome)
+        )
+        result = await session.execute(stmt)
+        
+        stats = {
+            'total': 0,
+            'failed': 0,
+            'bytes_downloaded': 0,
+            'output_bytes': 0,
+            'transcoded': 0,
+            'transcode_skipped': 0,
+            'outcomes': {},
+            'latency': {},
+        }
+        for outcome, count, downloaded, output, transcoded, skipped in result.all():
+            stats['outcomes'][outcome] = count
+            stats['total'] += count
+            if outcome in JOB_FAILURE_OUTCOMES:
+                stats['failed'] += count
+            stats['bytes_downloaded'] += downloaded
+            stats['output_bytes'] += output
+            stats['transcoded'] += transcoded
+            stats['transcode_skipped'] += skipped or 0
+        
+        for name in JOB_STAGE_COLUMNS:
+            stats['latency'][name] = await _percentiles(session, getattr(Job, name), since, (0.5, 0.95))
+        return stats
+
+async def close_db():
+    """Flush buffered writes and close pooled database connections."""
+    await event_writer.stop()
+    await db.close()
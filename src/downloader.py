@@ -1,19 +1,407 @@
+import os
+import glob
+import json
 import logging
 import asyncio
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
+from retry import HostCooldowns, TRANSIENT, backoff_delay, classify_failure, host_key, is_rate_limited
+from scheduler import TranscodePool
+
 logger = logging.getLogger(__name__)
 
 TRANSCODE_FOR_TELEGRAM = (str(__import__("os").getenv("TRANSCODE_FOR_TELEGRAM", "1")).lower() not in {"0", "false", "no"})
 FFMPEG_CRF = __import__("os").getenv("FFMPEG_CRF", "23")
 FFMPEG_PRESET = __import__("os").getenv("FFMPEG_PRESET", "veryfast")
 
-async def transcode_to_telegram_mp4(input_path: Path) -> Tuple[bool, str, Path]:
+# "api" drives yt_dlp.YoutubeDL in-process from a long-lived thread pool;
+# "cli" spawns the yt-dlp executable for every download (previous behaviour).
+YTDLP_ENGINE = os.getenv("YTDLP_ENGINE", "api").lower()
+YTDLP_WORKERS = int(os.getenv("YTDLP_WORKERS", "2"))
+
+# Format policy for videos that will be sent to Telegram (see _telegram_format_spec)
+TELEGRAM_MAX_HEIGHT = int(os.getenv("TELEGRAM_MAX_HEIGHT", "720"))
+
+BEST_FORMAT = 'bv*+ba/best'
+
+# "small" profile: low-bandwidth video for slow connections
+SMALL_VIDEO_HEIGHT = int(os.getenv("SMALL_VIDEO_HEIGHT", "360"))
+SMALL_VIDEO_MAX_KBPS = int(os.getenv("SMALL_VIDEO_MAX_KBPS", "800"))
+
+# Metadata fetched while the user picks an action is reused by the download
+# if it is younger than this (media URLs in it are signed and expire)
+PREFETCH_TTL_SECONDS = float(os.getenv("PREFETCH_TTL_SECONDS", "300"))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+
+_ytdlp_executor: Optional[ThreadPoolExecutor] = None
+_prefetch_executor: Optional[ThreadPoolExecutor] = None
+_ytdlp_local = threading.local()
+# url -> (monotonic time, unprocessed yt-dlp info), see prefetch_info
+_prefetched: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+_MAX_PREFETCHED = 256
+
+# yt-dlp runs (in-process or CLI) and ffmpeg processes currently in progress
+active_processes: Dict[str, int] = {"yt-dlp": 0, "ffmpeg": 0}
+
+@contextmanager
+def _track_process(kind: str):
+    active_processes[kind] += 1
+    try:
+        yield
+    finally:
+        active_processes[kind] -= 1
+
+# Progress callback: (fraction done 0..1, ETA in seconds or None). yt-dlp calls it
+# from its worker threads, so implementations should only record the value.
+ProgressCallback = Callable[[float, Optional[float]], None]
+
+# Subprocess output is read line by line; only this many lines are kept for errors
+OUTPUT_TAIL_LINES = 40
+_MAX_LINE_CHARS = 4096
+
+_YTDLP_PROGRESS_PREFIX = "[mbprogress]"
+_YTDLP_PROGRESS_TEMPLATE = (
+    "download:" + _YTDLP_PROGRESS_PREFIX +
+    " %(progress.downloaded_bytes)s %(progress.total_bytes,progress.total_bytes_estimate)s %(progress.eta)s"
+)
+_FFMPEG_PROGRESS_RE = re.compile(r"^out_time_(?:us|ms)=(\d+)$")
+# The other keys of a ``-progress`` block; any other line is real output
+_FFMPEG_PROGRESS_KEY_RE = re.compile(
+    r"^(?:frame|fps|stream_\d+_\d+_q|bitrate|total_size|out_time|dup_frames|drop_frames|speed|progress)=\S*$"
+)
+
+async def _run_streaming(
+    cmd: list,
+    on_line: Optional[Callable[[str], bool]] = None,
+    tail_lines: int = OUTPUT_TAIL_LINES,
+) -> Tuple[int, List[str], List[str]]:
+    """Run ``cmd`` reading stdout and stderr incrementally.
+
+    Every line (split on newlines and carriage returns) is offered to ``on_line``;
+    lines it doesn't consume (returns False) are kept in a bounded tail per stream.
+    Returns (returncode, stdout tail, stderr tail). The process is killed if the
+    caller is cancelled.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout_tail: deque = deque(maxlen=tail_lines)
+    stderr_tail: deque = deque(maxlen=tail_lines)
+
+    def handle(line: str, tail: deque) -> None:
+        line = line.strip()
+        if not line:
+            return
+        if on_line is not None and on_line(line):
+            return
+        tail.append(line[:_MAX_LINE_CHARS])
+
+    async def pump(stream: asyncio.StreamReader, tail: deque) -> None:
+        pending = ""
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            lines = re.split(r"[\r\n]", pending + chunk.decode(errors="ignore"))
+            pending = lines.pop()[-_MAX_LINE_CHARS:]
+            for line in lines:
+                handle(line, tail)
+        handle(pending, tail)
+
+    try:
+        await asyncio.gather(pump(process.stdout, stdout_tail), pump(process.stderr, stderr_tail))
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return returncode, list(stdout_tail), list(stderr_tail)
+
+def _ffmpeg_progress_parser(
+    duration: float, on_progress: ProgressCallback, offset: float = 0.0, scale: float = 1.0
+) -> Callable[[str], bool]:
+    """Consume ``-progress pipe:1`` lines, reporting offset + scale * (encoded / duration)."""
+    started = time.monotonic()
+
+    def on_line(line: str) -> bool:
+        match = _FFMPEG_PROGRESS_RE.match(line)
+        if match is None:
+            return _FFMPEG_PROGRESS_KEY_RE.match(line) is not None
+        if duration > 0:
+            fraction = min(1.0, int(match.group(1)) / 1_000_000 / duration)
+            elapsed = time.monotonic() - started
+            eta = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+            on_progress(offset + scale * fraction, eta)
+        return True
+
+    return on_line
+
+def _ytdlp_progress_line(on_progress: ProgressCallback) -> Callable[[str], bool]:
+    """Consume the lines printed by ``--progress-template`` (see _YTDLP_PROGRESS_TEMPLATE)."""
+    def on_line(line: str) -> bool:
+        if not line.startswith(_YTDLP_PROGRESS_PREFIX):
+            return False
+        try:
+            downloaded, total, eta = line[len(_YTDLP_PROGRESS_PREFIX):].split()
+            fraction = float(downloaded) / float(total) if total != "NA" else None
+            eta_seconds = float(eta) if eta != "NA" else None
+        except (ValueError, ZeroDivisionError):
+            return True
+        if fraction is not None:
+            on_progress(min(1.0, fraction), eta_seconds)
+        return True
+
+    return on_line
+
+def _ytdlp_cancel_hook(cancelled: threading.Event) -> Callable[[Dict[str, Any]], None]:
+    """Progress/postprocessor hook that stops the in-process download once
+    ``cancelled`` is set (yt-dlp lets hooks abort with DownloadCancelled)."""
+    def hook(status: Dict[str, Any]) -> None:
+        if cancelled.is_set():
+            from yt_dlp.utils import DownloadCancelled
+            raise DownloadCancelled()
+
+    return hook
+
+async def _communicate(process: asyncio.subprocess.Process) -> Tuple[bytes, bytes]:
+    """``process.communicate()`` that kills the process if the caller is cancelled."""
+    try:
+        return await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+def _ytdlp_progress_hook(on_progress: ProgressCallback) -> Callable[[Dict[str, Any]], None]:
+    """Same as _ytdlp_progress_line for the in-process engine's progress_hooks."""
+    def hook(status: Dict[str, Any]) -> None:
+        if status.get('status') != 'downloading':
+            return
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        if total:
+            on_progress(min(1.0, (status.get('downloaded_bytes') or 0) / total), status.get('eta'))
+
+    return hook
+
+# Probe the source first and only re-encode the streams Telegram can't play.
+SMART_TRANSCODE = (os.getenv("SMART_TRANSCODE", "1").lower() not in {"0", "false", "no"})
+
+_TELEGRAM_VIDEO_CODECS = {"h264"}
+_TELEGRAM_PIX_FMTS = {"yuv420p", "yuvj420p"}
+_TELEGRAM_AUDIO_CODECS = {"aac"}
+# sendAudio plays MP3 and M4A (AAC); anything else would arrive as a file
+_AUDIO_PASSTHROUGH = {("aac", ".m4a"), ("mp3", ".mp3")}
+
+# Size-targeted encoding: two-pass is slower but hits the budget more precisely
+# than the default capped-CRF single pass.
+FFMPEG_TWO_PASS = (os.getenv("FFMPEG_TWO_PASS", "0").lower() not in {"0", "false", "no"})
+
+# (minimum video kbps, output short side) used to downscale when the budget is tight
+_FIT_HEIGHT_LADDER = ((2500, 1080), (1200, 720), (600, 480), (0, 360))
+# Below these a size budget is not worth encoding for: the video is split or refused instead
+_MIN_VIDEO_KBPS = 100
+_MIN_AUDIO_KBPS = 32
+
+# Streaming mode: ffmpeg reads the media URLs resolved by yt-dlp directly, so the
+# encode overlaps the download and only the final file touches disk.
+STREAM_TRANSCODE = (os.getenv("STREAM_TRANSCODE", "0").lower() not in {"0", "false", "no"})
+_STREAMABLE_PROTOCOLS = {"http", "https", "m3u8", "m3u8_native"}
+
+# Transient download failures (429, resets, 5xx, extractor hiccups) are retried
+# with jittered exponential backoff; the .part file is resumed, not re-fetched.
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_RETRY_BASE_SECONDS = float(os.getenv("DOWNLOAD_RETRY_BASE_SECONDS", "5"))
+DOWNLOAD_RETRY_MAX_SECONDS = float(os.getenv("DOWNLOAD_RETRY_MAX_SECONDS", "120"))
+# After a rate limit (HTTP 429) every download from that host waits this long
+HOST_COOLDOWN_SECONDS = float(os.getenv("HOST_COOLDOWN_SECONDS", "60"))
+
+host_cooldowns = HostCooldowns()
+
+# CPU-bound encodes go through their own pool, sized from the available CPUs
+# (0 = auto) and independent of the download concurrency.
+transcode_pool = TranscodePool(
+    workers=int(os.getenv("TRANSCODE_WORKERS", "0")),
+    threads=int(os.getenv("FFMPEG_THREADS", "0")),
+    nice=int(os.getenv("FFMPEG_NICE", "0")),
+)
+
+async def probe_media(path: Path) -> Optional[Dict[str, Any]]:
+    """Return ffprobe's streams/format description of ``path`` or None on failure."""
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_streams",
+        "-show_format",
+        "-of",
+        "json",
+        str(path),
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await _communicate(process)
+        if process.returncode != 0:
+            return None
+        return json.loads(stdout.decode(errors="ignore") or "{}")
+    except Exception as e:
+        logger.warning(f"ffprobe failed for {path.name}: {e}")
+        return None
+
+def _moov_before_mdat(path: Path) -> bool:
+    """True if the MP4 index (moov) precedes the media data, i.e. faststart."""
+    try:
+        with path.open("rb") as fh:
+            while True:
+                header = fh.read(8)
+                if len(header) < 8:
+                    return False
+                size = int.from_bytes(header[:4], "big")
+                box = header[4:]
+                if box == b"moov":
+                    return True
+                if box == b"mdat":
+                    return False
+                if size == 1:
+                    size = int.from_bytes(fh.read(8), "big")
+                    fh.seek(size - 16, 1)
+                elif size < 8:
+                    return False
+                else:
+                    fh.seek(size - 8, 1)
+    except OSError:
+        return False
+
+def _select_streams(probe: Optional[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Pick the main video stream (ignoring cover art) and the first audio stream."""
+    video = audio = None
+    for stream in (probe or {}).get("streams", []):
+        codec_type = stream.get("codec_type")
+        if codec_type == "video" and video is None:
+            if (stream.get("disposition") or {}).get("attached_pic"):
+                continue
+            video = stream
+        elif codec_type == "audio" and audio is None:
+            audio = stream
+    return video, audio
+
+def _fit_height(video_kbps: float) -> int:
+    """Largest output height (short side) that still looks decent at ``video_kbps``."""
+    for min_kbps, height in _FIT_HEIGHT_LADDER:
+        if video_kbps >= min_kbps:
+            return height
+    return _FIT_HEIGHT_LADDER[-1][1]
+
+def _size_budget(duration: float, max_bytes: int) -> Optional[Tuple[int, int]]:
+    """Split the upload limit into (video_kbps, audio_kbps) for ``duration`` seconds.
+
+    Audio gives way first (down to _MIN_AUDIO_KBPS) so the video keeps
+    _MIN_VIDEO_KBPS; None when even both minimums don't fit.
+    """
+    # Keep a margin for container overhead and rate-control overshoot
+    total_kbps = (max_bytes * 8 * 0.95) / duration / 1000
+    if total_kbps < _MIN_VIDEO_KBPS + _MIN_AUDIO_KBPS:
+        return None
+    if total_kbps > 600:
+        audio_kbps = 128
+    else:
+        audio_kbps = min(64, int(total_kbps - _MIN_VIDEO_KBPS))
+    return int(total_kbps - audio_kbps), audio_kbps
+
+def _x264_args(scale_filter: Optional[str]) -> list:
+    """libx264 output options, without rate control."""
+    args = [
+        "-c:v",
+        "libx264",
+        "-preset",
+        str(FFMPEG_PRESET),
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    if scale_filter:
+        args += ["-vf", scale_filter]
+    return args
+
+def _rate_control_args(video_kbps: Optional[int]) -> list:
+    if video_kbps is None:
+        return ["-crf", str(FFMPEG_CRF)]
+    # Capped CRF: CRF quality, but never above the size budget
+    return ["-crf", str(FFMPEG_CRF), "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k"]
+
+def _scale_filter(width: int, height: int, target: int) -> Optional[str]:
+    """Downscale so the short side is at most ``target`` (portrait-aware)."""
+    if min(width, height) <= target:
+        return None
+    return f"scale=-2:{target}" if width >= height else f"scale={target}:-2"
+
+async def _run_ffmpeg(
+    cmd: list, cpu_bound: bool = True, on_line: Optional[Callable[[str], bool]] = None
+) -> Tuple[bool, str]:
+    """Run ffmpeg; encodes wait for a transcode_pool slot, stream copies don't.
+
+    With ``on_line`` (see _ffmpeg_progress_parser) ffmpeg reports its progress on stdout.
+    """
+    if on_line is not None:
+        cmd = cmd[:1] + ["-progress", "pipe:1", "-nostats"] + cmd[1:]
+    if not cpu_bound:
+        return await _exec_ffmpeg(cmd, on_line)
+    async with transcode_pool.slot():
+        return await _exec_ffmpeg(transcode_pool.wrap_command(cmd), on_line)
+
+async def _exec_ffmpeg(cmd: list, on_line: Optional[Callable[[str], bool]] = None) -> Tuple[bool, str]:
+    with _track_process("ffmpeg"):
+        returncode, _, stderr = await _run_streaming(cmd, on_line)
+    if returncode != 0:
+        return False, "\n".join(stderr)[-800:]
+    return True, ""
+
+async def transcode_to_telegram_mp4(
+    input_path: Path,
+    max_size_mb: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    profile: str = "telegram",
+    output_dir: Optional[Path] = None,
+) -> Tuple[bool, str, Path]:
     """Transcode to a Telegram-friendly MP4 (H.264/AAC, yuv420p).
 
     Many sources deliver AV1/HEVC which some Telegram clients show as a still frame + audio.
+    The source is probed first: already-compatible files are returned untouched
+    ("transcode skipped"), files that only need a different container or a
+    faststart index are stream-copied ("remuxed"), and otherwise only the
+    incompatible streams are re-encoded ("transcoded").
+
+    With ``max_size_mb`` the video is encoded against a bitrate budget derived
+    from the probed duration (downscaling when the budget is tight), so the
+    output fits the upload limit instead of being rejected afterwards. When the
+    video is too long for any usable bitrate to fit, no budget is applied and
+    the oversized result is left to the caller to split or refuse.
+
+    The default ``profile="telegram"`` keeps the video within
+    TELEGRAM_MAX_HEIGHT, which the cache key of the result names (see
+    telegram_profile_key). With ``profile="small"`` the video is also kept within
+    SMALL_VIDEO_HEIGHT and SMALL_VIDEO_MAX_KBPS. A compatible source that exceeds
+    these limits is re-encoded.
+
+    ``on_progress`` receives the encode progress (both passes of a two-pass encode).
+    The result is written as ``<name>_tg.mp4`` in ``output_dir`` (default: next
+    to the input); give each job its own directory so that two jobs for the
+    same source don't write the same file.
     """
     if not TRANSCODE_FOR_TELEGRAM:
         return True, "transcode disabled", input_path
@@ -23,47 +411,300 @@ async def transcode_to_telegram_mp4(input_path: Path) -> Tuple[bool, str, Path]:
         if not src.exists() or not src.is_file():
             return False, "input file not found", input_path
 
-        out_path = src.with_name(f"{src.stem}_tg.mp4")
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-i",
-            str(src),
-            "-c:v",
-            "libx264",
-            "-preset",
-            str(FFMPEG_PRESET),
-            "-crf",
-            str(FFMPEG_CRF),
-            "-pix_fmt",
-            "yuv420p",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
-            "-movflags",
-            "+faststart",
-            str(out_path),
-        ]
-
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        probe = await probe_media(src) if (SMART_TRANSCODE or max_size_mb) else None
+        video, audio = _select_streams(probe)
+        copy_video = SMART_TRANSCODE and bool(
+            video
+            and video.get("codec_name") in _TELEGRAM_VIDEO_CODECS
+            and video.get("pix_fmt") in _TELEGRAM_PIX_FMTS
+        )
+        copy_audio = SMART_TRANSCODE and bool(probe) and (
+            audio is None or audio.get("codec_name") in _TELEGRAM_AUDIO_CODECS
         )
-        _, stderr = await process.communicate()
-        if process.returncode != 0:
-            msg = stderr.decode(errors="ignore").strip()[-800:]
-            return False, f"ffmpeg transcode failed: {msg}", input_path
 
-        if not out_path.exists() or out_path.stat().st_size == 0:
-            return False, "ffmpeg produced empty output", input_path
+        try:
+            duration = float(((probe or {}).get("format") or {}).get("duration") or 0)
+        except ValueError:
+            duration = 0.0
+
+        max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        budget = _size_budget(duration, max_bytes) if max_bytes and duration > 0 else None
+        if max_bytes and duration > 0 and budget is None:
+            # No bitrate fits: don't burn encodes on it, the caller splits or refuses the result
+            logger.info(
+                "transcode_budget_infeasible file=%s duration=%.0f limit=%s", src.name, duration, max_bytes
+            )
+            max_bytes = None
+        if max_bytes and src.stat().st_size > max_bytes:
+            # Stream copy would keep it too large; the video has to be shrunk
+            copy_video = False
+        max_height = SMALL_VIDEO_HEIGHT if profile == "small" else TELEGRAM_MAX_HEIGHT
+        if video and (
+            min(video.get("width") or 0, video.get("height") or 0) > max_height
+            # Some sources have no per-stream bitrate: only the resolution is checked then
+            or (profile == "small" and int(video.get("bit_rate") or 0) > SMALL_VIDEO_MAX_KBPS * 1250)
+        ):
+            copy_video = False
+
+        if copy_video and copy_audio:
+            format_names = set(((probe or {}).get("format") or {}).get("format_name", "").split(","))
+            if src.suffix.lower() == ".mp4" and "mp4" in format_names and _moov_before_mdat(src):
+                return True, "transcode skipped", input_path
+
+        video_kbps = audio_kbps = None
+        scale_filter = None
+        if not copy_video:
+            scale_filter = _scale_filter(
+                (video or {}).get("width") or 0, (video or {}).get("height") or 0, max_height
+            )
+        if max_bytes and budget and not copy_video:
+            video_kbps, audio_kbps = budget
+            scale_filter = _scale_filter(
+                (video or {}).get("width") or 0,
+                (video or {}).get("height") or 0,
+                min(max_height, _fit_height(video_kbps)),
+            )
+        if profile == "small" and not copy_video:
+            video_kbps = min(video_kbps or SMALL_VIDEO_MAX_KBPS, SMALL_VIDEO_MAX_KBPS)
+            audio_kbps = audio_kbps or 96
+            scale_filter = _scale_filter(
+                (video or {}).get("width") or 0,
+                (video or {}).get("height") or 0,
+                min(SMALL_VIDEO_HEIGHT, _fit_height(video_kbps)),
+            )
+
+        out_dir = Path(output_dir) if output_dir else src.parent
+        out_path = out_dir / f"{src.stem}_tg.mp4"
+        passlog = out_dir / f"{src.stem}_tg.passlog"
 
+        def build_cmd(kbps: Optional[int], pass_number: Optional[int] = None) -> list:
+            cmd = [
+                "ffmpeg",
+                "-y",
+                "-i",
+                str(src),
+                "-map",
+                f"0:{video['index']}" if video else "0:v:0",
+            ]
+            if pass_number != 1:
+                cmd += ["-map", f"0:{audio['index']}" if audio else "0:a:0?"]
+            if copy_video:
+                cmd += ["-c:v", "copy"]
+            elif pass_number:
+                cmd += _x264_args(scale_filter)
+                cmd += ["-b:v", f"{kbps}k", "-pass", str(pass_number), "-passlogfile", str(passlog)]
+            else:
+                cmd += _x264_args(scale_filter) + _rate_control_args(kbps)
+            if pass_number == 1:
+                return cmd + ["-an", "-f", "mp4", os.devnull]
+            if copy_audio:
+                cmd += ["-c:a", "copy"]
+            else:
+                cmd += ["-c:a", "aac", "-b:a", f"{audio_kbps or 128}k"]
+            cmd += [
+                "-movflags",
+                "+faststart",
+                str(out_path),
+            ]
+            return cmd
+
+        def progress(offset: float = 0.0, scale: float = 1.0) -> Optional[Callable[[str], bool]]:
+            if on_progress is None or duration <= 0:
+                return None
+            return _ffmpeg_progress_parser(duration, on_progress, offset, scale)
+
+        try:
+            # One retry with a lower bitrate if the first encode overshoots the limit
+            for _ in range(2):
+                if video_kbps and FFMPEG_TWO_PASS:
+                    ok, msg = await _run_ffmpeg(build_cmd(video_kbps, 1), on_line=progress(0.0, 0.5))
+                    if ok:
+                        ok, msg = await _run_ffmpeg(build_cmd(video_kbps, 2), on_line=progress(0.5, 0.5))
+                else:
+                    ok, msg = await _run_ffmpeg(
+                        build_cmd(video_kbps), cpu_bound=not copy_video, on_line=progress()
+                    )
+                if not ok:
+                    return False, f"ffmpeg transcode failed: {msg}", input_path
+
+                if not out_path.exists() or out_path.stat().st_size == 0:
+                    return False, "ffmpeg produced empty output", input_path
+
+                out_size = out_path.stat().st_size
+                if not (video_kbps and max_bytes and out_size > max_bytes):
+                    break
+                logger.info(
+                    "transcode_overshoot file=%s size=%s limit=%s video_kbps=%s",
+                    out_path.name, out_size, max_bytes, video_kbps,
+                )
+                if video_kbps <= _MIN_VIDEO_KBPS:
+                    # A retry would be the same encode again
+                    break
+                video_kbps = max(int(video_kbps * 0.9 * max_bytes / out_size), _MIN_VIDEO_KBPS)
+        finally:
+            for leftover in out_dir.glob(f"{glob.escape(passlog.name)}*"):
+                try:
+                    leftover.unlink()
+                except OSError:
+                    pass
+
+        if copy_video and copy_audio:
+            return True, "remuxed", out_path
         return True, "transcoded", out_path
     except Exception as e:
         logger.error(f"Error transcoding video: {e}")
         return False, f"transcode error: {e}", input_path
 
+async def to_telegram_audio(
+    input_path: Path,
+    max_size_mb: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    output_dir: Optional[Path] = None,
+) -> Tuple[bool, str, Path]:
+    """Make a downloaded audio track playable by sendAudio (M4A/AAC or MP3).
+
+    AAC in .m4a and MP3 files are sent as they are ("transcode skipped"), AAC
+    in another container is stream-copied to .m4a ("remuxed") and other codecs
+    (Opus, Vorbis) are encoded to AAC ("transcoded"). A file over
+    ``max_size_mb`` is re-encoded at a bitrate that fits its duration. A new
+    file goes to ``output_dir`` (default: next to the input).
+    """
+    try:
+        src = input_path.expanduser().resolve()
+        if not src.exists() or not src.is_file():
+            return False, "input file not found", input_path
+
+        probe = await probe_media(src)
+        _, audio = _select_streams(probe)
+        if probe is None:
+            # No ffprobe: trust the extension yt-dlp gave the format
+            codec = {".m4a": "aac", ".mp3": "mp3"}.get(src.suffix.lower())
+        elif audio is None:
+            return False, "no audio stream", input_path
+        else:
+            codec = audio.get("codec_name")
+        try:
+            duration = float(((probe or {}).get("format") or {}).get("duration") or 0)
+        except ValueError:
+            duration = 0.0
+
+        max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        fits = not max_bytes or src.stat().st_size <= max_bytes
+        if fits and (codec, src.suffix.lower()) in _AUDIO_PASSTHROUGH:
+            return True, "transcode skipped", input_path
+
+        out_path = (Path(output_dir) if output_dir else src.parent) / f"{src.stem}_tg.m4a"
+        copy_audio = fits and codec in _TELEGRAM_AUDIO_CODECS
+        cmd = ["ffmpeg", "-y", "-i", str(src), "-map", "0:a:0", "-vn"]
+        if copy_audio:
+            cmd += ["-c:a", "copy"]
+        else:
+            audio_kbps = 128
+            if max_bytes and duration > 0:
+                # Same margin as _size_budget
+                audio_kbps = max(32, min(audio_kbps, int(max_bytes * 8 * 0.95 / duration / 1000)))
+            cmd += ["-c:a", "aac", "-b:a", f"{audio_kbps}k"]
+        cmd += ["-movflags", "+faststart", str(out_path)]
+
+        on_line = _ffmpeg_progress_parser(duration, on_progress) if on_progress and duration > 0 else None
+        ok, msg = await _run_ffmpeg(cmd, cpu_bound=not copy_audio, on_line=on_line)
+        if not ok:
+            return False, f"ffmpeg audio conversion failed: {msg}", input_path
+        if not out_path.exists() or out_path.stat().st_size == 0:
+            return False, "ffmpeg produced empty output", input_path
+        return True, "remuxed" if copy_audio else "transcoded", out_path
+    except Exception as e:
+        logger.error(f"Error converting audio: {e}")
+        return False, f"audio conversion error: {e}", input_path
+
+# Segment times are shortened this many times when keyframe spacing makes a part too big
+_SPLIT_ATTEMPTS = 4
+
+def _split_parts(output_dir: Path, stem: str) -> List[Path]:
+    return sorted(output_dir.glob(f"{glob.escape(stem)}_part[0-9][0-9][0-9].mp4"))
+
+def _remove_split_parts(output_dir: Path, stem: str) -> None:
+    for part in _split_parts(output_dir, stem):
+        try:
+            part.unlink()
+        except OSError:
+            pass
+
+async def split_for_upload(
+    input_path: Path, max_size_mb: float, output_dir: Optional[Path] = None
+) -> Tuple[bool, str, List[Path]]:
+    """Cut a video at keyframes into MP4 parts of at most ``max_size_mb`` each.
+
+    Uses ffmpeg's segment muxer with stream copy, so nothing is re-encoded and
+    the cost is about one read and write of the file. Parts are named
+    ``<name>_partNNN.mp4`` in ``output_dir`` (default: next to the input).
+    Returns: (success, message, parts in playback order)
+    """
+    output_dir = output_dir or input_path.parent
+    stem = input_path.stem
+    max_bytes = int(max_size_mb * 1024 * 1024)
+    try:
+        size = input_path.stat().st_size
+        if size <= max_bytes:
+            return True, "split skipped", [input_path]
+        probe = await probe_media(input_path)
+        duration = float(((probe or {}).get("format") or {}).get("duration") or 0)
+        if duration <= 0:
+            return False, "split failed: unknown duration", []
+
+        # Keyframes rarely fall exactly on the cut: leave some headroom
+        segment_time = duration * max_bytes / size * 0.9
+        for _ in range(_SPLIT_ATTEMPTS):
+            _remove_split_parts(output_dir, stem)
+            cmd = [
+                "ffmpeg",
+                "-y",
+                "-i",
+                str(input_path),
+                "-map",
+                "0:v:0",
+                "-map",
+                "0:a:0?",
+                "-c",
+                "copy",
+                "-f",
+                "segment",
+                "-segment_time",
+                f"{segment_time:.3f}",
+                "-reset_timestamps",
+                "1",
+                "-segment_format",
+                "mp4",
+                "-segment_format_options",
+                "movflags=+faststart",
+                str(output_dir / f"{stem}_part%03d.mp4"),
+            ]
+            ok, msg = await _run_ffmpeg(cmd, cpu_bound=False)
+            parts = _split_parts(output_dir, stem)
+            if not ok or not parts:
+                _remove_split_parts(output_dir, stem)
+                return False, f"ffmpeg split failed: {msg}", []
+
+            biggest = max(part.stat().st_size for part in parts)
+            if biggest <= max_bytes:
+                logger.info(
+                    "split_done file=%s parts=%s segment_seconds=%.1f", input_path.name, len(parts), segment_time
+                )
+                return True, f"{len(parts)} parts", parts
+            # Keyframes too far apart for this segment time: cut shorter
+            logger.info(
+                "split_overshoot file=%s biggest=%s limit=%s segment_seconds=%.1f",
+                input_path.name, biggest, max_bytes, segment_time,
+            )
+            segment_time *= max_bytes / biggest * 0.9
+
+        _remove_split_parts(output_dir, stem)
+        return False, "split failed: keyframes too far apart to fit the limit", []
+    except Exception as e:
+        _remove_split_parts(output_dir, stem)
+        logger.error(f"Error splitting video: {e}")
+        return False, f"split error: {e}", []
+
 def validate_url(url: str) -> bool:
     """Validate URL to ensure it's from a trusted domain."""
     trusted_base_domains = {
@@ -122,70 +763,722 @@ def ensure_directories(*dirs: Path) -> bool:
         logger.error(f"Error al crear/verificar directorios: {e}")
         return False
 
-async def download_video(url: str, output_dir: Path) -> Tuple[bool, str, Path]:
+def _output_template(output_dir: Path) -> str:
+    # The name only depends on the video: jobs download into their own
+    # directory (see storage.JobDir) so two of them never share a file.
+    # Convert to absolute path and sanitize
+    safe_dir = str(output_dir.expanduser().resolve())
+    # IMPORTANT:
+    # Do NOT sanitize yt-dlp templates with slugify.
+    # If you sanitize "%(title)s" it becomes a literal like "title_s" and every file
+    # will be named "title_s.mp4".
+    # yt-dlp + --restrict-filenames already produces safe filenames.
+    return f"{safe_dir}/%(title).200B-%(id)s.%(ext)s"
+
+def _telegram_format_spec(
+    max_size_mb: Optional[float] = None,
+    max_height: Optional[int] = None,
+    max_kbps: Optional[int] = None,
+) -> str:
+    """Format selector for videos that will be sent to Telegram.
+
+    Walks down a resolution ladder starting at ``max_height`` (default
+    TELEGRAM_MAX_HEIGHT), preferring H.264/AAC (no re-encode needed) before any
+    other codec at each step. When ``max_size_mb`` is given, video streams whose
+    (estimated) size would not fit the upload limit are filtered out before
+    anything is fetched; formats with an unknown size are still allowed.
+    ``max_kbps`` does the same with the bitrate.
+    """
+    max_height = max_height or TELEGRAM_MAX_HEIGHT
+    size_filter = ""
+    if max_size_mb:
+        # Leave ~10% of the budget for the audio track
+        budget = max(1, int(max_size_mb * 0.9))
+        size_filter = f"[filesize<?{budget}MiB][filesize_approx<?{budget}MiB]"
+    if max_kbps:
+        size_filter += f"[tbr<=?{max_kbps}]"
+
+    heights = [h for h in (max_height, 720, 480, 360) if h <= max_height]
+    choices = []
+    for height in sorted(set(heights), reverse=True):
+        video_filter = f"[height<={height}]{size_filter}"
+        choices += [
+            f"bv*[vcodec^=avc1]{video_filter}+ba[acodec^=mp4a]",
+            f"bv*[vcodec^=avc1]{video_filter}+ba",
+            f"b[vcodec^=avc1]{video_filter}",
+            f"bv*{video_filter}+ba",
+            f"b{video_filter}",
+        ]
+    # Nothing fits: take the smallest rendition and let the transcoder deal with it
+    choices.append("wv*+ba/w")
+    return "/".join(choices)
+
+def _audio_format_spec(max_size_mb: Optional[float] = None) -> str:
+    """Format selector for the "audio" profile: audio-only formats, never a video stream.
+
+    AAC (sent as-is, see to_telegram_audio) is preferred over other codecs,
+    first among formats that fit ``max_size_mb``. Sites without a separate
+    audio track fail with "requested format is not available".
+    """
+    choices = []
+    if max_size_mb:
+        size_filter = f"[filesize<?{int(max_size_mb)}MiB][filesize_approx<?{int(max_size_mb)}MiB]"
+        choices += [f"ba[acodec^=mp4a]{size_filter}", f"ba{size_filter}"]
+    choices += ["ba[acodec^=mp4a]", "ba"]
+    return "/".join(choices)
+
+def _profile_format_spec(profile: str, max_size_mb: Optional[float] = None) -> str:
+    """yt-dlp format selector of a download profile (see download_video)."""
+    if profile == "telegram":
+        return _telegram_format_spec(max_size_mb)
+    if profile == "small":
+        return _telegram_format_spec(max_size_mb, SMALL_VIDEO_HEIGHT, SMALL_VIDEO_MAX_KBPS)
+    if profile == "audio":
+        return _audio_format_spec(max_size_mb)
+    return BEST_FORMAT
+
+def _ytdlp_params(outtmpl: str, format_spec: str = BEST_FORMAT) -> Dict[str, Any]:
+    """YoutubeDL options equivalent to the flags used by the CLI engine."""
+    return {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'restrictfilenames': True,
+        'format': format_spec,
+        'merge_output_format': 'mp4',
+        'outtmpl': outtmpl,
+        'cachedir': False,
+        # Keep and resume .part files so a retry only fetches the missing bytes
+        'continuedl': True,
+        'nopart': False,
+    }
+
+def _get_youtube_dl(params: Dict[str, Any]):
+    """Return this thread's YoutubeDL for ``params``, creating it on first use.
+
+    Instances are kept per worker thread (YoutubeDL is not thread-safe) so the
+    extractor registry and extractor instances stay warm between jobs.
+    """
+    instances = getattr(_ytdlp_local, 'instances', None)
+    if instances is None:
+        instances = _ytdlp_local.instances = {}
+
+    key = tuple(sorted((k, repr(v)) for k, v in params.items()))
+    ydl = instances.get(key)
+    if ydl is None:
+        import yt_dlp
+        ydl = instances[key] = yt_dlp.YoutubeDL(params)
+    return ydl
+
+def _summarize_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep the fields of a yt-dlp info dict the bot actually uses."""
+    if info.get('_type') in ('playlist', 'multi_video'):
+        # A single playlist item was requested: describe that entry
+        entry = next((e for e in info.get('entries') or [] if e), None)
+        if entry is not None:
+            info = entry
+    downloads = info.get('requested_downloads') or []
+    filepath = downloads[-1].get('filepath') if downloads else info.get('filepath')
+    formats = [
+        {
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'width': f.get('width'),
+            'height': f.get('height'),
+            'tbr': f.get('tbr'),
+            'filesize': f.get('filesize') or f.get('filesize_approx'),
+        }
+        for f in info.get('formats') or []
+    ]
+    return {
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'filepath': filepath,
+        'formats': formats,
+    }
+
+def _extract_blocking(
+    url: str,
+    params: Dict[str, Any],
+    on_progress: Optional[ProgressCallback] = None,
+    playlist_item: Optional[int] = None,
+    prefetched: Optional[Dict[str, Any]] = None,
+    cancelled: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+    if cancelled is not None and cancelled.is_set():
+        # Cancelled while waiting for a free yt-dlp thread
+        from yt_dlp.utils import DownloadCancelled
+        raise DownloadCancelled()
+    ydl = _get_youtube_dl(params)
+    # The instance is reused by later jobs on this thread, so per-job settings
+    # are undone afterwards (YoutubeDL has no public API for removing hooks)
+    hooks = []
+    if on_progress is not None:
+        hooks.append(_ytdlp_progress_hook(on_progress))
+    if cancelled is not None:
+        hooks.append(_ytdlp_cancel_hook(cancelled))
+        ydl.add_postprocessor_hook(hooks[-1])
+    for hook in hooks:
+        ydl.add_progress_hook(hook)
+    if playlist_item is not None:
+        ydl.params['playlist_items'] = str(playlist_item)
+    try:
+        if prefetched is not None:
+            # Extraction already happened: only pick formats and download
+            info = ydl.process_ie_result(prefetched, download=True)
+        else:
+            info = ydl.extract_info(url, download=True)
+    finally:
+        ydl.params.pop('playlist_items', None)
+        for hook in hooks:
+            ydl._progress_hooks.remove(hook)
+        if cancelled is not None:
+            ydl._postprocessor_hooks.remove(hooks[-1])
+    if info is None:
+        raise RuntimeError("yt-dlp no devolvió información del video")
+    return _summarize_info(info)
+
+def _stream_source(info: Dict[str, Any], filename: Optional[str]) -> Dict[str, Any]:
+    """Summary plus the resolved media URLs ffmpeg needs to read the selected formats."""
+    summary = _summarize_info(info)
+    summary['filename'] = filename
+    summary['inputs'] = [
+        {
+            'url': f.get('url'),
+            'protocol': f.get('protocol'),
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'width': f.get('width'),
+            'height': f.get('height'),
+            'filesize': f.get('filesize') or f.get('filesize_approx'),
+            'http_headers': f.get('http_headers') or {},
+            'cookies': f.get('cookies'),
+        }
+        for f in info.get('requested_formats') or [info]
+    ]
+    return summary
+
+def _resolve_blocking(
+    url: str, params: Dict[str, Any], prefetched: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    ydl = _get_youtube_dl(params)
+    if prefetched is not None:
+        info = ydl.process_ie_result(prefetched, download=False)
+    else:
+        info = ydl.extract_info(url, download=False)
+    if info is None:
+        raise RuntimeError("yt-dlp no devolvió información del video")
+    return _stream_source(info, ydl.prepare_filename(info))
+
+@lru_cache(maxsize=1024)
+def _identify_blocking(url: str) -> Optional[Tuple[str, str]]:
+    from yt_dlp.extractor import gen_extractor_classes
+
+    for ie in gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        video_id = ie.get_temp_id(url)
+        return (ie.ie_key(), video_id) if video_id else None
+    return None
+
+def _playlist_items(url: str, info: Dict[str, Any], limit: int) -> List[Tuple[str, Optional[int]]]:
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return [(url, None)]
+    items: List[Tuple[str, Optional[int]]] = []
+    for index, entry in enumerate(info.get('entries') or [], 1):
+        if len(items) >= limit:
+            break
+        if not entry:
+            continue
+        # Playlists list their videos' own pages; carousel entries only exist
+        # inside the post and are fetched from it by position
+        page = entry.get('url') if entry.get('_type') in ('url', 'url_transparent') else None
+        items.append((page, None) if page and validate_url(page) else (url, index))
+    return items or [(url, None)]
+
+def estimate_size(info: Dict[str, Any], max_height: Optional[int] = None) -> Optional[int]:
+    """Rough bytes of the best video (up to ``max_height``) plus audio, from the format list."""
+    def size(f: Dict[str, Any]) -> Optional[int]:
+        return f.get('filesize') or f.get('filesize_approx')
+
+    formats = [f for f in info.get('formats') or [] if size(f)]
+    videos = [
+        f for f in formats
+        if f.get('vcodec') not in (None, 'none') and (not max_height or (f.get('height') or 0) <= max_height)
+    ]
+    if not videos:
+        return info.get('filesize') or info.get('filesize_approx')
+    best = max(videos, key=lambda f: (f.get('height') or 0, f.get('tbr') or 0))
+    total = size(best)
+    audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    if best.get('acodec') == 'none' and audios:
+        total += size(max(audios, key=lambda f: f.get('tbr') or 0))
+    return int(total)
+
+def _prefetch_blocking(url: str) -> Optional[Dict[str, Any]]:
+    ydl = _get_youtube_dl({'quiet': True, 'no_warnings': True, 'cachedir': False})
+    return ydl.extract_info(url, download=False, process=False)
+
+def _take_prefetched(url: str) -> Optional[Dict[str, Any]]:
+    entry = _prefetched.pop(url, None)
+    if entry is None or time.monotonic() - entry[0] > PREFETCH_TTL_SECONDS:
+        return None
+    return entry[1]
+
+async def prefetch_info(url: str) -> Optional[Dict[str, Any]]:
+    """Extract a video's metadata ahead of its download; None if that fails.
+
+    Only the extractor runs (no format selection or download), on its own
+    threads so it never delays running jobs. The result is kept for
+    PREFETCH_TTL_SECONDS and the next in-process ``download_video`` of the
+    same URL starts from it instead of extracting again. Returns id,
+    extractor, title, duration, ``estimated_size`` for the Telegram profile and
+    ``type`` ("video", "playlist", "url", ...).
+    """
+    global _prefetch_executor
+    if not validate_url(url):
+        return None
+    if _prefetch_executor is None:
+        _prefetch_executor = ThreadPoolExecutor(
+            max_workers=max(1, PREFETCH_WORKERS),
+            thread_name_prefix='yt-dlp-prefetch',
+        )
+    started = time.monotonic()
+    try:
+        loop = asyncio.get_running_loop()
+        info = await loop.run_in_executor(_prefetch_executor, _prefetch_blocking, url)
+    except Exception as e:
+        logger.info(f"Could not prefetch video info: {e}")
+        return None
+    if not info:
+        return None
+
+    summary = {
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'estimated_size': estimate_size(info, TELEGRAM_MAX_HEIGHT),
+        'type': info.get('_type', 'video'),
+    }
+    # Playlists hold lazy entries and redirects carry no formats: nothing to reuse
+    if info.get('_type', 'video') == 'video':
+        now = time.monotonic()
+        for key in [k for k, (at, _) in _prefetched.items() if now - at > PREFETCH_TTL_SECONDS]:
+            del _prefetched[key]
+        while len(_prefetched) >= _MAX_PREFETCHED:
+            _prefetched.pop(next(iter(_prefetched)))
+        _prefetched[url] = (now, info)
+    logger.info(
+        "prefetch_done extractor=%s seconds=%.2f cached=%s",
+        summary['extractor'],
+        time.monotonic() - started,
+        url in _prefetched,
+    )
+    return summary
+
+def _expand_blocking(url: str, limit: int) -> List[Tuple[str, Optional[int]]]:
+    ydl = _get_youtube_dl({
+        'quiet': True,
+        'no_warnings': True,
+        'cachedir': False,
+        'extract_flat': 'in_playlist',
+        'playlistend': limit,
+    })
+    info = ydl.extract_info(url, download=False)
+    return _playlist_items(url, info or {}, limit)
+
+async def _expand_with_cli(url: str, limit: int) -> List[Tuple[str, Optional[int]]]:
+    cmd = ['yt-dlp', '--no-warnings', '--no-cache-dir', '--flat-playlist', '--playlist-end', str(limit), '-J', url]
+    with _track_process("yt-dlp"):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await _communicate(process)
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode(errors="ignore").strip()[-800:])
+    return _playlist_items(url, json.loads(stdout.decode(errors="ignore") or "{}"), limit)
+
+async def expand_url(url: str, limit: int) -> List[Tuple[str, Optional[int]]]:
+    """Videos behind ``url``: (url, playlist index) for up to ``limit`` playlist or carousel items.
+
+    A plain video comes back as ``[(url, None)]``; playlist entries with their own
+    page are returned as that page, others as the original URL plus the 1-based
+    index to pass to ``download_video(playlist_item=...)``. On any error the URL
+    is returned unexpanded.
+    """
+    if not validate_url(url):
+        return [(url, None)]
+    try:
+        if YTDLP_ENGINE == "cli":
+            return await _expand_with_cli(url, limit)
+        loop = asyncio.get_running_loop()
+        with _track_process("yt-dlp"):
+            return await loop.run_in_executor(_get_ytdlp_executor(), _expand_blocking, url, limit)
+    except Exception as e:
+        logger.info(f"Could not expand playlist: {e}")
+        return [(url, None)]
+
+async def identify_url(url: str) -> Optional[Tuple[str, str]]:
+    """(extractor, video id) for ``url`` from yt-dlp's URL patterns, without any network access."""
+    if not validate_url(url):
+        return None
+    try:
+        return await asyncio.to_thread(_identify_blocking, url)
+    except Exception as e:
+        logger.debug(f"Could not identify URL: {e}")
+        return None
+
+def telegram_profile_key(max_size_mb: Optional[float], profile: str = "telegram") -> str:
+    """Identifies the format/transcode settings a sent video was produced with."""
+    if profile == "small":
+        return f"small-{SMALL_VIDEO_HEIGHT}p-{SMALL_VIDEO_MAX_KBPS}k-{int(max_size_mb or 0)}mb"
+    if profile == "audio":
+        return f"audio-{int(max_size_mb or 0)}mb"
+    return f"tg-{TELEGRAM_MAX_HEIGHT}p-{int(max_size_mb or 0)}mb"
+
+def _get_ytdlp_executor() -> ThreadPoolExecutor:
+    global _ytdlp_executor
+    if _ytdlp_executor is None:
+        _ytdlp_executor = ThreadPoolExecutor(
+            max_workers=max(1, YTDLP_WORKERS),
+            thread_name_prefix='yt-dlp',
+        )
+    return _ytdlp_executor
+
+def shutdown_download_engine() -> None:
+    """Stop the in-process yt-dlp worker threads."""
+    global _ytdlp_executor, _prefetch_executor
+    if _ytdlp_executor is not None:
+        _ytdlp_executor.shutdown(wait=False, cancel_futures=True)
+        _ytdlp_executor = None
+    if _prefetch_executor is not None:
+        _prefetch_executor.shutdown(wait=False, cancel_futures=True)
+        _prefetch_executor = None
+
+async def _download_with_api(
+    url: str,
+    outtmpl: str,
+    format_spec: str,
+    on_progress: Optional[ProgressCallback] = None,
+    playlist_item: Optional[int] = None,
+) -> Tuple[bool, str, Path, Dict[str, Any]]:
+    loop = asyncio.get_running_loop()
+    prefetched = _take_prefetched(url) if playlist_item is None else None
+    if prefetched is not None:
+        logger.info("prefetch_used extractor=%s", prefetched.get('extractor_key'))
+    # The thread can't be interrupted from here: cancelling this coroutine sets
+    # the event and the thread stops at its next progress update
+    cancelled = threading.Event()
+    try:
+        with _track_process("yt-dlp"):
+            future = loop.run_in_executor(
+                _get_ytdlp_executor(),
+                _extract_blocking,
+                url,
+                _ytdlp_params(outtmpl, format_spec),
+                on_progress,
+                playlist_item,
+                prefetched,
+                cancelled,
+            )
+            try:
+                info = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                cancelled.set()
+                # Hand back only once the thread let go of the output files
+                await asyncio.gather(future, return_exceptions=True)
+                logger.info("download_cancelled engine=api")
+                raise
+    except Exception as e:
+        return False, f"Error: {e}", Path(), {}
+
+    if not info.get('filepath'):
+        return False, "No se encontró el archivo de video descargado", Path(), info
+    video_path = Path(info['filepath'])
+    if not video_path.is_file():
+        return False, "No se encontró el archivo de video descargado", Path(), info
+    return True, "Descarga exitosa", video_path, info
+
+async def _download_with_cli(
+    url: str,
+    outtmpl: str,
+    format_spec: str,
+    on_progress: Optional[ProgressCallback] = None,
+    playlist_item: Optional[int] = None,
+) -> Tuple[bool, str, Path, Dict[str, Any]]:
+    if on_progress is None:
+        progress_args = ['--no-progress']
+    else:
+        progress_args = ['--progress', '--newline', '--progress-template', _YTDLP_PROGRESS_TEMPLATE]
+    if playlist_item is not None:
+        progress_args += ['--playlist-items', str(playlist_item)]
+
+    # Prepare the command with sanitized inputs
+    cmd = [
+        'yt-dlp',
+        '--no-warnings',
+        '--restrict-filenames',
+        '-f', format_spec,
+        '--merge-output-format', 'mp4',
+        '-o', outtmpl,
+        '--no-cache-dir',
+        '--continue',
+        *progress_args,
+        # Report the final location (after merge/move) so we never have to
+        # guess it by scanning the output directory.
+        '--print', 'after_move:%(.{id,extractor_key,title,duration,filepath})j',
+        url
+    ]
+    
+    # Run the command
+    with _track_process("yt-dlp"):
+        returncode, stdout, stderr = await _run_streaming(
+            cmd, _ytdlp_progress_line(on_progress) if on_progress else None
+        )
+    
+    if returncode != 0:
+        return False, "Error: " + "\n".join(stderr)[-800:], Path(), {}
+
+    info = _parse_printed_info("\n".join(stdout))
+    if not info.get('filepath'):
+        return False, "No se encontró el archivo de video descargado", Path(), info
+    video_path = Path(info['filepath'])
+    if not video_path.is_file():
+        return False, "No se encontró el archivo de video descargado", Path(), info
+    return True, "Descarga exitosa", video_path, info
+
+def _parse_printed_info(output: str) -> Dict[str, Any]:
+    """Parse the JSON line emitted by ``--print after_move:...j``."""
+    for line in reversed(output.splitlines()):
+        line = line.strip()
+        if not line.startswith('{'):
+            continue
+        try:
+            printed = json.loads(line)
+        except ValueError:
+            continue
+        return {
+            'id': printed.get('id'),
+            'extractor': printed.get('extractor_key'),
+            'title': printed.get('title'),
+            'duration': printed.get('duration'),
+            'filepath': printed.get('filepath'),
+            'formats': [],
+        }
+    return {}
+
+async def download_video(
+    url: str,
+    output_dir: Path,
+    profile: str = "best",
+    max_size_mb: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    playlist_item: Optional[int] = None,
+) -> Tuple[bool, str, Path, Dict[str, Any]]:
     """
     Download video from supported platforms using yt-dlp.
-    Returns: (success: bool, message: str, file_path: Path)
+    Returns: (success: bool, message: str, file_path: Path, info: dict)
+
+    ``profile`` is "best" (highest quality, for archiving), "telegram"
+    (H.264/AAC, capped resolution, sized to fit ``max_size_mb``), "small"
+    (the same capped at SMALL_VIDEO_HEIGHT and SMALL_VIDEO_MAX_KBPS) or "audio"
+    (only the audio track, see _audio_format_spec).
+
+    ``info`` holds id, extractor, title, duration and the final filepath as
+    reported by yt-dlp itself; ``formats`` is only filled by the in-process engine.
+    ``on_progress`` receives the download progress of each format being fetched.
+    ``playlist_item`` picks one entry (1-based) of a playlist or carousel URL.
+
+    Transient failures are retried (see DOWNLOAD_RETRIES); partial downloads are
+    resumed from their .part file.
     """
     # Validate URL before processing
     if not validate_url(url):
-        return False, "URL no válida o dominio no soportado", Path()
+        return False, "URL no válida o dominio no soportado", Path(), {}
     
     # Ensure output directory exists and is writable
     if not ensure_directories(output_dir):
-        return False, f"Error: No se puede acceder al directorio {output_dir}", Path()
+        return False, f"Error: No se puede acceder al directorio {output_dir}", Path(), {}
     
     try:
-        # Convert to absolute path and sanitize
-        safe_dir = str(output_dir.expanduser().resolve())
-        # IMPORTANT:
-        # Do NOT sanitize yt-dlp templates with slugify.
-        # If you sanitize "%(title)s" it becomes a literal like "title_s" and every file
-        # will be named "title_s.mp4".
-        # yt-dlp + --restrict-filenames already produces safe filenames.
-        outtmpl = f"{safe_dir}/%(title).200B-%(id)s.%(ext)s"
-        
-        # Prepare the command with sanitized inputs
-        cmd = [
-            'yt-dlp',
-            '--no-warnings',
-            '--restrict-filenames',
-            # Some sites (e.g. Reddit) expose separate video+audio streams.
-            # This selector downloads best video+audio when available, otherwise falls back.
-            '-f', 'bv*+ba/best',
-            '--merge-output-format', 'mp4',
-            '-o', outtmpl,
-            '--no-cache-dir',
-            '--no-progress',
-            url
-        ]
+        outtmpl = _output_template(output_dir)
+
+        # Some sites (e.g. Reddit) expose separate video+audio streams.
+        # Video selectors download video+audio when available, otherwise fall back.
+        format_spec = _profile_format_spec(profile, max_size_mb)
+
+        host = host_key(url)
+        attempt = 0
+        while True:
+            await host_cooldowns.wait(host, DOWNLOAD_RETRY_MAX_SECONDS)
+            if YTDLP_ENGINE == "cli":
+                result = await _download_with_cli(url, outtmpl, format_spec, on_progress, playlist_item)
+            else:
+                result = await _download_with_api(url, outtmpl, format_spec, on_progress, playlist_item)
+
+            ok, msg = result[0], result[1]
+            if ok or attempt >= DOWNLOAD_RETRIES or classify_failure(msg) != TRANSIENT:
+                if ok and attempt:
+                    logger.info("download_recovered host=%s retries=%s", host, attempt)
+                return result
+
+            attempt += 1
+            if is_rate_limited(msg):
+                host_cooldowns.cool_down(host, HOST_COOLDOWN_SECONDS)
+            delay = backoff_delay(attempt, DOWNLOAD_RETRY_BASE_SECONDS, DOWNLOAD_RETRY_MAX_SECONDS)
+            logger.info(
+                "download_retry host=%s attempt=%s delay=%.1f error=%s",
+                host,
+                attempt,
+                delay,
+                msg.strip().splitlines()[-1][:200] if msg.strip() else "",
+            )
+            await asyncio.sleep(delay)
         
-        # Run the command
+    except Exception as e:
+        logger.error(f"Error downloading video: {e}")
+        return False, f"Error: {str(e)}", Path(), {}
+
+async def _resolve_with_cli(url: str, outtmpl: str, format_spec: str) -> Dict[str, Any]:
+    cmd = [
+        'yt-dlp',
+        '--no-warnings',
+        '--restrict-filenames',
+        '-f', format_spec,
+        '--merge-output-format', 'mp4',
+        '-o', outtmpl,
+        '--no-cache-dir',
+        '-j',
+        url
+    ]
+    with _track_process("yt-dlp"):
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            return False, f"Error: {stderr.decode()}", Path()
-            
-        # Find the downloaded file safely (avoid picking metadata like .info.json)
-        allowed_extensions = {'.mp4', '.mkv', '.webm', '.mov'}
-        candidate_files = [
-            p for p in output_dir.iterdir()
-            if p.is_file() and p.suffix.lower() in allowed_extensions
-        ]
-        if not candidate_files:
-            return False, "No se encontró el archivo de video descargado", Path()
+        stdout, stderr = await _communicate(process)
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode(errors="ignore").strip()[-800:])
+    info = json.loads(stdout.decode(errors="ignore").strip().splitlines()[-1])
+    return _stream_source(info, info.get('filename') or info.get('_filename'))
 
-        # Get the most recently modified video file
-        latest_file = max(candidate_files, key=lambda x: x.stat().st_mtime)
-            
-        return True, "Descarga exitosa", latest_file
-        
+def _ffmpeg_input_args(source: Dict[str, Any]) -> list:
+    headers = dict(source.get('http_headers') or {})
+    if source.get('cookies'):
+        headers['Cookie'] = source['cookies']
+    args = []
+    if headers:
+        args += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    return args + ["-i", source['url']]
+
+async def stream_to_telegram_mp4(
+    url: str,
+    output_dir: Path,
+    max_size_mb: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None,
+) -> Tuple[bool, str, Path, Dict[str, Any]]:
+    """Download and transcode in one pass: ffmpeg reads the resolved media URLs.
+
+    Encoding starts while bytes are still arriving and only the final ``_tg.mp4``
+    is written to ``output_dir``. Returns the same tuple as ``download_video``;
+    on failure (including sources ffmpeg can't read directly, such as DASH
+    fragments) the caller should fall back to ``download_video``.
+    """
+    if not validate_url(url):
+        return False, "URL no válida o dominio no soportado", Path(), {}
+
+    if not ensure_directories(output_dir):
+        return False, f"Error: No se puede acceder al directorio {output_dir}", Path(), {}
+
+    try:
+        outtmpl = _output_template(output_dir)
+        format_spec = _telegram_format_spec(max_size_mb)
+        if YTDLP_ENGINE == "cli":
+            info = await _resolve_with_cli(url, outtmpl, format_spec)
+        else:
+            loop = asyncio.get_running_loop()
+            with _track_process("yt-dlp"):
+                info = await loop.run_in_executor(
+                    _get_ytdlp_executor(),
+                    _resolve_blocking,
+                    url,
+                    _ytdlp_params(outtmpl, format_spec),
+                    _take_prefetched(url),
+                )
     except Exception as e:
-        logger.error(f"Error downloading video: {e}")
-        return False, f"Error: {str(e)}", Path()
+        return False, f"Error: {e}", Path(), {}
+
+    inputs = info.get('inputs') or []
+    unsupported = [i.get('protocol') for i in inputs if i.get('protocol') not in _STREAMABLE_PROTOCOLS]
+    if not inputs or unsupported or not info.get('filename'):
+        return False, f"streaming not supported (protocol={unsupported})", Path(), info
+
+    video_index = next((n for n, i in enumerate(inputs) if (i.get('vcodec') or 'none') != 'none'), None)
+    audio_index = next((n for n, i in enumerate(inputs) if (i.get('acodec') or 'none') != 'none'), None)
+    if video_index is None:
+        return False, "streaming not supported (no video stream)", Path(), info
+    video, audio = inputs[video_index], inputs[audio_index] if audio_index is not None else None
+
+    duration = info.get('duration') or 0
+    max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+    budget = _size_budget(duration, max_bytes) if max_bytes and duration > 0 else None
+    if max_bytes and duration > 0 and budget is None:
+        # Too long for any bitrate to fit: the result is split or refused as it is
+        max_bytes = None
+    estimated = sum(i.get('filesize') or 0 for i in inputs) or None
+    fits = not max_bytes or (estimated is not None and estimated <= max_bytes)
+    within_height = min(video.get('width') or 0, video.get('height') or 0) <= TELEGRAM_MAX_HEIGHT
+    copy_video = SMART_TRANSCODE and fits and within_height and (video.get('vcodec') or '').startswith('avc1')
+    copy_audio = SMART_TRANSCODE and (audio is None or (audio.get('acodec') or '').startswith('mp4a'))
+
+    video_kbps = audio_kbps = None
+    scale_filter = None
+    if not copy_video:
+        scale_filter = _scale_filter(video.get('width') or 0, video.get('height') or 0, TELEGRAM_MAX_HEIGHT)
+    if max_bytes and budget and not copy_video:
+        video_kbps, audio_kbps = budget
+        scale_filter = _scale_filter(
+            video.get('width') or 0, video.get('height') or 0, min(TELEGRAM_MAX_HEIGHT, _fit_height(video_kbps))
+        )
+
+    out_path = Path(info['filename']).with_suffix('')
+    out_path = out_path.with_name(f"{out_path.name}_tg.mp4")
+
+    cmd = ["ffmpeg", "-y"]
+    for source in inputs:
+        cmd += _ffmpeg_input_args(source)
+    cmd += ["-map", f"{video_index}:v:0"]
+    if audio_index is not None:
+        cmd += ["-map", f"{audio_index}:a:0"]
+    if copy_video:
+        cmd += ["-c:v", "copy"]
+    else:
+        cmd += _x264_args(scale_filter) + _rate_control_args(video_kbps)
+    if copy_audio:
+        cmd += ["-c:a", "copy"]
+    else:
+        cmd += ["-c:a", "aac", "-b:a", f"{audio_kbps or 128}k"]
+    cmd += ["-movflags", "+faststart", str(out_path)]
+
+    try:
+        on_line = _ffmpeg_progress_parser(duration, on_progress) if on_progress and duration > 0 else None
+        ok, msg = await _run_ffmpeg(cmd, cpu_bound=not copy_video, on_line=on_line)
+    except Exception as e:
+        ok, msg = False, str(e)
+    if not ok or not out_path.exists() or out_path.stat().st_size == 0:
+        try:
+            out_path.unlink()
+        except OSError:
+            pass
+        return False, f"ffmpeg streaming failed: {msg}", Path(), info
+
+    info['filepath'] = str(out_path)
+    return True, "streamed", out_path, info
@@ -0,0 +1,211 @@
+import logging
+import importlib
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import select, update, delete, func, or_, and_
+
+from models import Database, QueuedJob, QueueJob
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(ABC):
+    """Durable queue between the bot (producer) and the download workers.
+
+    A worker claims a job with a lease and keeps renewing it while it works; if
+    the worker dies the lease runs out and another worker picks the job up again,
+    up to ``max_attempts`` times, after which ``fail_expired`` fails it. Backends
+    other than SQLite subclass this and are selected with
+    ``JOB_QUEUE_BACKEND=package.module:ClassName``.
+    """
+
+    def __init__(self, max_attempts: int = 3, per_chat_limit: int = 1):
+        self.max_attempts = max(1, max_attempts)
+        self.per_chat_limit = max(1, per_chat_limit)
+
+    @abstractmethod
+    async def enqueue(
+        self, chat_id: int, username: Optional[str], action: str, url: str, message_id: int
+    ) -> int:
+        """Add a job; returns its id."""
+
+    @abstractmethod
+    async def claim(self, worker_id: str, lease_seconds: float) -> Optional[QueueJob]:
+        """Take the oldest runnable job, or None if there is nothing to do."""
+
+    @abstractmethod
+    async def renew(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        """Extend a lease; False means the job was taken over by another worker."""
+
+    @abstractmethod
+    async def finish(self, job_id: int, worker_id: str, error: Optional[str] = None) -> None:
+        """Mark a claimed job as done (or failed with ``error``)."""
+
+    @abstractmethod
+    async def fail_expired(self) -> List[QueueJob]:
+        """Fail jobs whose lease ran out on their last attempt; returns them so their users can be told."""
+
+    @abstractmethod
+    async def purge(self, older_than: datetime) -> int:
+        """Delete finished jobs last updated before ``older_than``."""
+
+    @abstractmethod
+    async def counts(self) -> dict:
+        """Number of jobs per state."""
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue stored in the bot's SQLite database.
+
+    Claims are optimistic: a worker picks a candidate and takes it with a
+    conditional UPDATE, so any number of worker processes sharing the database
+    file can poll it. SQLite locking needs a local filesystem, so this suits
+    workers on one host; use another backend to spread workers across nodes.
+    """
+
+    def __init__(self, database: Database, max_attempts: int = 3, per_chat_limit: int = 1):
+        super().__init__(max_attempts, per_chat_limit)
+        self.db = database
+
+    async def enqueue(
+        self, chat_id: int, username: Optional[str], action: str, url: str, message_id: int
+    ) -> int:
+        async with self.db.session() as session:
+            job = QueuedJob(chat_id=chat_id, username=username, action=action, url=url, message_id=message_id)
+            session.add(job)
+            await session.commit()
+            return job.id
+
+    async def fail_expired(self) -> List[QueueJob]:
+        now = datetime.utcnow()
+        exhausted = and_(
+            QueuedJob.state == "running",
+            QueuedJob.lease_until < now,
+            QueuedJob.attempts >= self.max_attempts,
+        )
+        async with self.db.session() as session:
+            jobs = (await session.execute(select(QueuedJob).where(exhausted))).scalars().all()
+            if not jobs:
+                return []
+            expired = []
+            for job in jobs:
+                # Another worker may have failed (or renewed) it in between
+                result = await session.execute(
+                    update(QueuedJob)
+                    .where(QueuedJob.id == job.id, exhausted)
+                    .values(state="failed", error="worker lease expired", lease_until=None, updated_at=now)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount == 1:
+                    expired.append(QueueJob.from_orm(job))
+            await session.commit()
+            return expired
+
+    async def claim(self, worker_id: str, lease_seconds: float) -> Optional[QueueJob]:
+        now = datetime.utcnow()
+        # Jobs out of attempts wait for fail_expired instead
+        runnable = or_(
+            QueuedJob.state == "queued",
+            and_(
+                QueuedJob.state == "running",
+                QueuedJob.lease_until < now,
+                QueuedJob.attempts < self.max_attempts,
+            ),
+        )
+        busy_chats = (
+            select(QueuedJob.chat_id)
+            .where(QueuedJob.state == "running", QueuedJob.lease_until >= now)
+            .group_by(QueuedJob.chat_id)
+            .having(func.count() >= self.per_chat_limit)
+        )
+        async with self.db.session() as session:
+            # Another worker may take a candidate first: try the next one
+            for _ in range(5):
+                candidate = (
+                    await session.execute(
+                        select(QueuedJob.id)
+                        .where(runnable, QueuedJob.chat_id.notin_(busy_chats))
+                        .order_by(QueuedJob.id)
+                        .limit(1)
+                    )
+                ).scalar()
+                if candidate is None:
+                    return None
+
+                result = await session.execute(
+                    update(QueuedJob)
+                    .where(QueuedJob.id == candidate, runnable)
+                    .values(
+                        state="running",
+                        worker_id=worker_id,
+                        lease_until=now + timedelta(seconds=lease_seconds),
+                        attempts=QueuedJob.attempts + 1,
+                        updated_at=now,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+                if result.rowcount == 1:
+                    job = (await session.execute(select(QueuedJob).where(QueuedJob.id == candidate))).scalar_one()
+                    return QueueJob.from_orm(job)
+        return None
+
+    async def renew(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        now = datetime.utcnow()
+        async with self.db.session() as session:
+            result = await session.execute(
+                update(QueuedJob)
+                .where(QueuedJob.id == job_id, QueuedJob.worker_id == worker_id, QueuedJob.state == "running")
+                .values(lease_until=now + timedelta(seconds=lease_seconds), updated_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            return result.rowcount == 1
+
+    async def finish(self, job_id: int, worker_id: str, error: Optional[str] = None) -> None:
+        async with self.db.session() as session:
+            await session.execute(
+                update(QueuedJob)
+                .where(QueuedJob.id == job_id, QueuedJob.worker_id == worker_id)
+                .values(
+                    state="failed" if error else "done",
+                    error=error[:500] if error else None,
+                    lease_until=None,
+                    updated_at=datetime.utcnow(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+    async def purge(self, older_than: datetime) -> int:
+        async with self.db.session() as session:
+            result = await session.execute(
+                delete(QueuedJob)
+                .where(QueuedJob.state.in_(("done", "failed")), QueuedJob.updated_at < older_than)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            return result.rowcount or 0
+
+    async def counts(self) -> dict:
+        async with self.db.read_session() as session:
+            result = await session.execute(select(QueuedJob.state, func.count()).group_by(QueuedJob.state))
+            return dict(result.all())
+
+
+_BACKENDS = {"sqlite": SQLiteJobQueue}
+
+
+def create_job_queue(backend: str, database: Database, **options) -> JobQueue:
+    """Build the queue named by ``backend``: "sqlite" or "package.module:ClassName"."""
+    if backend in _BACKENDS:
+        return _BACKENDS[backend](database, **options)
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown job queue backend: {backend}")
+    queue_class = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(queue_class, JobQueue):
+        raise ValueError(f"{backend} is not a JobQueue")
+    return queue_class(database, **options)
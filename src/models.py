@@ -2,8 +2,9 @@ from datetime import datetime
 from typing import Optional, AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Index
+from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, Index, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 import bleach
@@ -32,6 +33,7 @@ class UnauthorizedEvent(Base):
     chat_id = Column(Integer, nullable=False)
     username = Column(String, nullable=True)
     command = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=1)
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     # Add indexes for faster lookups
@@ -40,6 +42,41 @@ class UnauthorizedEvent(Base):
         Index('idx_timestamp', 'timestamp'),
     )
 
+class SentVideo(Base):
+    """Telegram file_id of a video we already uploaded, so it can be re-sent without re-uploading."""
+    __tablename__ = "sent_videos"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    extractor = Column(String, nullable=False)
+    video_id = Column(String, nullable=False)
+    profile = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    file_unique_id = Column(String, nullable=True)
+    file_size = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_sent_video_identity', 'extractor', 'video_id', 'profile', unique=True),
+    )
+
+class CachedDownload(Base):
+    """A downloaded file still on disk, indexed by canonical video identity."""
+    __tablename__ = "cached_downloads"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    extractor = Column(String, nullable=False)
+    video_id = Column(String, nullable=False)
+    profile = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    file_size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_cached_download_identity', 'extractor', 'video_id', 'profile', unique=True),
+        Index('idx_cached_download_path', 'path'),
+    )
+
 # Pydantic Schemas
 class UserBase(BaseModel):
     chat_id: int
@@ -63,28 +100,169 @@ class EventBase(BaseModel):
     class Config:
         orm_mode = True
 
+class QueueJob(BaseModel):
+    id: int
+    chat_id: int
+    username: Optional[str] = None
+    action: str
+    url: str
+    message_id: int
+    attempts: int = 0
+    
+    class Config:
+        orm_mode = True
+
 class Event(EventBase):
     id: int
+    attempts: int = 1
     timestamp: datetime
 
+class Job(Base):
+    """One processed request, with per-stage timings (seconds) and its outcome."""
+    __tablename__ = "jobs"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    extractor = Column(String, nullable=True)
+    video_id = Column(String, nullable=True)
+    bytes_downloaded = Column(Integer, nullable=True)
+    download_seconds = Column(Float, nullable=True)
+    transcode_seconds = Column(Float, nullable=True)
+    upload_seconds = Column(Float, nullable=True)
+    total_seconds = Column(Float, nullable=True)
+    output_size = Column(Integer, nullable=True)
+    transcode_skipped = Column(Boolean, nullable=True)
+    outcome = Column(String, nullable=False)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_jobs_created_at', 'created_at'),
+        Index('idx_jobs_outcome_created_at', 'outcome', 'created_at'),
+    )
+
+class QueuedJob(Base):
+    """A job handed from the bot to the download workers (see jobqueue.py)."""
+    __tablename__ = "job_queue"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Integer, nullable=False)
+    username = Column(String, nullable=True)
+    action = Column(String, nullable=False)
+    # One link, or the links of a batch one per line
+    url = Column(String, nullable=False)
+    # Status message the worker edits while it processes the job
+    message_id = Column(Integer, nullable=False)
+    state = Column(String, nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_job_queue_state', 'state', 'id'),
+        Index('idx_job_queue_lease', 'state', 'lease_until'),
+    )
+
+# Columns added after the first release: create_all() doesn't alter existing tables
+_ADDED_COLUMNS = {
+    "unauthorized_events": {
+        "attempts": "INTEGER NOT NULL DEFAULT 1",
+    },
+}
+
+def _add_missing_columns(connection) -> None:
+    for table, columns in _ADDED_COLUMNS.items():
+        existing = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+        for name, ddl in columns.items():
+            if name not in existing:
+                connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
 # Database configuration and session management
+_JOURNAL_MODES = {"WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"}
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
 class Database:
-    def __init__(self, db_path: Path):
-        self.engine = create_async_engine(
-            f"sqlite+aiosqlite:///{db_path}",
-            echo=False,
-            future=True
-        )
+    """Async SQLite access with separate write and read paths.
+
+    With ``tuned`` (the default) every connection gets performance pragmas and is
+    kept open in a pool: a single persistent writer connection (SQLite only allows
+    one writer anyway, so writers queue in the pool instead of on the file lock)
+    and ``read_pool_size`` reader connections. In WAL mode readers never wait for
+    the writer. WAL needs shared memory, so use ``journal_mode="DELETE"`` if the
+    database file lives on NFS (db_manager picks it on its own for network
+    filesystems unless DB_JOURNAL_MODE says otherwise). ``tuned=False`` gives the bare engine (a new
+    connection per session, default pragmas).
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        tuned: bool = True,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        busy_timeout_ms: int = 5000,
+        cache_size_kb: int = 16384,
+        mmap_size_mb: int = 64,
+        read_pool_size: int = 4,
+    ):
+        url = f"sqlite+aiosqlite:///{db_path}"
+        if not tuned:
+            self.engine = create_async_engine(url, echo=False, future=True)
+            self.read_engine = self.engine
+        else:
+            journal_mode = journal_mode.upper()
+            synchronous = synchronous.upper()
+            if journal_mode not in _JOURNAL_MODES:
+                raise ValueError(f"Unsupported journal mode: {journal_mode}")
+            if synchronous not in _SYNCHRONOUS_MODES:
+                raise ValueError(f"Unsupported synchronous mode: {synchronous}")
+            
+            pragmas = [
+                f"PRAGMA synchronous={synchronous}",
+                f"PRAGMA busy_timeout={int(busy_timeout_ms)}",
+                f"PRAGMA cache_size=-{int(cache_size_kb)}",
+                f"PRAGMA mmap_size={int(mmap_size_mb) * 1024 * 1024}",
+                "PRAGMA temp_store=MEMORY",
+            ]
+            self.engine = create_async_engine(
+                url,
+                echo=False,
+                future=True,
+                poolclass=AsyncAdaptedQueuePool,
+                pool_size=1,
+                max_overflow=0,
+            )
+            self.read_engine = create_async_engine(
+                url,
+                echo=False,
+                future=True,
+                poolclass=AsyncAdaptedQueuePool,
+                pool_size=max(1, read_pool_size),
+                max_overflow=0,
+            )
+            _set_pragmas_on_connect(self.engine, [f"PRAGMA journal_mode={journal_mode}"] + pragmas)
+            _set_pragmas_on_connect(self.read_engine, pragmas)
+        
         self.async_session = sessionmaker(
             self.engine,
             class_=AsyncSession,
             expire_on_commit=False
         )
+        self.async_read_session = sessionmaker(
+            self.read_engine,
+            class_=AsyncSession,
+            expire_on_commit=False
+        )
 
     async def initialize(self):
         """Create all tables"""
         async with self.engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(_add_missing_columns)
 
     @asynccontextmanager
     async def session(self) -> AsyncGenerator[AsyncSession, None]:
@@ -95,6 +273,29 @@ class Database:
         finally:
             await session.close()
 
+    @asynccontextmanager
+    async def read_session(self) -> AsyncGenerator[AsyncSession, None]:
+        """Get a session for read-only queries (never waits behind the writer in WAL mode)"""
+        session: AsyncSession = self.async_read_session()
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    async def close(self):
+        """Close all pooled connections"""
+        await self.engine.dispose()
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+
+def _set_pragmas_on_connect(engine, pragmas: list[str]) -> None:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
 # Input sanitization functions
 def sanitize_text(text: str) -> str:
     """Sanitize text input to prevent XSS"""
@@ -0,0 +1,88 @@
+import re
+import time
+import random
+import asyncio
+import logging
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+UNKNOWN = "unknown"
+
+# Checked first: retrying these can't succeed
+_PERMANENT_PATTERNS = re.compile(
+    r"unsupported url|video unavailable|private video|this video is (?:not available|private)"
+    r"|has been removed|no video formats found|requested format is not available"
+    r"|sign in to confirm your age|login required|members[- ]only|available in your country"
+    r"|geo.?restrict|copyright|http error 40[0134]|http error 410|url no válida"
+    r"|no se puede acceder al directorio",
+    re.IGNORECASE,
+)
+_RATE_LIMIT_PATTERNS = re.compile(r"http error 429|too many requests|rate.?limit", re.IGNORECASE)
+_TRANSIENT_PATTERNS = re.compile(
+    r"http error 5\d\d|connection (?:reset|refused|aborted)|timed? ?out|temporary failure"
+    r"|name resolution|incompleteread|remote end closed|broken pipe|network is unreachable"
+    r"|unable to download (?:webpage|video data|json metadata)|got server http error"
+    r"|eof occurred|content too short|did not get any data blocks|giving up after \d+ retries",
+    re.IGNORECASE,
+)
+
+
+def classify_failure(message: str) -> str:
+    """Tell whether a yt-dlp error is worth retrying (TRANSIENT), not (PERMANENT) or unclear."""
+    if _PERMANENT_PATTERNS.search(message or ""):
+        return PERMANENT
+    if _RATE_LIMIT_PATTERNS.search(message or "") or _TRANSIENT_PATTERNS.search(message or ""):
+        return TRANSIENT
+    return UNKNOWN
+
+
+def is_rate_limited(message: str) -> bool:
+    return bool(_RATE_LIMIT_PATTERNS.search(message or ""))
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for the ``attempt``-th retry (1-based)."""
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+
+def host_key(url: str) -> str:
+    """Host used for cool-downs, without "www." / "m." prefixes."""
+    host = (urlparse(url).hostname or "").lower()
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+class HostCooldowns:
+    """Per-host pause after a rate limit, shared by every download in the process."""
+
+    def __init__(self):
+        self._until: Dict[str, float] = {}
+
+    def remaining(self, host: str) -> float:
+        until = self._until.get(host)
+        if until is None:
+            return 0.0
+        left = until - time.monotonic()
+        if left <= 0:
+            del self._until[host]
+            return 0.0
+        return left
+
+    def cool_down(self, host: str, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        if until > self._until.get(host, 0):
+            self._until[host] = until
+            logger.info("host_cooldown host=%s seconds=%.0f", host, seconds)
+
+    async def wait(self, host: str, max_wait: Optional[float] = None) -> None:
+        delay = self.remaining(host)
+        if max_wait is not None:
+            delay = min(delay, max_wait)
+        if delay > 0:
+            await asyncio.sleep(delay)
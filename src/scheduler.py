@@ -0,0 +1,303 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncGenerator, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+JobRunner = Callable[[], Awaitable[None]]
+PositionCallback = Callable[[int], Awaitable[None]]
+DropCallback = Callable[[], Awaitable[None]]
+
+
+class _Job:
+    __slots__ = ("chat_id", "run", "on_position", "on_drop", "position", "shown", "notice")
+
+    def __init__(
+        self,
+        chat_id: int,
+        run: JobRunner,
+        on_position: Optional[PositionCallback],
+        on_drop: Optional[DropCallback],
+    ):
+        self.chat_id = chat_id
+        self.run = run
+        self.on_position = on_position
+        self.on_drop = on_drop
+        self.position = 0
+        # Last position reported through on_position, and the task reporting it
+        self.shown = 0
+        self.notice: Optional[asyncio.Task] = None
+
+
+def _take_next(
+    rotation: Deque[int], queues: Dict[int, Deque[_Job]], running: Dict[int, int], per_chat_limit: int
+) -> Optional[_Job]:
+    """Pop the job the rotation hands out next, skipping chats at their limit."""
+    for _ in range(len(rotation)):
+        chat_id = rotation[0]
+        rotation.rotate(-1)
+        if running.get(chat_id, 0) >= per_chat_limit:
+            continue
+        queue = queues[chat_id]
+        job = queue.popleft()
+        if not queue:
+            del queues[chat_id]
+            rotation.pop()
+        return job
+    return None
+
+
+class JobScheduler:
+    """Bounded job pool that dispatches work round-robin across chats.
+
+    Every chat has its own FIFO queue. When a slot frees up, the next chat in the
+    rotation that is below its per-chat limit gets to run its oldest job, so a user
+    queueing several long videos cannot hold everybody else behind them.
+    """
+
+    def __init__(self, max_workers: int = 2, per_chat_limit: int = 1):
+        self.max_workers = max(1, max_workers)
+        self.per_chat_limit = max(1, per_chat_limit)
+        self._pending: Dict[int, Deque[_Job]] = {}
+        self._rotation: Deque[int] = deque()
+        self._running: Dict[int, int] = {}
+        # Chats of the running jobs, in the order they started
+        self._started: Deque[int] = deque()
+        self._tasks: Set[asyncio.Task] = set()
+        self._callbacks: Set[asyncio.Task] = set()
+        self._closing = False
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a free slot."""
+        return sum(len(q) for q in self._pending.values())
+
+    @property
+    def in_flight(self) -> int:
+        """Number of jobs currently running."""
+        return len(self._tasks)
+
+    def submit(
+        self,
+        chat_id: int,
+        run: JobRunner,
+        on_position: Optional[PositionCallback] = None,
+        on_drop: Optional[DropCallback] = None,
+    ) -> int:
+        """Queue a job for a chat.
+
+        Returns 0 if the job started right away, otherwise its 1-based position in
+        the queue. ``on_position`` is awaited whenever that position changes while
+        the job waits; ``on_drop`` if the scheduler stops before the job started.
+        """
+        if self._closing:
+            raise RuntimeError("scheduler is shutting down")
+
+        job = _Job(chat_id, run, on_position, on_drop)
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            self._rotation.append(chat_id)
+        queue.append(job)
+
+        self._dispatch()
+        return job.position
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Drop queued jobs (telling them through on_drop) and wait (up to ``timeout``) for running ones."""
+        self._closing = True
+        dropped = [job for queue in self._pending.values() for job in queue]
+        self._pending.clear()
+        self._rotation.clear()
+        if dropped:
+            logger.warning("scheduler_stop dropped_jobs=%s", len(dropped))
+            for job in dropped:
+                job.position = 0
+            await asyncio.gather(
+                *(self._drop(job) for job in dropped if job.on_drop is not None), return_exceptions=True
+            )
+
+        if self._tasks:
+            _, still_running = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in still_running:
+                task.cancel()
+            if still_running:
+                await asyncio.gather(*still_running, return_exceptions=True)
+
+        for task in self._callbacks:
+            task.cancel()
+
+    async def _drop(self, job: _Job) -> None:
+        try:
+            if job.notice is not None:
+                await asyncio.wait({job.notice})
+            await job.on_drop()
+        except Exception as e:
+            logger.debug(f"Queue drop callback failed: {e}")
+
+    def _next_job(self) -> Optional[_Job]:
+        return _take_next(self._rotation, self._pending, self._running, self.per_chat_limit)
+
+    def _dispatch(self) -> None:
+        while len(self._tasks) < self.max_workers:
+            job = self._next_job()
+            if job is None:
+                break
+            job.position = 0
+            self._running[job.chat_id] = self._running.get(job.chat_id, 0) + 1
+            self._started.append(job.chat_id)
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+        self._update_positions()
+
+    def _dispatch_order(self) -> List[_Job]:
+        """Pending jobs in the order _next_job would hand them out.
+
+        Replays the rotation on copies of the queues, per-chat limit included,
+        assuming running jobs finish in the order they started.
+        """
+        rotation = deque(self._rotation)
+        queues = {chat_id: deque(self._pending[chat_id]) for chat_id in rotation}
+        running = dict(self._running)
+        started = deque(self._started)
+        order: List[_Job] = []
+        while rotation:
+            job = None
+            if len(started) < self.max_workers:
+                job = _take_next(rotation, queues, running, self.per_chat_limit)
+            if job is None:
+                # Nothing else can start until a running job ends
+                finished = started.popleft()
+                running[finished] -= 1
+                continue
+            running[job.chat_id] = running.get(job.chat_id, 0) + 1
+            started.append(job.chat_id)
+            order.append(job)
+        return order
+
+    def _update_positions(self) -> None:
+        for index, job in enumerate(self._dispatch_order(), start=1):
+            if job.position == index:
+                continue
+            job.position = index
+            if job.on_position is not None:
+                task = asyncio.create_task(self._notify(job, job.notice))
+                job.notice = task
+                self._callbacks.add(task)
+                task.add_done_callback(self._callbacks.discard)
+
+    async def _notify(self, job: _Job, previous: Optional[asyncio.Task]) -> None:
+        """Report the job's current position, after any earlier report has landed.
+
+        Nothing is sent once the job has started (position 0): its own status
+        must not be overwritten by a stale "#N en cola".
+        """
+        if previous is not None:
+            await asyncio.wait({previous})
+        position = job.position
+        if position == 0 or position == job.shown:
+            return
+        job.shown = position
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            logger.debug(f"Queue position callback failed: {e}")
+
+    async def _run(self, job: _Job) -> None:
+        try:
+            if job.notice is not None:
+                # A position edit already on its way must land before the job's own
+                await asyncio.wait({job.notice})
+            await job.run()
+        except Exception as e:
+            logger.error(f"Unhandled error in scheduled job: {e}")
+        finally:
+            remaining = self._running.get(job.chat_id, 1) - 1
+            if remaining > 0:
+                self._running[job.chat_id] = remaining
+            else:
+                self._running.pop(job.chat_id, None)
+            self._started.remove(job.chat_id)
+            self._tasks.discard(asyncio.current_task())
+            if not self._closing:
+                self._dispatch()
+
+
+def available_cpus() -> int:
+    """CPUs this process may actually use, honouring cgroup quotas (Docker --cpus)."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        limit, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            limit = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+            period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, max(1, int(quota)))
+    return max(1, cpus)
+
+
+class TranscodePool:
+    """Limits how many CPU-bound ffmpeg processes run at once.
+
+    Downloads are network-bound and are limited by JobScheduler; encodes are
+    CPU-bound and each one is given a fixed share of the cores (``threads``) so
+    concurrent jobs don't thrash the CPU.
+    """
+
+    def __init__(self, workers: int = 0, threads: int = 0, nice: int = 0):
+        cpus = available_cpus()
+        self.workers = workers if workers > 0 else max(1, cpus // 4)
+        self.threads = threads if threads > 0 else max(1, cpus // self.workers)
+        self.nice = nice
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._waiting = 0
+        self._running = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of encodes waiting for a free slot."""
+        return self._waiting
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def wrap_command(self, cmd: List[str]) -> List[str]:
+        """Add the per-job thread limit (an output option) and optional niceness."""
+        cmd = cmd[:-1] + ["-threads", str(self.threads), cmd[-1]]
+        if self.nice:
+            cmd = ["nice", "-n", str(self.nice)] + cmd
+        return cmd
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncGenerator[None, None]:
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._running += 1
+        try:
+            yield
+        finally:
+            self._running -= 1
+            self._semaphore.release()
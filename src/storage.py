@@ -0,0 +1,495 @@
+import os
+import re
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Leftovers of interrupted yt-dlp/ffmpeg runs: partial downloads, per-format
+# fragments before merging, merge temporaries and two-pass logs
+_TEMP_FILE_RE = re.compile(r"(\.part(-Frag\d+)?|\.ytdl|\.temp\.\w+|\.f\d+\.\w+|\.passlog.*)$")
+
+# Jobs work in their own subdirectory of the directory they write to (see JobDir)
+JOB_DIR_PREFIX = ".job-"
+_JOB_LOCK_NAME = ".lock"
+
+
+def _lock_job_dir(directory: Path) -> Optional[int]:
+    """Lock ``directory`` for one job; returns the lock's fd, or None if another job holds it."""
+    lock_path = directory / _JOB_LOCK_NAME
+    try:
+        directory.mkdir(exist_ok=True)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # The previous owner removes the lock file on release: a lock taken on
+        # the old file protects nothing
+        if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+            return fd
+    except OSError:
+        pass
+    os.close(fd)
+    return None
+
+
+class JobDir:
+    """Private working directory of one job, under the directory it writes to.
+
+    The name is derived from ``key`` (profile and link), so retrying a link
+    resumes the partial downloads its last attempt left. While a job runs the
+    directory is locked (flock on its .lock file); a second job for the same
+    key meanwhile gets a directory of its own instead of writing over the
+    first one's files. Files a job keeps are moved out with ``publish``.
+
+    Blocks on filesystem I/O; create and close it from a worker thread.
+    """
+
+    def __init__(self, base: Path, key: str):
+        base = Path(base)
+        base.mkdir(parents=True, exist_ok=True)
+        name = JOB_DIR_PREFIX + hashlib.sha1(key.encode()).hexdigest()[:16]
+        self.path = base / name
+        self._fd = _lock_job_dir(self.path)
+        if self._fd is None:
+            # Nobody else knows this name, so it is private even if it can't be locked
+            self.path = Path(tempfile.mkdtemp(prefix=f"{name}-", dir=base))
+            self._fd = _lock_job_dir(self.path)
+        self.closed = False
+
+    def close(self) -> None:
+        """Release the directory; it is removed unless something (e.g. a .part file) is left in it."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            (self.path / _JOB_LOCK_NAME).unlink()
+        except OSError:
+            pass
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        remove_empty_job_dir(self.path)
+
+
+def _job_dir_locked(directory: Path) -> bool:
+    """Whether a running job holds ``directory`` (see JobDir)."""
+    try:
+        fd = os.open(directory / _JOB_LOCK_NAME, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def remove_empty_job_dir(directory: Path) -> None:
+    """Remove ``directory`` if it is an (unlocked) job directory with nothing left in it."""
+    if Path(directory).name.startswith(JOB_DIR_PREFIX):
+        try:
+            Path(directory).rmdir()
+        except OSError:
+            pass
+
+
+def publish(path: Path, directory: Path) -> Path:
+    """Move a finished file into ``directory`` under its own name, or ``stem-N.ext`` if that is taken.
+
+    An existing file is never replaced: another job may be reading it.
+    Returns the file's new path.
+    """
+    n = 0
+    while True:
+        target = Path(directory) / (path.name if n == 0 else f"{path.stem}-{n}{path.suffix}")
+        try:
+            # Fails instead of replacing, unlike a rename
+            os.link(path, target)
+        except FileExistsError:
+            n += 1
+            continue
+        except OSError:
+            # No hard links here (some network filesystems) or another volume
+            if target.exists():
+                n += 1
+                continue
+            shutil.move(str(path), str(target))
+            return target
+        os.unlink(path)
+        return target
+
+
+class _Entry:
+    __slots__ = ("size", "mtime", "last_used")
+
+    def __init__(self, size: int, mtime: float, last_used: float):
+        self.size = size
+        self.mtime = mtime
+        self.last_used = last_used
+
+
+class DirectoryBudget:
+    """Size limit for one directory tree.
+
+    ``max_bytes`` of 0 means unlimited. ``transient`` directories only hold files
+    of jobs in progress, so anything idle for longer than the orphan age is
+    removed; nothing is ever removed from ``pinned`` directories.
+    """
+
+    def __init__(self, name: str, path: Path, max_bytes: int = 0, transient: bool = False, pinned: bool = False):
+        self.name = name
+        self.path = Path(path)
+        self.max_bytes = max(0, max_bytes)
+        self.transient = transient
+        self.pinned = pinned
+
+
+class StorageManager:
+    """Keeps the download directories within their budgets.
+
+    Sizes and access times are kept in an in-memory index. A refresh only
+    re-lists directories whose mtime changed (files were added, renamed or
+    removed) and re-stats files that are still being written, so periodic sweeps
+    don't walk the whole tree. ``record_file`` adds a finished file without
+    re-listing its directory. ``touch`` records reads, which don't show up in
+    mtimes, for LRU eviction. Files in the download cache index (see
+    ``seed_access_times``) are never taken for orphans.
+
+    Nothing in the directory of a running job (see JobDir) is ever removed,
+    however long it has been idle (e.g. waiting for a transcode slot); what a
+    job that is gone left in its directory is swept after the orphan age.
+
+    All methods block on filesystem I/O; call them from a worker thread.
+    """
+
+    def __init__(
+        self,
+        budgets: Iterable[DirectoryBudget],
+        orphan_age: float = 3600,
+        min_free_bytes: int = 0,
+    ):
+        self.budgets: List[DirectoryBudget] = list(budgets)
+        self.orphan_age = orphan_age
+        self.min_free_bytes = max(0, min_free_bytes)
+        self._files: Dict[Path, _Entry] = {}
+        self._dirs: Dict[Path, Tuple[int, List[Path]]] = {}
+        # Directories whose mtime record_file accepted without listing them
+        self._stale_dirs: Set[Path] = set()
+        self._indexed: Set[Path] = set()
+        self._lock = threading.Lock()
+        # Bytes per budget name as of the last refresh/sweep, readable without the lock
+        self.last_usage: Dict[str, int] = {}
+
+    def budget_for(self, path: Path) -> Optional[DirectoryBudget]:
+        path = Path(path)
+        for budget in self.budgets:
+            if path == budget.path or budget.path in path.parents:
+                return budget
+        return None
+
+    def usage(self, budget: DirectoryBudget) -> int:
+        """Indexed bytes under ``budget`` (as of the last refresh)."""
+        with self._lock:
+            return self._usage(budget)
+
+    def _usage(self, budget: DirectoryBudget) -> int:
+        return sum(e.size for p, e in self._files.items() if self.budget_for(p) is budget)
+
+    def _snapshot(self) -> None:
+        self.last_usage = {budget.name: self._usage(budget) for budget in self.budgets}
+
+    def touch(self, path: Path, when: Optional[float] = None) -> None:
+        """Record that ``path`` was used (e.g. a cached copy was re-sent)."""
+        with self._lock:
+            entry = self._files.get(Path(path))
+            if entry is not None:
+                entry.last_used = max(entry.last_used, when or time.time())
+
+    def seed_access_times(self, last_used: Dict[str, float]) -> None:
+        """Restore access times persisted elsewhere (the download cache index).
+
+        ``last_used`` covers every indexed file; they are kept out of orphan sweeps.
+        """
+        with self._lock:
+            self._indexed = {Path(path) for path in last_used}
+        for path, when in last_used.items():
+            self.touch(Path(path), when)
+
+    def record_file(self, path: Path) -> None:
+        """Add a file a job just finished and indexed, without re-listing its directory.
+
+        The directory's new mtime is taken as seen; anything else that changed
+        there meanwhile shows up at the next ``sweep``, which re-lists it.
+        """
+        path = Path(path)
+        with self._lock:
+            try:
+                st = path.stat()
+                dir_mtime_ns = os.stat(path.parent).st_mtime_ns
+            except OSError:
+                return
+            self._files[path] = _Entry(st.st_size, st.st_mtime, time.time())
+            self._indexed.add(path)
+            known = self._dirs.get(path.parent)
+            if known is not None:
+                self._dirs[path.parent] = (dir_mtime_ns, known[1])
+                self._stale_dirs.add(path.parent)
+            self._snapshot()
+
+    def refresh(self, budget: Optional[DirectoryBudget] = None) -> None:
+        """Update the index for ``budget`` (default: every budget)."""
+        with self._lock:
+            for refreshed in [budget] if budget is not None else self.budgets:
+                self._refresh_tree(refreshed.path)
+            # Files still being written grow without changing their directory
+            cutoff = time.time() - self.orphan_age
+            for path, entry in list(self._files.items()):
+                if entry.mtime >= cutoff and (budget is None or self.budget_for(path) is budget):
+                    self._stat_file(path)
+            self._snapshot()
+
+    def _refresh_tree(self, root: Path) -> None:
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._forget_tree(directory)
+                continue
+            known = self._dirs.get(directory)
+            if known is not None and known[0] == mtime_ns:
+                stack.extend(known[1])
+                continue
+            stack.extend(self._scan_dir(directory, mtime_ns))
+
+    def _scan_dir(self, directory: Path, mtime_ns: int) -> List[Path]:
+        subdirs: List[Path] = []
+        seen = set()
+        try:
+            with os.scandir(directory) as entries:
+                for item in entries:
+                    path = Path(item.path)
+                    try:
+                        if item.is_dir(follow_symlinks=False):
+                            subdirs.append(path)
+                        elif item.is_file(follow_symlinks=False):
+                            seen.add(path)
+                            st = item.stat(follow_symlinks=False)
+                            entry = self._files.get(path)
+                            if entry is None:
+                                self._files[path] = _Entry(st.st_size, st.st_mtime, st.st_mtime)
+                            else:
+                                entry.size, entry.mtime = st.st_size, st.st_mtime
+                                entry.last_used = max(entry.last_used, st.st_mtime)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Could not scan {directory}: {e}")
+            return []
+
+        for path in [p for p in self._files if p.parent == directory and p not in seen]:
+            del self._files[path]
+        for path in [d for d in self._dirs if d.parent == directory and d not in subdirs]:
+            self._forget_tree(path)
+        self._dirs[directory] = (mtime_ns, subdirs)
+        return subdirs
+
+    def _forget_tree(self, directory: Path) -> None:
+        for path in [p for p in self._files if directory in p.parents]:
+            del self._files[path]
+        for path in [d for d in self._dirs if d == directory or directory in d.parents]:
+            del self._dirs[path]
+
+    def _stat_file(self, path: Path) -> None:
+        try:
+            st = path.stat()
+        except OSError:
+            self._files.pop(path, None)
+            return
+        entry = self._files[path]
+        entry.size, entry.mtime = st.st_size, st.st_mtime
+        entry.last_used = max(entry.last_used, st.st_mtime)
+
+    def _remove(self, path: Path) -> int:
+        entry = self._files.pop(path, None)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {e}")
+            return 0
+        return entry.size if entry else 0
+
+    def _job_dir(self, path: Path, budget: DirectoryBudget) -> Optional[Path]:
+        """The job directory ``path`` is in, if any."""
+        for parent in path.parents:
+            if parent == budget.path:
+                return None
+            if parent.name.startswith(JOB_DIR_PREFIX):
+                return parent
+        return None
+
+    def _held(self, path: Path, budget: DirectoryBudget, locked: Dict[Path, bool]) -> bool:
+        """Whether ``path`` belongs to a running job; ``locked`` caches the lock checks of one pass."""
+        job_dir = self._job_dir(path, budget)
+        if job_dir is None:
+            return False
+        if job_dir not in locked:
+            locked[job_dir] = _job_dir_locked(job_dir)
+        return locked[job_dir]
+
+    def _is_orphan(self, path: Path, entry: _Entry, budget: DirectoryBudget, now: float) -> bool:
+        if path in self._indexed or now - entry.mtime < self.orphan_age:
+            return False
+        if self._job_dir(path, budget) is not None:
+            # Left by a job that is gone (running ones are skipped by the
+            # caller); job directories never hold saved videos, pinned or not
+            return True
+        if budget.pinned:
+            return False
+        # Transient directories cover "<name>_tg.mp4" left by a failed transcode;
+        # elsewhere such a name can be a saved video
+        return budget.transient or bool(_TEMP_FILE_RE.search(path.name))
+
+    def sweep_orphans(self) -> Tuple[int, int]:
+        """Remove idle leftovers of failed jobs. Returns (files, bytes) removed."""
+        now = time.time()
+        removed = freed = 0
+        locked: Dict[Path, bool] = {}
+        with self._lock:
+            for path, entry in list(self._files.items()):
+                budget = self.budget_for(path)
+                if budget is None or not self._is_orphan(path, entry, budget, now):
+                    continue
+                if self._held(path, budget, locked):
+                    continue
+                freed += self._remove(path)
+                removed += 1
+            for directory in list(self._dirs):
+                if directory.name.startswith(JOB_DIR_PREFIX) and not locked.get(directory):
+                    remove_empty_job_dir(directory)
+        return removed, freed
+
+    def _evict(self, budget: DirectoryBudget, bytes_to_free: int) -> Tuple[int, int]:
+        """Remove least recently used idle files of ``budget`` until ``bytes_to_free`` are gone."""
+        if budget.pinned or bytes_to_free <= 0:
+            return 0, 0
+        # A file written or reused within the orphan age may be in a running
+        # job's hands (e.g. a cached copy being uploaded)
+        cutoff = time.time() - self.orphan_age
+        candidates = sorted(
+            (
+                (entry.last_used, path)
+                for path, entry in self._files.items()
+                if entry.last_used < cutoff and self.budget_for(path) is budget
+            ),
+        )
+        removed = freed = 0
+        locked: Dict[Path, bool] = {}
+        for _, path in candidates:
+            if freed >= bytes_to_free:
+                break
+            if self._held(path, budget, locked):
+                continue
+            size = self._remove(path)
+            if size:
+                removed += 1
+                freed += size
+                logger.info("storage_evicted dir=%s file=%s size=%s", budget.name, path.name, size)
+        return removed, freed
+
+    def enforce_budgets(self, reserve: Optional[DirectoryBudget] = None, reserve_bytes: int = 0) -> Tuple[int, int]:
+        """Evict down to every budget (leaving ``reserve_bytes`` free in ``reserve``)."""
+        removed = freed = 0
+        with self._lock:
+            for budget in self.budgets:
+                if not budget.max_bytes:
+                    continue
+                extra = reserve_bytes if budget is reserve else 0
+                count, size = self._evict(budget, self._usage(budget) + extra - budget.max_bytes)
+                removed += count
+                freed += size
+        return removed, freed
+
+    def sweep(self) -> Tuple[int, int]:
+        """Periodic maintenance: refresh the index, drop orphans, enforce budgets."""
+        with self._lock:
+            # Re-list what record_file skipped
+            for directory in self._stale_dirs:
+                self._dirs.pop(directory, None)
+            self._stale_dirs.clear()
+        self.refresh()
+        orphans, orphan_bytes = self.sweep_orphans()
+        evicted, evicted_bytes = self.enforce_budgets()
+        with self._lock:
+            self._snapshot()
+        return orphans + evicted, orphan_bytes + evicted_bytes
+
+    def _free_bytes(self, path: Path) -> int:
+        try:
+            return shutil.disk_usage(path).free
+        except OSError:
+            return 0
+
+    def _fits(self, directory: Path, budget: Optional[DirectoryBudget], needed_bytes: int) -> bool:
+        if budget is not None and budget.max_bytes and self.usage(budget) + needed_bytes > budget.max_bytes:
+            return False
+        return self._free_bytes(directory) - needed_bytes >= self.min_free_bytes
+
+    def has_room(self, directory: Path, needed_bytes: int) -> bool:
+        """Like ensure_room, but never deletes anything to make the room."""
+        budget = self.budget_for(directory)
+        if budget is not None and budget.max_bytes:
+            self.refresh(budget)
+        return self._fits(directory, budget, needed_bytes)
+
+    def ensure_room(self, directory: Path, needed_bytes: int) -> bool:
+        """Make room for a new job writing up to ``needed_bytes`` into ``directory``.
+
+        Cleans up orphans and evicts as allowed; returns False when the budget
+        or the volume's free space (minus the configured reserve) can't fit it.
+        """
+        budget = self.budget_for(directory)
+        if budget is not None and budget.max_bytes:
+            # Only the usage of the target budget matters here
+            self.refresh(budget)
+
+        def fits() -> bool:
+            return self._fits(directory, budget, needed_bytes)
+
+        if fits():
+            return True
+
+        self.sweep_orphans()
+        self.enforce_budgets(budget, needed_bytes)
+        shortfall = self.min_free_bytes + needed_bytes - self._free_bytes(directory)
+        if shortfall > 0:
+            # Low on disk: evict from any budget that shares the volume
+            try:
+                device = os.stat(directory).st_dev
+            except OSError:
+                device = None
+            with self._lock:
+                for other in self.budgets:
+                    if shortfall <= 0:
+                        break
+                    try:
+                        same_volume = os.stat(other.path).st_dev == device
+                    except OSError:
+                        same_volume = False
+                    if same_volume:
+                        shortfall -= self._evict(other, shortfall)[1]
+        return fits()
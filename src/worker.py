@@ -0,0 +1,209 @@
+"""Download worker: runs the jobs the bot puts in the durable queue.
+
+Start the bot with JOB_QUEUE_BACKEND set (e.g. "sqlite") and run any number of
+these processes against the same database and download volumes:
+
+    python src/worker.py
+"""
+import os
+import socket
+import signal
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from telegram import Bot, Chat, Message
+from telegram.error import TelegramError
+
+from bot import (
+    TOKEN, TELEGRAM_API_BASE_URL, TELEGRAM_LOCAL_MODE, MAX_CONCURRENT_JOBS, MAX_JOBS_PER_CHAT,
+    JOB_QUEUE_BACKEND, JOB_MAX_ATTEMPTS, METRICS_HOST, METRICS_PORT, process_request, telegram_api_options
+)
+from db_manager import init_db, event_writer, close_db, db, JOB_FAILURE_OUTCOMES
+from downloader import shutdown_download_engine
+from jobqueue import JobQueue, create_job_queue
+from metrics import MetricsServer
+from models import QueueJob
+
+logger = logging.getLogger("worker")
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", str(MAX_CONCURRENT_JOBS)))
+# Leases are renewed every third of this; a crashed worker's job is retried after it
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "2"))
+# Finished jobs are kept this long in the queue table
+JOB_QUEUE_RETENTION_HOURS = float(os.getenv("JOB_QUEUE_RETENTION_HOURS", "72"))
+
+
+class Worker:
+    def __init__(self, queue: JobQueue, bot: Bot, concurrency: int, worker_id: str):
+        self.queue = queue
+        self.bot = bot
+        self.worker_id = worker_id
+        self.concurrency = max(1, concurrency)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self._last_purge = datetime.min
+        self._last_expiry_check = datetime.min
+
+    async def run(self, stop: asyncio.Event) -> None:
+        """Claim and process jobs until ``stop`` is set, then wait for running ones."""
+        logger.info("worker_started worker_id=%s concurrency=%s", self.worker_id, self.concurrency)
+        while not stop.is_set():
+            await self._slots.acquire()
+            await self._fail_expired()
+            try:
+                job = await self.queue.claim(self.worker_id, JOB_LEASE_SECONDS)
+            except Exception as e:
+                logger.warning(f"Could not claim a job: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                await self._purge_finished()
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=WORKER_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._process(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._job_done)
+
+        if self._tasks:
+            logger.info("worker_draining running_jobs=%s", len(self._tasks))
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _job_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def _process(self, job: QueueJob) -> None:
+        logger.info(
+            "job_claimed job_id=%s chat_id=%s action=%s attempt=%s worker_id=%s",
+            job.id,
+            job.chat_id,
+            job.action,
+            job.attempts,
+            self.worker_id,
+        )
+        # Only the ids matter for editing/deleting the status message
+        message = Message(job.message_id, datetime.now(), Chat(job.chat_id, Chat.PRIVATE))
+        message.set_bot(self.bot)
+
+        work = asyncio.create_task(
+            process_request(self.bot, job.chat_id, job.username, job.action, job.url.splitlines(), message)
+        )
+        lease_lost = asyncio.Event()
+        heartbeat = asyncio.create_task(self._keep_lease(job, work, lease_lost))
+        error = None
+        try:
+            outcome = await work
+            if outcome in JOB_FAILURE_OUTCOMES:
+                error = outcome
+        except asyncio.CancelledError:
+            if not lease_lost.is_set():
+                raise
+            # Another worker owns the job now: stop before sending it twice, report nothing
+            logger.warning("job_abandoned job_id=%s worker_id=%s", job.id, self.worker_id)
+            return
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Unhandled error in job {job.id}: {e}")
+        finally:
+            heartbeat.cancel()
+            work.cancel()
+            # Cancelling stops the job's yt-dlp thread or process and ffmpeg;
+            # wait for that so a retry never races this worker for the files
+            await asyncio.gather(work, return_exceptions=True)
+        try:
+            await self.queue.finish(job.id, self.worker_id, error)
+        except Exception as e:
+            logger.warning(f"Could not report job {job.id}: {e}")
+
+    async def _keep_lease(self, job: QueueJob, work: asyncio.Task, lease_lost: asyncio.Event) -> None:
+        """Renew the job's lease until cancelled; cancel ``work`` if the lease is lost."""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                if not await self.queue.renew(job.id, self.worker_id, JOB_LEASE_SECONDS):
+                    logger.warning("job_lease_lost job_id=%s worker_id=%s", job.id, self.worker_id)
+                    lease_lost.set()
+                    work.cancel()
+                    return
+            except Exception as e:
+                logger.warning(f"Could not renew lease of job {job.id}: {e}")
+
+    async def _fail_expired(self) -> None:
+        """Fail jobs whose workers kept dying and tell their users."""
+        if datetime.utcnow() - self._last_expiry_check < timedelta(seconds=WORKER_POLL_SECONDS):
+            return
+        self._last_expiry_check = datetime.utcnow()
+        try:
+            expired = await self.queue.fail_expired()
+        except Exception as e:
+            logger.warning(f"Could not fail expired jobs: {e}")
+            return
+        for job in expired:
+            logger.warning("job_failed_lease_expired job_id=%s chat_id=%s attempts=%s", job.id, job.chat_id, job.attempts)
+            try:
+                await self.bot.edit_message_text(
+                    "❌ No se pudo completar el trabajo: se interrumpió varias veces.\n"
+                    "Por favor, envía el enlace de nuevo.",
+                    chat_id=job.chat_id,
+                    message_id=job.message_id,
+                )
+            except TelegramError as e:
+                logger.warning(f"Could not notify chat {job.chat_id} about job {job.id}: {e}")
+
+    async def _purge_finished(self) -> None:
+        if datetime.utcnow() - self._last_purge < timedelta(hours=1):
+            return
+        self._last_purge = datetime.utcnow()
+        try:
+            removed = await self.queue.purge(datetime.utcnow() - timedelta(hours=JOB_QUEUE_RETENTION_HOURS))
+            if removed:
+                logger.info("job_queue_purged removed=%s", removed)
+        except Exception as e:
+            logger.warning(f"Could not purge finished jobs: {e}")
+
+
+async def main() -> None:
+    if TELEGRAM_LOCAL_MODE and not TELEGRAM_API_BASE_URL:
+        logger.error("TELEGRAM_LOCAL_MODE needs TELEGRAM_API_BASE_URL (the local Bot API server)")
+        return
+    await init_db()
+    event_writer.start()
+
+    queue = create_job_queue(
+        JOB_QUEUE_BACKEND or "sqlite", db, max_attempts=JOB_MAX_ATTEMPTS, per_chat_limit=MAX_JOBS_PER_CHAT
+    )
+    bot = Bot(TOKEN, **telegram_api_options())
+    worker = Worker(queue, bot, WORKER_CONCURRENCY, f"{socket.gethostname()}-{os.getpid()}")
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+
+    try:
+        await bot.initialize()
+        if metrics_server is not None:
+            await metrics_server.start()
+        await worker.run(stop)
+    finally:
+        logger.info("Worker shutting down...")
+        if metrics_server is not None:
+            await metrics_server.stop()
+        shutdown_download_engine()
+        await bot.shutdown()
+        await close_db()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Worker stopped by user")
+    except Exception as e:
+        logger.error(f"Fatal error: {e}")
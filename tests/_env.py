@@ -0,0 +1,17 @@
+"""Test environment shared by every test module; import it before any src module.
+
+The bot modules read their configuration when imported, so the variables are
+set here, pointing at throwaway directories. Run the tests from the repository
+root with ``python -m unittest discover tests``.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+_tmp = tempfile.mkdtemp(prefix="mediabot-test-")
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("DOWNLOAD_DIR", os.path.join(_tmp, "downloads"))
+os.environ.setdefault("SAVED_VIDEOS_DIR", os.path.join(_tmp, "saved"))
+os.environ.setdefault("DB_PATH", os.path.join(_tmp, "users.db"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
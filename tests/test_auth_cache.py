@@ -0,0 +1,75 @@
+"""In-memory cache of authorized users and super admins."""
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import delete
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import db_manager
+from db_manager import add_authorized_user, db, init_db, is_super_admin, is_user_authorized
+from models import AuthorizedUser
+
+
+class AuthCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        async with db.session() as session:
+            await session.execute(delete(AuthorizedUser))
+            await session.commit()
+        await db_manager._load_auth_cache()
+        self._ttl = db_manager.AUTH_CACHE_TTL
+
+    async def asyncTearDown(self):
+        db_manager.AUTH_CACHE_TTL = self._ttl
+
+    async def _revoke_behind_the_cache(self, chat_id):
+        """Change the table the way another process would, without touching the cache."""
+        async with db.session() as session:
+            await session.execute(delete(AuthorizedUser).where(AuthorizedUser.chat_id == chat_id))
+            await session.commit()
+
+    async def test_add_authorized_user_writes_through(self):
+        self.assertFalse(await is_user_authorized(10))
+
+        await add_authorized_user(10, "alice")
+        await add_authorized_user(11, "root", is_super_admin=True)
+
+        self.assertTrue(await is_user_authorized(10))
+        self.assertFalse(await is_super_admin(10))
+        self.assertTrue(await is_super_admin(11))
+
+    async def test_demoting_a_super_admin_updates_the_cache(self):
+        await add_authorized_user(11, "root", is_super_admin=True)
+
+        await add_authorized_user(11, "root", is_super_admin=False)
+
+        self.assertTrue(await is_user_authorized(11))
+        self.assertFalse(await is_super_admin(11))
+
+    async def test_without_ttl_the_cache_is_never_reloaded(self):
+        db_manager.AUTH_CACHE_TTL = 0
+        await add_authorized_user(12, "bob")
+        await self._revoke_behind_the_cache(12)
+
+        with mock.patch.object(db_manager.time, "monotonic", return_value=time.monotonic() + 10 ** 6):
+            self.assertTrue(await is_user_authorized(12))
+
+    async def test_ttl_reloads_changes_made_elsewhere(self):
+        db_manager.AUTH_CACHE_TTL = 30
+        await add_authorized_user(12, "bob")
+        await self._revoke_behind_the_cache(12)
+        async with db.session() as session:
+            session.add(AuthorizedUser(chat_id=13, is_super_admin=True))
+            await session.commit()
+
+        self.assertTrue(await is_user_authorized(12))
+        self.assertFalse(await is_super_admin(13))
+
+        with mock.patch.object(db_manager.time, "monotonic", return_value=time.monotonic() + 31):
+            self.assertFalse(await is_user_authorized(12))
+            self.assertTrue(await is_super_admin(13))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Cancelling a job stops the download it started."""
+import asyncio
+import http.server
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import downloader
+
+
+class _SlowVideo(http.server.BaseHTTPRequestHandler):
+    """Serves a large "video" a few KB at a time."""
+
+    size = 50 * 1024 * 1024
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(self.size))
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+        try:
+            for _ in range(self.size // 8192):
+                self.wfile.write(b"\0" * 8192)
+                time.sleep(0.01)
+        except OSError:
+            pass
+
+
+class InProcessCancelTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SlowVideo)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    async def test_cancelled_download_stops_writing(self):
+        output_dir = Path(self.tmp.name)
+        url = f"http://127.0.0.1:{self.server.server_port}/clip.mp4"
+        loop, started = asyncio.get_running_loop(), asyncio.Event()
+        task = asyncio.create_task(
+            downloader._download_with_api(
+                url,
+                downloader._output_template(output_dir),
+                "best",
+                lambda fraction, eta: loop.call_soon_threadsafe(started.set),
+            )
+        )
+        await asyncio.wait_for(started.wait(), timeout=30)
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        sizes = [path.stat().st_size for path in output_dir.iterdir()]
+        await asyncio.sleep(0.5)
+
+        self.assertEqual([path.stat().st_size for path in output_dir.iterdir()], sizes)
+        self.assertEqual(downloader.active_processes["yt-dlp"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+"""Choice of the SQLite journal mode for the database's filesystem."""
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import db_manager
+
+_MOUNTS = """\
+/dev/sda1 / ext4 rw,relatime 0 0
+server:/export /data nfs4 rw,relatime 0 0
+/dev/sdb1 /data/db ext4 rw,relatime 0 0
+//nas/share /mnt/my\\040share cifs rw 0 0
+"""
+
+
+class JournalModeTest(unittest.TestCase):
+    def test_filesystem_of_the_deepest_mount(self):
+        cases = [
+            ("/data/db", "ext4"),
+            ("/data/downloads", "nfs4"),
+            ("/database", "ext4"),
+            ("/mnt/my share/db", "cifs"),
+        ]
+        with mock.patch("builtins.open", mock.mock_open(read_data=_MOUNTS)):
+            for path, expected in cases:
+                with self.subTest(path=path):
+                    self.assertEqual(db_manager._filesystem_type(Path(path)), expected)
+
+    def test_default_is_wal_only_on_local_disks(self):
+        # (requested, filesystem, expected)
+        cases = [
+            ("", "ext4", "WAL"),
+            ("", None, "WAL"),
+            ("", "nfs4", "DELETE"),
+            ("", "cifs", "DELETE"),
+            ("WAL", "nfs", "WAL"),
+            ("truncate", "ext4", "truncate"),
+        ]
+        for requested, fstype, expected in cases:
+            with self.subTest(requested=requested, fstype=fstype):
+                with mock.patch.object(db_manager, "_filesystem_type", return_value=fstype):
+                    self.assertEqual(db_manager._journal_mode(requested, Path("/data/db")), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
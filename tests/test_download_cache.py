@@ -0,0 +1,153 @@
+"""The download index: what gets recorded and pruning it."""
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import bot
+import db_manager
+
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+    async def delete(self):
+        pass
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_video(self, chat_id, video, caption=None, **kwargs):
+        self.sent.append(video)
+        return SimpleNamespace(video=None, audio=None)
+
+
+class SaveAndSendCacheHitTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await db_manager.init_db()
+        names = ("download_video", "identify_url", "transcode_to_telegram_mp4", "_cached_file_id")
+        self._saved = {name: getattr(bot, name) for name in names}
+
+        async def identify_url(url):
+            return "Test", "hit"
+
+        async def download_video(url, output_dir, **kwargs):
+            path = Path(output_dir) / "Hit.mp4"
+            path.write_bytes(b"video")
+            return True, "ok", path, {"id": "hit", "extractor": "Test"}
+
+        async def transcode(path, max_size_mb=None, on_progress=None, profile="telegram", output_dir=None):
+            output = (output_dir or path.parent) / f"{path.stem}_tg.mp4"
+            output.write_bytes(b"telegram video")
+            return True, "ok", output
+
+        async def cached_file_id(identities, profile_key):
+            return "cached-file-id"
+
+        bot.identify_url = identify_url
+        bot.download_video = download_video
+        bot.transcode_to_telegram_mp4 = transcode
+        bot._cached_file_id = cached_file_id
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(bot, name, value)
+
+    async def test_saved_copy_is_transcoded_when_the_upload_is_reused(self):
+        stats = {"chat_id": 1, "action": "save_and_send", "outcome": "error"}
+
+        fake_bot = FakeBot()
+        await bot._deliver_video(fake_bot, 1, "tester", "save_and_send", "https://youtu.be/hit", FakeMessage(), stats)
+
+        self.assertEqual(stats["outcome"], "saved_and_sent_cached")
+        self.assertEqual(fake_bot.sent, ["cached-file-id"])
+        profile_key = bot.telegram_profile_key(bot.TELEGRAM_MAX_UPLOAD_MB, "telegram")
+        entry = await db_manager.get_cached_download("Test", "hit", [profile_key])
+        self.assertIsNotNone(entry)
+        # Only the Telegram-friendly copy is kept and indexed under its profile
+        self.assertEqual(Path(entry.path).name, "Hit_tg.mp4")
+        self.assertFalse((bot.SAVED_VIDEOS_DIR / "Hit.mp4").exists())
+
+
+class StaleFileIdTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await db_manager.init_db()
+        names = ("download_video", "identify_url", "transcode_to_telegram_mp4", "STREAM_TRANSCODE")
+        self._saved = {name: getattr(bot, name) for name in names}
+        self.downloads = []
+
+        async def identify_url(url):
+            return "Test", "stale"
+
+        async def download_video(url, output_dir, **kwargs):
+            self.downloads.append(url)
+            path = Path(output_dir) / "Stale.mp4"
+            path.write_bytes(b"video")
+            return True, "ok", path, {"id": "stale", "extractor": "Test"}
+
+        async def transcode(path, max_size_mb=None, on_progress=None, profile="telegram", output_dir=None):
+            return True, "transcode skipped", path
+
+        bot.identify_url = identify_url
+        bot.download_video = download_video
+        bot.transcode_to_telegram_mp4 = transcode
+        bot.STREAM_TRANSCODE = False
+        self.profile_key = bot.telegram_profile_key(bot.TELEGRAM_MAX_UPLOAD_MB, "telegram")
+        await db_manager.cache_file_id("Test", "stale", self.profile_key, "gone-file-id", "u", 5)
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(bot, name, value)
+
+    async def test_rejected_file_id_is_forgotten_and_the_video_uploaded_again(self):
+        class RejectingBot(FakeBot):
+            async def send_video(self, chat_id, video, caption=None, **kwargs):
+                if isinstance(video, str):
+                    raise BadRequest("Wrong file identifier/http url specified")
+                return await super().send_video(chat_id, video, caption)
+
+        fake_bot = RejectingBot()
+        stats = {"chat_id": 1, "action": "send", "outcome": "error"}
+
+        await bot._deliver_video(fake_bot, 1, "tester", "send", "https://youtu.be/stale", FakeMessage(), stats)
+
+        self.assertEqual(stats["outcome"], "sent")
+        self.assertEqual(self.downloads, ["https://youtu.be/stale"])
+        self.assertEqual([Path(video).name for video in fake_bot.sent], ["Stale.mp4"])
+        self.assertIsNone(await db_manager.get_cached_file_id("Test", "stale", self.profile_key))
+        self.assertEqual(list(bot.DOWNLOAD_DIR.rglob("Stale*")), [])
+
+
+class PruneDownloadCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await db_manager.init_db()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_only_missing_or_changed_files_are_dropped(self):
+        kept = self.root / "kept.mp4"
+        kept.write_bytes(b"12345")
+        changed = self.root / "changed.mp4"
+        changed.write_bytes(b"123")
+        await db_manager.record_download("Test", "kept", "tg-720p", str(kept), 5)
+        await db_manager.record_download("Test", "changed", "tg-720p", str(changed), 5)
+        await db_manager.record_download("Test", "gone", "tg-720p", str(self.root / "gone.mp4"), 5)
+
+        self.assertEqual(await db_manager.prune_download_cache(), 2)
+
+        self.assertIsNotNone(await db_manager.get_cached_download("Test", "kept", ["tg-720p"]))
+        self.assertIsNone(await db_manager.get_cached_download("Test", "changed", ["tg-720p"]))
+        self.assertEqual(await db_manager.prune_download_cache(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
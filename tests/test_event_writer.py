@@ -0,0 +1,88 @@
+"""Buffered writes of unauthorized attempts."""
+import asyncio
+import unittest
+
+from sqlalchemy import delete, select
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import db_manager
+from db_manager import UnauthorizedEventWriter, db, init_db
+from models import UnauthorizedEvent
+
+
+async def _rows():
+    async with db.read_session() as session:
+        result = await session.execute(
+            select(UnauthorizedEvent.chat_id, UnauthorizedEvent.command, UnauthorizedEvent.attempts)
+            .order_by(UnauthorizedEvent.chat_id, UnauthorizedEvent.command)
+        )
+        return [tuple(row) for row in result.all()]
+
+
+class UnauthorizedEventWriterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        async with db.session() as session:
+            await session.execute(delete(UnauthorizedEvent))
+            await session.commit()
+
+    async def test_identical_attempts_collapse_into_one_row(self):
+        writer = UnauthorizedEventWriter(max_rows=100, interval=60)
+        for _ in range(3):
+            writer.add(1, "spam", "/start")
+        writer.add(1, "spam", "/help")
+        writer.add(2, None, "/start")
+
+        await writer.flush()
+
+        self.assertEqual(await _rows(), [(1, "/help", 1), (1, "/start", 3), (2, "/start", 1)])
+
+    async def test_flush_fires_at_max_rows_distinct_attempts(self):
+        writer = UnauthorizedEventWriter(max_rows=3, interval=60)
+        writer.add(1, None, "/a")
+        writer.add(1, None, "/a")
+        writer.add(1, None, "/b")
+        self.assertIsNone(writer._flush_task)
+
+        writer.add(1, None, "/c")
+        await asyncio.wait_for(writer._flush_task, timeout=5)
+
+        self.assertEqual(await _rows(), [(1, "/a", 2), (1, "/b", 1), (1, "/c", 1)])
+        self.assertEqual(writer._pending, {})
+
+    async def test_stop_writes_what_is_still_buffered(self):
+        writer = UnauthorizedEventWriter(max_rows=100, interval=60)
+        writer.start()
+        writer.add(5, "late", "/start")
+
+        await writer.stop()
+
+        self.assertIsNone(writer._task)
+        self.assertEqual(await _rows(), [(5, "/start", 1)])
+
+    async def test_close_db_flushes_before_closing(self):
+        await db_manager.log_unauthorized_attempt(6, "bye", "/start")
+        written_before_close = []
+
+        async def close():
+            written_before_close.extend(await _rows())
+
+        db.close = close
+        try:
+            await db_manager.close_db()
+        finally:
+            del db.close
+
+        self.assertEqual(written_before_close, [(6, "/start", 1)])
+
+    async def test_events_listing_flushes_first(self):
+        await db_manager.log_unauthorized_attempt(7, "new", "/start")
+        await db_manager.log_unauthorized_attempt(7, "new", "/start")
+
+        events = await db_manager.get_unauthorized_events()
+
+        self.assertEqual([(event.chat_id, event.attempts) for event in events], [(7, 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""Concurrent jobs for one link keep their files apart."""
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import bot
+from storage import JobDir, publish
+
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+    async def delete(self):
+        self.deleted = True
+
+
+class JobDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_key_gets_a_directory_of_its_own_while_locked(self):
+        first = JobDir(self.base, "telegram https://youtu.be/x")
+        second = JobDir(self.base, "telegram https://youtu.be/x")
+        self.assertNotEqual(first.path, second.path)
+        first.close()
+        second.close()
+
+        # Once released the keyed directory is used again (to resume its .part files)
+        third = JobDir(self.base, "telegram https://youtu.be/x")
+        self.assertEqual(third.path, first.path)
+        third.close()
+        self.assertEqual(list(self.base.iterdir()), [])
+
+    def test_close_keeps_partial_downloads(self):
+        workdir = JobDir(self.base, "best https://youtu.be/x")
+        partial = workdir.path / "Talk-x.mp4.part"
+        partial.write_bytes(b"x")
+
+        workdir.close()
+
+        self.assertTrue(partial.exists())
+        self.assertEqual(JobDir(self.base, "best https://youtu.be/x").path, workdir.path)
+
+    def test_publish_never_replaces_an_existing_file(self):
+        existing = self.base / "Talk-x.mp4"
+        existing.write_bytes(b"in use")
+        finished = self.base / "job"
+        finished.mkdir()
+        (finished / "Talk-x.mp4").write_bytes(b"new")
+
+        target = publish(finished / "Talk-x.mp4", self.base)
+
+        self.assertEqual(target.name, "Talk-x-1.mp4")
+        self.assertEqual(target.read_bytes(), b"new")
+        self.assertEqual(existing.read_bytes(), b"in use")
+        self.assertFalse((finished / "Talk-x.mp4").exists())
+
+
+class ConcurrentJobsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        names = ("download_video", "identify_url", "transcode_to_telegram_mp4", "STREAM_TRANSCODE")
+        self._saved = {name: getattr(bot, name) for name in names}
+
+        async def identify_url(url):
+            return None
+
+        async def download_video(url, output_dir, **kwargs):
+            # yt-dlp names the file after the video only
+            path = Path(output_dir) / "Clip-x.mp4"
+            path.write_bytes(b"video")
+            return True, "ok", path, {"id": "x", "extractor": "Test"}
+
+        async def transcode(path, max_size_mb=None, on_progress=None, profile="telegram", output_dir=None):
+            output = (output_dir or path.parent) / f"{path.stem}_tg.mp4"
+            output.write_bytes(b"telegram video")
+            return True, "transcoded", output
+
+        bot.identify_url = identify_url
+        bot.download_video = download_video
+        bot.transcode_to_telegram_mp4 = transcode
+        bot.STREAM_TRANSCODE = False
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(bot, name, value)
+
+    async def test_two_jobs_for_one_link_run_at_once(self):
+        class SlowBot:
+            """The first upload is still reading its file when the second job ends."""
+
+            def __init__(self):
+                self.uploads = []
+                self.delays = [0.2, 0.0]
+
+            async def send_video(self, chat_id, video, caption=None, **kwargs):
+                await asyncio.sleep(self.delays.pop(0))
+                self.uploads.append((video, Path(video).read_bytes()))
+                return SimpleNamespace(video=None, audio=None)
+
+        fake_bot = SlowBot()
+        stats = [{"chat_id": n, "action": "send", "outcome": "error"} for n in (1, 2)]
+
+        await asyncio.gather(
+            *(
+                bot._deliver_video(fake_bot, n, "tester", "send", "https://youtu.be/x", FakeMessage(), stats[n - 1])
+                for n in (1, 2)
+            )
+        )
+
+        self.assertEqual([s["outcome"] for s in stats], ["sent", "sent"])
+        self.assertEqual([content for _, content in fake_bot.uploads], [b"telegram video"] * 2)
+        self.assertNotEqual(fake_bot.uploads[0][0], fake_bot.uploads[1][0])
+        self.assertEqual(list(bot.DOWNLOAD_DIR.rglob("Clip-x*")), [])
+
+    async def test_two_saves_of_one_link_keep_both_files(self):
+        stats = [{"chat_id": n, "action": "save", "outcome": "error"} for n in (1, 2)]
+
+        await asyncio.gather(
+            *(
+                bot._deliver_video(None, n, "tester", "save", "https://youtu.be/x", FakeMessage(), stats[n - 1])
+                for n in (1, 2)
+            )
+        )
+
+        saved = sorted(path.name for path in bot.SAVED_VIDEOS_DIR.glob("Clip-x*"))
+        self.assertEqual(saved, ["Clip-x-1.mp4", "Clip-x.mp4"])
+        self.assertEqual(list(bot.SAVED_VIDEOS_DIR.glob(".job-*")), [])
+        for path in bot.SAVED_VIDEOS_DIR.glob("Clip-x*"):
+            path.unlink()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+"""Progress lines read from ffmpeg and yt-dlp subprocesses."""
+import sys
+import unittest
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import downloader
+
+_FFMPEG_OUTPUT = r"""
+import sys
+print("frame=25\nfps=0.00\nstream_0_0_q=28.0\nbitrate=N/A\ntotal_size=48\nout_time_us=500000")
+print("out_time_ms=500000\nout_time=00:00:00.500000\ndup_frames=0\ndrop_frames=0\nspeed=1x\nprogress=continue")
+print("crf=bad", file=sys.stderr)
+print("[aac] Error=-22", file=sys.stderr)
+"""
+
+
+class FfmpegProgressTest(unittest.IsolatedAsyncioTestCase):
+    async def test_only_progress_keys_are_consumed(self):
+        reports = []
+        parser = downloader._ffmpeg_progress_parser(1.0, lambda fraction, eta: reports.append(fraction))
+
+        returncode, stdout, stderr = await downloader._run_streaming([sys.executable, "-c", _FFMPEG_OUTPUT], parser)
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, [])
+        self.assertEqual(stderr, ["crf=bad", "[aac] Error=-22"])
+        self.assertEqual(reports, [0.5, 0.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
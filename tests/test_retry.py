@@ -0,0 +1,109 @@
+"""Failure classification, backoff jitter and per-host cool-downs of retry."""
+import time
+import unittest
+from unittest import mock
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import retry
+from retry import PERMANENT, TRANSIENT, UNKNOWN, HostCooldowns, backoff_delay, classify_failure, host_key
+
+_CLASSIFIED = [
+    ("ERROR: [youtube] abc: Private video. Sign in if you've been granted access", PERMANENT),
+    ("ERROR: [youtube] abc: Video unavailable", PERMANENT),
+    ("ERROR: The uploader has not made this video available in your country", PERMANENT),
+    ("ERROR: [youtube] abc: This video is not available in your country", PERMANENT),
+    ("ERROR: [BBC] abc: geo restricted content", PERMANENT),
+    ("ERROR: Unsupported URL: https://example.com/", PERMANENT),
+    ("ERROR: Requested format is not available", PERMANENT),
+    ("ERROR: Unable to download webpage: HTTP Error 404: Not Found", PERMANENT),
+    ("ERROR: Unable to download webpage: HTTP Error 403: Forbidden", PERMANENT),
+    ("URL no válida o dominio no soportado", PERMANENT),
+    ("ERROR: Unable to download webpage: HTTP Error 429: Too Many Requests", TRANSIENT),
+    ("ERROR: rate-limit reached, try again later", TRANSIENT),
+    ("ERROR: Unable to download video data: HTTP Error 503: Service Unavailable", TRANSIENT),
+    ("ERROR: HTTP Error 500: Internal Server Error", TRANSIENT),
+    ("ERROR: [Errno 104] Connection reset by peer", TRANSIENT),
+    ("ERROR: The read operation timed out", TRANSIENT),
+    ("ERROR: [Errno -3] Temporary failure in name resolution", TRANSIENT),
+    ("ERROR: Did not get any data blocks", TRANSIENT),
+    ("ERROR: giving up after 10 retries", TRANSIENT),
+    # A permanent pattern wins over a transient one in the same message
+    ("ERROR: Private video (HTTP Error 503 while checking)", PERMANENT),
+    ("ERROR: Something odd happened", UNKNOWN),
+    ("", UNKNOWN),
+    (None, UNKNOWN),
+]
+
+
+class ClassifyFailureTest(unittest.TestCase):
+    def test_messages(self):
+        for message, expected in _CLASSIFIED:
+            with self.subTest(message=message):
+                self.assertEqual(classify_failure(message), expected)
+
+
+class BackoffDelayTest(unittest.TestCase):
+    def test_jitter_stays_within_the_exponential_bound(self):
+        # (attempt, base, cap, upper bound)
+        cases = [
+            (1, 2.0, 60.0, 2.0),
+            (2, 2.0, 60.0, 4.0),
+            (3, 2.0, 60.0, 8.0),
+            (6, 2.0, 60.0, 60.0),
+            (20, 2.0, 60.0, 60.0),
+            (1, 0.0, 60.0, 0.0),
+        ]
+        for attempt, base, cap, bound in cases:
+            with self.subTest(attempt=attempt, base=base, cap=cap):
+                delays = [backoff_delay(attempt, base, cap) for _ in range(200)]
+                self.assertTrue(all(0 <= delay <= bound for delay in delays))
+
+    def test_full_jitter_reaches_both_ends(self):
+        for value, expected in ((0.0, 0.0), (1.0, 8.0)):
+            with self.subTest(value=value):
+                with mock.patch.object(retry.random, "uniform", lambda low, high: low + (high - low) * value):
+                    self.assertEqual(backoff_delay(3, 2.0, 60.0), expected)
+
+
+class HostCooldownsTest(unittest.TestCase):
+    def test_host_key_drops_mobile_prefixes(self):
+        cases = [
+            ("https://www.youtube.com/watch?v=x", "youtube.com"),
+            ("https://m.youtube.com/watch?v=x", "youtube.com"),
+            ("https://mobile.twitter.com/a/status/1", "twitter.com"),
+            ("https://VM.TikTok.com/abc", "vm.tiktok.com"),
+            ("not a url", ""),
+        ]
+        for url, expected in cases:
+            with self.subTest(url=url):
+                self.assertEqual(host_key(url), expected)
+
+    def test_cool_down_keeps_the_latest_deadline(self):
+        cooldowns = HostCooldowns()
+        cooldowns.cool_down("youtube.com", 30)
+        cooldowns.cool_down("youtube.com", 5)
+
+        self.assertGreater(cooldowns.remaining("youtube.com"), 25)
+        self.assertEqual(cooldowns.remaining("vimeo.com"), 0.0)
+
+    def test_expired_cool_down_is_forgotten(self):
+        cooldowns = HostCooldowns()
+        cooldowns.cool_down("youtube.com", 30)
+        with mock.patch.object(retry.time, "monotonic", return_value=time.monotonic() + 31):
+            self.assertEqual(cooldowns.remaining("youtube.com"), 0.0)
+        self.assertNotIn("youtube.com", cooldowns._until)
+
+
+class HostCooldownsWaitTest(unittest.IsolatedAsyncioTestCase):
+    async def test_wait_is_capped_by_max_wait(self):
+        cooldowns = HostCooldowns()
+        cooldowns.cool_down("youtube.com", 30)
+
+        started = time.monotonic()
+        await cooldowns.wait("youtube.com", max_wait=0.05)
+
+        self.assertLess(time.monotonic() - started, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Round-robin dispatch, per-chat limits and queue positions of JobScheduler."""
+import asyncio
+import unittest
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+from scheduler import JobScheduler
+
+
+class Jobs:
+    """Jobs that block until released, recording the order they started in."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.started = []
+        self.positions = {}
+        self.dropped = []
+        self._gates = {}
+
+    def submit(self, chat_id, name):
+        gate = self._gates[name] = asyncio.Event()
+
+        async def run():
+            self.started.append(name)
+            await gate.wait()
+
+        async def on_position(position):
+            self.positions.setdefault(name, []).append(position)
+
+        async def on_drop():
+            self.dropped.append(name)
+
+        return self.scheduler.submit(chat_id, run, on_position, on_drop)
+
+    async def finish(self, name):
+        self._gates[name].set()
+        await _settle()
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def _queued(scheduler):
+    return [(job.chat_id, job.position) for job in scheduler._dispatch_order()]
+
+
+class JobSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        for task in asyncio.all_tasks() - {asyncio.current_task()}:
+            task.cancel()
+        await _settle()
+
+    async def test_chats_take_turns_instead_of_first_come_first_served(self):
+        scheduler = JobScheduler(max_workers=1, per_chat_limit=1)
+        jobs = Jobs(scheduler)
+        jobs.submit(1, "a1")
+        for name in ("a2", "a3"):
+            jobs.submit(1, name)
+        jobs.submit(2, "b1")
+        jobs.submit(3, "c1")
+        await _settle()
+
+        for name in ("a1", "a2", "b1", "c1"):
+            await jobs.finish(name)
+
+        self.assertEqual(jobs.started, ["a1", "a2", "b1", "c1", "a3"])
+
+    async def test_per_chat_limit_leaves_slots_to_other_chats(self):
+        scheduler = JobScheduler(max_workers=3, per_chat_limit=1)
+        jobs = Jobs(scheduler)
+        self.assertEqual(jobs.submit(1, "a1"), 0)
+        self.assertEqual(jobs.submit(1, "a2"), 1)
+        self.assertEqual(jobs.submit(2, "b1"), 0)
+        await _settle()
+
+        self.assertEqual(jobs.started, ["a1", "b1"])
+        self.assertEqual(scheduler.in_flight, 2)
+
+        await jobs.finish("a1")
+        self.assertEqual(jobs.started, ["a1", "b1", "a2"])
+
+    async def test_positions_follow_the_per_chat_limit(self):
+        scheduler = JobScheduler(max_workers=2, per_chat_limit=1)
+        jobs = Jobs(scheduler)
+        jobs.submit(2, "b1")
+        jobs.submit(1, "a1")
+        jobs.submit(1, "a2")
+        jobs.submit(1, "a3")
+        jobs.submit(3, "c1")
+        await _settle()
+
+        # Chat 1 comes first in the rotation, but it is at its limit until a1
+        # ends, so the slot b1 frees goes to c1
+        self.assertEqual(_queued(scheduler), [(3, 1), (1, 2), (1, 3)])
+        self.assertEqual(jobs.positions, {"a2": [2], "a3": [3], "c1": [1]})
+
+        await jobs.finish("b1")
+        self.assertEqual(jobs.started, ["b1", "a1", "c1"])
+        self.assertEqual(_queued(scheduler), [(1, 1), (1, 2)])
+
+        await jobs.finish("a1")
+        self.assertEqual(jobs.started, ["b1", "a1", "c1", "a2"])
+        self.assertEqual(jobs.positions, {"a2": [2, 1], "a3": [3, 2, 1], "c1": [1]})
+
+    async def test_no_position_edit_once_the_job_started(self):
+        scheduler = JobScheduler(max_workers=1, per_chat_limit=1)
+        jobs = Jobs(scheduler)
+        jobs.submit(1, "a1")
+        jobs.submit(2, "b1")
+        # b1 starts before its "#1" report had a chance to run
+        await jobs.finish("a1")
+
+        self.assertEqual(jobs.started, ["a1", "b1"])
+        self.assertNotIn("b1", jobs.positions)
+
+    async def test_stop_tells_queued_jobs_they_were_dropped(self):
+        scheduler = JobScheduler(max_workers=1, per_chat_limit=1)
+        jobs = Jobs(scheduler)
+        jobs.submit(1, "a1")
+        jobs.submit(2, "b1")
+        jobs.submit(3, "c1")
+        await _settle()
+
+        await scheduler.stop(timeout=0.05)
+
+        self.assertEqual(sorted(jobs.dropped), ["b1", "c1"])
+        self.assertEqual(jobs.started, ["a1"])
+        self.assertEqual(scheduler.queue_depth, 0)
+        with self.assertRaises(RuntimeError):
+            jobs.submit(1, "late")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Order of the bot's graceful shutdown."""
+import unittest
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import bot
+
+
+class FakeUpdater:
+    def __init__(self, calls):
+        self.calls = calls
+        self.running = True
+
+    async def stop(self):
+        self.calls.append("updater.stop")
+
+
+class FakeApplication:
+    def __init__(self, calls):
+        self.calls = calls
+        self.running = True
+        self.updater = FakeUpdater(calls)
+
+    async def stop(self):
+        self.calls.append("application.stop")
+
+    async def shutdown(self):
+        self.calls.append("application.shutdown")
+
+
+class ShutdownOrderTest(unittest.IsolatedAsyncioTestCase):
+    async def test_intake_stops_before_draining_and_the_database_closes_last(self):
+        calls = []
+
+        async def scheduler_stop():
+            calls.append("scheduler.stop")
+
+        async def close_db():
+            calls.append("close_db")
+
+        saved = bot.job_scheduler.stop, bot.close_db
+        bot.job_scheduler.stop, bot.close_db = scheduler_stop, close_db
+        try:
+            await bot.shutdown(FakeApplication(calls))
+        finally:
+            bot.job_scheduler.stop, bot.close_db = saved
+
+        self.assertEqual(
+            calls,
+            ["updater.stop", "application.stop", "scheduler.stop", "application.shutdown", "close_db"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
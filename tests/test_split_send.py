@@ -0,0 +1,76 @@
+"""Sending an oversized video as its parts."""
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from telegram.error import BadRequest, NetworkError
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import bot
+
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+
+class FakeBot:
+    """Rejects albums so parts go one by one; fails the parts in ``failing``."""
+
+    def __init__(self, failing, error=BadRequest("Wrong file identifier/http url specified")):
+        self.failing = failing
+        self.error = error
+        self.sent = []
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        raise BadRequest("Group send failed")
+
+    async def send_video(self, chat_id, video, caption=None, **kwargs):
+        if caption.endswith(tuple(f"(parte {n}/3)" for n in self.failing)):
+            raise self.error
+        self.sent.append(caption)
+        return SimpleNamespace(video=None, audio=None)
+
+
+class SendInPartsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def _send(self, fake_bot):
+        item = bot._MediaItem(1, "https://youtu.be/big", 1, "send")
+        for index in range(1, 4):
+            part = bot._MediaItem(index, "", 1, "send")
+            part.stats = item.stats
+            part.send_path = Path(self.tmp.name) / f"part{index}.mp4"
+            part.send_path.write_bytes(b"x")
+            part.cleanup = [part.send_path]
+            part.caption = f"📹 (parte {index}/3)"
+            item.parts.append(part)
+        self.item = item
+        return await bot._send_in_parts(fake_bot, 1, "send", item, FakeMessage())
+
+    async def test_reports_the_parts_that_were_delivered(self):
+        sent, total = await self._send(FakeBot(failing=[3]))
+
+        self.assertEqual((sent, total), ([1, 2], 3))
+        self.assertIn("partes 1, 2 de 3", bot._unsent_parts_text(sent, total))
+        self.assertEqual(self.item.stats["outcome"], "error")
+        self.assertIn("llegaron las partes 1, 2 de 3", self.item.error)
+
+    async def test_upload_error_keeps_the_parts_already_sent(self):
+        sent, total = await self._send(FakeBot(failing=[2], error=NetworkError("connection reset")))
+
+        self.assertEqual((sent, total), ([1], 3))
+
+    async def test_all_parts_delivered(self):
+        self.assertEqual(await self._send(FakeBot(failing=[])), ([1, 2, 3], 3))
+        self.assertEqual(self.item.stats["outcome"], "sent_split")
+        self.assertFalse(any(part.send_path.exists() for part in self.item.parts))
+
+
+if __name__ == "__main__":
+    unittest.main()
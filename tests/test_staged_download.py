@@ -0,0 +1,102 @@
+"""Staged (PREFETCH_DOWNLOAD) downloads handed to a job."""
+import asyncio
+import unittest
+from pathlib import Path
+
+from telegram.error import BadRequest
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import bot
+
+
+class FakeMessage:
+    """Rejects an edit that doesn't change the text, as Telegram does."""
+
+    def __init__(self):
+        self.text = "⏳ Procesando el enlace..."
+        self.deleted = False
+
+    async def edit_text(self, text, **kwargs):
+        if text == self.text:
+            raise BadRequest("Message is not modified: specified new message content is the same")
+        self.text = text
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_video(self, chat_id, video, caption=None, **kwargs):
+        self.sent.append(Path(video).name)
+        return None
+
+
+class StagedDownloadTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._saved = {
+            name: getattr(bot, name)
+            for name in ("download_video", "identify_url", "transcode_to_telegram_mp4", "STREAM_TRANSCODE")
+        }
+        self._ensure_room = bot.storage.ensure_room
+
+        async def identify_url(url):
+            return None
+
+        async def transcode(path, max_size_mb=None, on_progress=None, profile="telegram", output_dir=None):
+            return True, "transcode skipped", path
+
+        bot.identify_url = identify_url
+        bot.transcode_to_telegram_mp4 = transcode
+        bot.STREAM_TRANSCODE = False
+        bot.storage.ensure_room = lambda *args: True
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(bot, name, value)
+        bot.storage.ensure_room = self._ensure_room
+
+    async def test_failed_staged_download_falls_back_to_a_normal_download(self):
+        downloads = []
+
+        async def download_video(url, output_dir, **kwargs):
+            downloads.append(url)
+            path = Path(output_dir) / "fallback.mp4"
+            path.write_bytes(b"video")
+            return True, "ok", path, {"id": "1", "extractor": "Test"}
+
+        async def failing_stage():
+            return False, "Error: HTTP Error 500", Path(), {}
+
+        bot.download_video = download_video
+        message, fake_bot = FakeMessage(), FakeBot()
+        stats = {"chat_id": 1, "action": "send", "outcome": "error"}
+        staged = asyncio.create_task(failing_stage())
+
+        await bot._deliver_video(fake_bot, 1, "tester", "send", "https://youtu.be/x", message, stats, staged)
+
+        self.assertEqual(downloads, ["https://youtu.be/x"])
+        self.assertEqual(fake_bot.sent, ["fallback.mp4"])
+        self.assertEqual(stats["outcome"], "sent")
+        self.assertTrue(message.deleted)
+
+    async def test_claimed_file_does_not_replace_a_saved_one(self):
+        staged_path = bot.DOWNLOAD_DIR / "Talk-abc.mp4"
+        staged_path.write_bytes(b"staged")
+        saved = bot.SAVED_VIDEOS_DIR / "Talk-abc.mp4"
+        saved.write_bytes(b"saved before")
+
+        async def stage():
+            return True, "ok", staged_path, {}
+
+        claimed = await bot._claim_staged(asyncio.create_task(stage()), bot.SAVED_VIDEOS_DIR, FakeMessage(), {})
+
+        self.assertEqual(saved.read_bytes(), b"saved before")
+        self.assertNotEqual(claimed[0], saved)
+        self.assertEqual(claimed[0].read_bytes(), b"staged")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""Orphan sweeps and the incremental index of StorageManager."""
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+from storage import DirectoryBudget, JobDir, StorageManager
+
+
+def _write(path: Path, size: int = 10, age: float = 0) -> Path:
+    path.write_bytes(b"x" * size)
+    if age:
+        when = time.time() - age
+        os.utime(path, (when, when))
+    return path
+
+
+class OrphanSweepTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.downloads = root / "downloads"
+        self.saved = root / "saved"
+        self.downloads.mkdir()
+        self.saved.mkdir()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _manager(self, pinned: bool = True) -> StorageManager:
+        return StorageManager(
+            [
+                DirectoryBudget("downloads", self.downloads, transient=True),
+                DirectoryBudget("saved_videos", self.saved, pinned=pinned),
+            ],
+            orphan_age=60,
+        )
+
+    def test_pinned_saved_videos_are_never_swept(self):
+        tg_copy = _write(self.saved / "Talk-abc123_tg.mp4", age=3600)
+        _write(self.saved / "Talk-abc123.mp4", age=3600)
+        leftover = _write(self.saved / "Other.mp4.part", age=3600)
+        storage = self._manager(pinned=True)
+        storage.refresh()
+
+        storage.sweep_orphans()
+
+        self.assertTrue(tg_copy.exists())
+        self.assertTrue(leftover.exists())
+
+    def test_unpinned_saved_dir_keeps_tg_copies_and_indexed_files(self):
+        tg_copy = _write(self.saved / "Talk-abc123_tg.mp4", age=3600)
+        _write(self.saved / "Talk-abc123.mp4", age=3600)
+        indexed_part = _write(self.saved / "Odd.f137.mp4", age=3600)
+        leftover = _write(self.saved / "Other.mp4.part", age=3600)
+        storage = self._manager(pinned=False)
+        storage.seed_access_times({str(indexed_part): time.time()})
+        storage.refresh()
+
+        storage.sweep_orphans()
+
+        self.assertTrue(tg_copy.exists())
+        self.assertTrue(indexed_part.exists())
+        self.assertFalse(leftover.exists())
+
+    def test_idle_files_in_transient_dir_are_swept(self):
+        tg_copy = _write(self.downloads / "Clip_tg.mp4", age=3600)
+        fresh = _write(self.downloads / "Fresh.mp4")
+        storage = self._manager()
+        storage.refresh()
+
+        storage.sweep_orphans()
+
+        self.assertFalse(tg_copy.exists())
+        self.assertTrue(fresh.exists())
+
+    def test_recorded_file_does_not_relist_its_directory(self):
+        _write(self.saved / "First.mp4", size=100)
+        storage = self._manager()
+        storage.refresh()
+        second = _write(self.saved / "Second.mp4", size=50)
+
+        storage.record_file(second)
+        scans = []
+        original = storage._scan_dir
+        storage._scan_dir = lambda directory, mtime_ns: scans.append(directory) or original(directory, mtime_ns)
+        storage.refresh(storage.budget_for(self.saved))
+
+        self.assertEqual(scans, [])
+        self.assertEqual(storage.usage(storage.budget_for(self.saved)), 150)
+
+        storage.sweep()
+        self.assertEqual(scans, [self.saved])
+
+    def test_files_of_running_jobs_are_kept_however_idle(self):
+        storage = self._manager(pinned=True)
+        jobs = [JobDir(self.downloads, "telegram https://youtu.be/x"), JobDir(self.saved, "best https://youtu.be/x")]
+        waiting = [_write(job.path / "Clip-x.mp4", age=3600) for job in jobs]
+        storage.refresh()
+
+        storage.sweep_orphans()
+        self.assertTrue(all(path.exists() for path in waiting))
+
+        # Once the job is gone its leftovers go too, even from the pinned directory
+        for job in jobs:
+            job.close()
+        storage.refresh()
+        storage.sweep_orphans()
+        self.assertFalse(any(path.exists() for path in waiting))
+        self.assertEqual([list(budget.iterdir()) for budget in (self.downloads, self.saved)], [[], []])
+
+
+class RoomTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.downloads = Path(self.tmp.name)
+        self.storage = StorageManager(
+            [DirectoryBudget("downloads", self.downloads, max_bytes=100, transient=True)], orphan_age=60
+        )
+        self.old = _write(self.downloads / "Old.mp4", size=80, age=3600)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_has_room_never_deletes(self):
+        self.assertFalse(self.storage.has_room(self.downloads, 50))
+        self.assertTrue(self.old.exists())
+        self.assertTrue(self.storage.has_room(self.downloads, 20))
+
+    def test_ensure_room_evicts_to_fit(self):
+        self.assertTrue(self.storage.ensure_room(self.downloads, 50))
+        self.assertFalse(self.old.exists())
+
+    def test_eviction_spares_files_in_use(self):
+        job = JobDir(self.downloads, "telegram https://youtu.be/x")
+        uploading = _write(job.path / "Clip-x.mp4", size=10, age=3600)
+        self.storage.refresh()
+        # An indexed copy a job just reused
+        self.storage.seed_access_times({str(self.old): time.time()})
+
+        self.assertFalse(self.storage.ensure_room(self.downloads, 50))
+
+        self.assertTrue(self.old.exists())
+        self.assertTrue(uploading.exists())
+        job.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Size budgets and height caps of transcode_to_telegram_mp4."""
+import tempfile
+import unittest
+from pathlib import Path
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import downloader
+
+MB = 1024 * 1024
+
+
+def _probe(codec: str, duration: float, format_name: str, height: int) -> dict:
+    return {
+        "format": {"format_name": format_name, "duration": str(duration)},
+        "streams": [
+            {"index": 0, "codec_type": "video", "codec_name": codec, "pix_fmt": "yuv420p", "width": height * 16 // 9, "height": height},
+            {"index": 1, "codec_type": "audio", "codec_name": "aac"},
+        ],
+    }
+
+
+class SizeBudgetTest(unittest.TestCase):
+    def test_audio_gives_way_before_the_video_floor(self):
+        video_kbps, audio_kbps = downloader._size_budget(40 * 60, 45 * MB)
+        self.assertEqual(video_kbps, downloader._MIN_VIDEO_KBPS)
+        self.assertLess(audio_kbps, 64)
+        self.assertGreaterEqual(audio_kbps, downloader._MIN_AUDIO_KBPS)
+
+    def test_long_videos_have_no_budget(self):
+        self.assertIsNone(downloader._size_budget(3600, 45 * MB))
+        self.assertIsNone(downloader._size_budget(3 * 3600, 45 * MB))
+
+
+class TranscodeBudgetTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = Path(self.tmp.name) / "clip.mkv"
+        self.src.write_bytes(b"x" * (2 * MB))
+        self.commands = []
+        self._saved = downloader.probe_media, downloader._run_ffmpeg, downloader.FFMPEG_TWO_PASS
+        downloader.FFMPEG_TWO_PASS = False
+
+        async def run_ffmpeg(cmd, cpu_bound=True, on_line=None):
+            self.commands.append(cmd)
+            Path(cmd[-1]).write_bytes(b"x" * (2 * MB))
+            return True, ""
+
+        downloader._run_ffmpeg = run_ffmpeg
+
+    def tearDown(self):
+        downloader.probe_media, downloader._run_ffmpeg, downloader.FFMPEG_TWO_PASS = self._saved
+        self.tmp.cleanup()
+
+    def _probe_as(self, codec: str, duration: float, format_name: str = "matroska,webm", height: int = 720) -> None:
+        async def probe_media(path):
+            return _probe(codec, duration, format_name, height)
+
+        downloader.probe_media = probe_media
+
+    async def test_infeasible_budget_only_remuxes_a_compatible_source(self):
+        self._probe_as("h264", 3600)
+
+        ok, msg, out = await downloader.transcode_to_telegram_mp4(self.src, 1)
+
+        self.assertTrue(ok)
+        self.assertEqual(msg, "remuxed")
+        self.assertEqual(len(self.commands), 1)
+        self.assertIn("copy", self.commands[0][self.commands[0].index("-c:v") + 1])
+
+    async def test_overshoot_at_the_floor_is_not_encoded_again(self):
+        # 1 MB over 60 s leaves about 132 kbps: the video is already at its floor
+        self._probe_as("av1", 60)
+
+        ok, _, out = await downloader.transcode_to_telegram_mp4(self.src, 1)
+
+        self.assertTrue(ok)
+        self.assertEqual(len(self.commands), 1)
+        self.assertGreater(out.stat().st_size, MB)
+
+    async def test_telegram_profile_is_kept_within_the_max_height(self):
+        # A compatible 1080p MP4 that fits would otherwise be sent untouched
+        self.src = self.src.rename(self.src.with_suffix(".mp4"))
+        self._probe_as("h264", 60, "mov,mp4,m4a,3gp,3g2,mj2", height=1080)
+
+        ok, msg, _ = await downloader.transcode_to_telegram_mp4(self.src, 50)
+
+        self.assertEqual((ok, msg), (True, "transcoded"))
+        self.assertIn(f"scale=-2:{downloader.TELEGRAM_MAX_HEIGHT}", self.commands[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
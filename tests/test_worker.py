@@ -0,0 +1,104 @@
+"""Job leases: a worker that loses one stops, and exhausted jobs are failed."""
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import update
+
+from tests import _env  # noqa: F401  (must come before the src imports)
+import downloader
+import worker
+from db_manager import db, init_db
+from jobqueue import SQLiteJobQueue
+from models import QueuedJob, QueueJob
+
+
+class LostLeaseQueue:
+    def __init__(self):
+        self.finished = []
+
+    async def renew(self, job_id, worker_id, lease_seconds):
+        return False
+
+    async def finish(self, job_id, worker_id, error=None):
+        self.finished.append(job_id)
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits.append((chat_id, message_id, text))
+
+
+class WorkerLeaseTest(unittest.IsolatedAsyncioTestCase):
+    async def test_lost_lease_cancels_the_job(self):
+        cancelled = asyncio.Event()
+
+        async def process_request(*args, **kwargs):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return "sent"
+
+        saved = worker.process_request, worker.JOB_LEASE_SECONDS
+        worker.process_request, worker.JOB_LEASE_SECONDS = process_request, 0.03
+        try:
+            queue = LostLeaseQueue()
+            job = QueueJob(id=7, chat_id=1, action="send", url="https://youtu.be/x", message_id=3, attempts=1)
+            await asyncio.wait_for(worker.Worker(queue, FakeBot(), 1, "w1")._process(job), timeout=5)
+        finally:
+            worker.process_request, worker.JOB_LEASE_SECONDS = saved
+
+        self.assertTrue(cancelled.is_set())
+        self.assertEqual(queue.finished, [])
+
+    async def test_lost_lease_kills_the_job_subprocess(self):
+        pid_file = Path(tempfile.mkdtemp()) / "pid"
+        script = f"import os, time; open({str(pid_file)!r}, 'w').write(str(os.getpid())); time.sleep(60)"
+
+        async def process_request(*args, **kwargs):
+            await downloader._run_streaming([sys.executable, "-c", script])
+            return "sent"
+
+        saved = worker.process_request, worker.JOB_LEASE_SECONDS
+        worker.process_request, worker.JOB_LEASE_SECONDS = process_request, 0.6
+        try:
+            job = QueueJob(id=8, chat_id=1, action="send", url="https://youtu.be/x", message_id=3, attempts=1)
+            await asyncio.wait_for(worker.Worker(LostLeaseQueue(), FakeBot(), 1, "w1")._process(job), timeout=5)
+        finally:
+            worker.process_request, worker.JOB_LEASE_SECONDS = saved
+
+        with self.assertRaises(ProcessLookupError):
+            os.kill(int(pid_file.read_text()), 0)
+
+    async def test_exhausted_job_is_failed_and_its_user_told(self):
+        await init_db()
+        queue = SQLiteJobQueue(db, max_attempts=2)
+        job_id = await queue.enqueue(1, "tester", "send", "https://youtu.be/x", 42)
+        async with db.session() as session:
+            await session.execute(
+                update(QueuedJob)
+                .where(QueuedJob.id == job_id)
+                .values(state="running", attempts=2, lease_until=datetime.utcnow() - timedelta(seconds=1))
+            )
+            await session.commit()
+
+        self.assertIsNone(await queue.claim("w2", 60))
+        bot = FakeBot()
+        await worker.Worker(queue, bot, 1, "w2")._fail_expired()
+
+        self.assertEqual([(chat_id, message_id) for chat_id, message_id, _ in bot.edits], [(1, 42)])
+        self.assertEqual((await queue.counts()).get("failed"), 1)
+        self.assertEqual(await queue.fail_expired(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()